@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Compact set of UniProt accessions stored on disk
+        Accessions are encoded as base 36 integers (UniProt accessions are at most 10 characters
+        long and start with a letter, so every accession gets a distinct 64 bits value)
+        The index file contains a header followed by the sorted values (unsigned 64 bits, native byte order)
+        It is memory-mapped for lookups (binary search), so all processes reading the same file share it
+        through the page cache
+
+@arguments [-i inputfile]: file containing one accession per line
+           [-o indexfile]: index file to generate
+"""
+
+import argparse
+import heapq
+import mmap
+import os
+import tempfile
+from array import array
+from bisect import bisect_left
+
+MAGIC = b"ACCIDX01"
+ACCESSION_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode_accession(acc):
+    """
+    Integer value of an accession (str or bytes), raises ValueError for non alphanumeric accessions
+    """
+    if len(acc) > 12 or not acc.isalnum():
+        raise ValueError(f"Invalid accession {acc}")
+    return int(acc, 36)
+
+
+def decode_accession(value):
+    """
+    Accession corresponding to an integer value (upper case)
+    """
+    chars = []
+    while value:
+        value, i = divmod(value, 36)
+        chars.append(ACCESSION_CHARS[i])
+    return "".join(reversed(chars))
+
+
+def get_index_file(proteinfile):
+    """
+    Name of the index file corresponding to a list of accessions
+    """
+    return f"{os.path.splitext(proteinfile)[0]}.idx"
+
+
+class accession_index_writer:
+    """
+    Build an index file from accessions given in any order
+    Accessions are sorted by chunks saved into temporary files, then merged,
+    so the memory used doesn't depend on the number of accessions
+    """
+
+    def __init__(self, indexfile, chunk_size=5000000):
+        self.indexfile = indexfile
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.runs = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            for run in self.runs:
+                run.close()
+
+    def add(self, acc):
+        self.chunk.append(encode_accession(acc))
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def add_many(self, accessions):
+        for acc in accessions:
+            self.add(acc)
+
+    def flush(self):
+        if self.chunk:
+            self.chunk.sort()
+            run = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.indexfile)))
+            array("Q", self.chunk).tofile(run)
+            run.seek(0)
+            self.runs.append(run)
+            self.chunk = []
+
+    def read_run(self, run, block=1 << 16):
+        while True:
+            values = array("Q")
+            try:
+                values.fromfile(run, block)
+            except EOFError:
+                # fewer values than requested left in the file
+                yield from values
+                break
+            yield from values
+
+    def close(self):
+        """
+        Merge the sorted chunks into the index file (written to a temporary file then renamed)
+        """
+        self.flush()
+        tmpfile = f"{self.indexfile}.tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(MAGIC)
+            buffer = array("Q")
+            previous = None
+            for value in heapq.merge(*[self.read_run(run) for run in self.runs]):
+                if value == previous:
+                    continue
+                buffer.append(value)
+                previous = value
+                if len(buffer) >= 1 << 20:
+                    buffer.tofile(f)
+                    self.count += len(buffer)
+                    buffer = array("Q")
+            buffer.tofile(f)
+            self.count += len(buffer)
+
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        os.replace(tmpfile, self.indexfile)
+
+
+def build_index(accessions, indexfile):
+    """
+    Write the index file for the given accessions, return the number of distinct accessions
+    """
+    with accession_index_writer(indexfile) as writer:
+        writer.add_many(accessions)
+    return writer.count
+
+
+class accession_index:
+    """
+    Read-only set of accessions backed by an index file
+    """
+
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self.open()
+
+    def open(self):
+        with open(self.indexfile, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[: len(MAGIC)] != MAGIC:
+            self.buffer.close()
+            raise ValueError(f"{self.indexfile} is not an accession index file")
+        self.values = memoryview(self.buffer)[len(MAGIC) :].cast("Q")
+
+    def close(self):
+        self.values.release()
+        self.buffer.close()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __contains__(self, acc):
+        try:
+            value = encode_accession(acc)
+        except (TypeError, ValueError):
+            return False
+        i = bisect_left(self.values, value)
+        return i < len(self.values) and self.values[i] == value
+
+    # only the file name is sent to other processes, the file is mapped again on their side
+    def __getstate__(self):
+        return {"indexfile": self.indexfile}
+
+    def __setstate__(self, state):
+        self.indexfile = state["indexfile"]
+        self.open()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputfile", help="file containing the accessions", required=True)
+    parser.add_argument("-o", "--indexfile", help="index file to generate", required=True)
+    args = parser.parse_args()
+
+    with open(args.inputfile, "r") as f:
+        count = build_index((line.strip("\n") for line in f if line.strip("\n")), args.indexfile)
+    print(f"{count} accessions saved in {args.indexfile}")
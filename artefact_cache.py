@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Cache of the files produced when building a family (alignment, liftover, pfbuild), reused by the next runs
+        The key of a stage is a hash of its input file (cluster sequences, SEED alignment), of the scripts and
+        programs of the stage (their contents) and of its parameters, so it doesn't depend on the family number:
+        the files of a cluster which didn't change are restored in its new family directory instead of running
+        the stage again
+        The keys of the stages searching pfamseq (liftover, pfbuild) also include the version of pfamseq: path,
+        size and modification time of the pfamseq file of the Pfam configuration ($PFAM_CONFIG), or a version
+        given to the cache; the cache can't be used for these stages without it
+        <cachedir>/<key[:2]>/<key>.<stage>/: files of a stage, named with FAMILY in place of the family name
+        <cachedir>/cache.db: size and last use of each entry (SQLite, WAL mode), the least recently used
+        entries are removed once the cache is larger than its maximum size
+        The key of each stage is saved in the family directory (.cache_key.<stage>) for the stages run later
+
+@arguments CACHEDIR: cache directory
+           [-s SIZE]: remove the least recently used entries to keep the cache under SIZE GB
+
+"""
+
+import argparse
+import functools
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+# changed when the layout of the entries changes
+CACHE_FORMAT = b"2"
+KEY_FILE = ".cache_key"
+FAMILY = "FAMILY"
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (key, stage)
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def tool_digest(tool):
+    """
+    Digest of the content of a script or program (path, or name found in PATH),
+    the name itself if it can't be read
+    """
+    path = tool if os.path.isfile(tool) else shutil.which(tool)
+    if not path:
+        return tool.encode("utf-8")
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def content_key(inputfile, tools, parameters=""):
+    """
+    Key of the files produced from inputfile with the tools and parameters
+    """
+    digest = hashlib.blake2b(CACHE_FORMAT, digest_size=20)
+    for tool in tools:
+        digest.update(tool_digest(tool))
+    digest.update(parameters.encode("utf-8"))
+    with open(inputfile, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_key(familydir, stage, key):
+    with open(os.path.join(familydir, f"{KEY_FILE}.{stage}"), "w") as f:
+        f.write(key)
+
+
+def family_key(familydir, stage):
+    """
+    Key of the stage saved in the family directory, None if the stage isn't cached
+    """
+    try:
+        with open(os.path.join(familydir, f"{KEY_FILE}.{stage}"), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def pfam_config_value(configfile, block, name):
+    """
+    Value of name in the <block> section of a Pfam configuration file (Config::General format),
+    None if not found
+    """
+    blocks = []
+    with open(configfile, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            tag = re.fullmatch(r"<(/?)\s*(\w+)[^>]*>", line)
+            if tag:
+                if tag.group(1):
+                    blocks = blocks[:-1]
+                else:
+                    blocks.append(tag.group(2))
+                continue
+            # "name value" or "name = value"
+            fields = re.split(r"\s*=\s*|\s+", line, maxsplit=1)
+            if blocks and blocks[-1] == block and fields[0] == name and len(fields) == 2:
+                return fields[1].strip("\"'")
+    return None
+
+
+def pfamseq_version(configfile=None):
+    """
+    Version of the pfamseq database searched by the liftover and pfbuild: path, size and modification time
+    of pfamseq (location of the <pfamseq> section of the Pfam configuration, $PFAM_CONFIG if not given),
+    None if not found
+    """
+    configfile = configfile or os.environ.get("PFAM_CONFIG")
+    if not configfile or not os.path.isfile(configfile):
+        return None
+    location = pfam_config_value(configfile, "pfamseq", "location")
+    if not location:
+        return None
+    path = os.path.join(location, "pfamseq") if os.path.isdir(location) else location
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return f"{os.path.realpath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class artefact_cache:
+    """
+    Files of the stages of the families, by key, with a connection to the index per thread
+    """
+
+    def __init__(self, cachedir, max_size, pfamseq=None):
+        """
+        max_size: maximum size of the cache in bytes
+        pfamseq: version of pfamseq (see pfamseq_version), needed by the stages searching pfamseq
+        """
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.pfamseq = pfamseq
+        os.makedirs(cachedir, exist_ok=True)
+        self.local = threading.local()
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def connection(self):
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(os.path.join(self.cachedir, "cache.db"), timeout=BUSY_TIMEOUT)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+    def stage_key(self, inputfile, tools, parameters="", pfamseq=False):
+        """
+        Key of the files of a stage produced from inputfile with the tools and parameters of the stage,
+        and with the version of pfamseq if the stage searches it
+        """
+        if pfamseq:
+            if not self.pfamseq:
+                raise ValueError("The version of pfamseq is needed to cache the stages searching it")
+            parameters = f"{parameters}\0{self.pfamseq}"
+        return content_key(inputfile, tools, parameters)
+
+    def entry_dir(self, key, stage):
+        return os.path.join(self.cachedir, key[:2], f"{key}.{stage}")
+
+    def restore(self, key, stage, familydir, family):
+        """
+        Copy the files of the stage into familydir, return False if not cached
+        """
+        entry = self.entry_dir(key, stage)
+        with self.connection() as db:
+            cursor = db.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ? AND stage = ?",
+                (time.time(), key, stage),
+            )
+        if cursor.rowcount != 1 or not os.path.isdir(entry):
+            return False
+        try:
+            for name in os.listdir(entry):
+                shutil.copyfile(
+                    os.path.join(entry, name),
+                    os.path.join(familydir, name.replace(FAMILY, family)),
+                )
+        except FileNotFoundError:
+            # evicted in the meantime
+            return False
+        return True
+
+    def store(self, key, stage, familydir, family, filenames):
+        """
+        Save the files of the stage found in familydir (names formatted with family),
+        the entry is written in a temporary directory then renamed
+        """
+        entry = self.entry_dir(key, stage)
+        if os.path.isdir(entry):
+            return
+        tmpdir = f"{entry}.tmp_{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(tmpdir, exist_ok=True)
+        size = 0
+        for filename in filenames:
+            path = os.path.join(familydir, filename.format(family=family))
+            if os.path.isfile(path):
+                shutil.copyfile(path, os.path.join(tmpdir, filename.format(family=FAMILY)))
+                size += os.path.getsize(path)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # stored in the meantime
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        with self.connection() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, stage, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, stage, size, time.time()),
+            )
+        self.evict()
+
+    def size(self):
+        return self.connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used entries until the cache is under max_size bytes,
+        return the number of entries removed
+        """
+        max_size = self.max_size if max_size is None else max_size
+        total = self.size()
+        if total <= max_size:
+            return 0
+        removed = []
+        for key, stage, size in self.connection().execute(
+            "SELECT key, stage, size FROM entries ORDER BY last_used"
+        ):
+            if total <= max_size:
+                break
+            removed.append((key, stage))
+            total -= size
+        with self.connection() as db:
+            db.executemany("DELETE FROM entries WHERE key = ? AND stage = ?", removed)
+        for key, stage in removed:
+            entry = self.entry_dir(key, stage)
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(entry))
+            except OSError:
+                # other entries with the same prefix
+                pass
+        return len(removed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cachedir", help="cache directory")
+    parser.add_argument(
+        "-s", "--size", help="remove the least recently used entries to keep the cache under SIZE GB", type=float
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.cachedir, "cache.db")):
+        print(f"No cache found in {args.cachedir}")
+        sys.exit(1)
+
+    cache = artefact_cache(args.cachedir, 0)
+    if args.size is not None:
+        removed = cache.evict(int(args.size * 1024 ** 3))
+        print(f"{removed} entries removed")
+    counts = cache.connection().execute("SELECT stage, COUNT(*) FROM entries GROUP BY stage")
+    for stage, count in counts.fetchall():
+        print(f"{stage}\t{count}")
+    print(f"{cache.size() / 1024 ** 3:.2f} GB")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Liftover of a batch of families in a single search of pfamseq, instead of a liftover_alignment.pl run
+        (and a scan of pfamseq) per family
+        The SEED alignments of the families are written to one Stockholm query file, one alignment per family
+        named by the family (#=GF ID); the search command builds a query from each alignment and searches pfamseq
+        once with all of them, e.g. hmmbuild (one HMM per alignment, named by the alignment) then hmmsearch -A
+        (one alignment of the hits per query, named by the query):
+            hmmbuild {input}.hmm {input} > /dev/null && hmmsearch -A {output} {input}.hmm pfamseq > /dev/null
+        The output is split by query name, the alignment of the hits of each family being written to its
+        <family>_SEED.phmmer file (mul format)
+        The families missing from the output (or all of them if the search fails) are lifted over
+        one by one with liftover_alignment.pl
+
+@arguments -s SEARCH: search command, {input} and {output} replaced by the query and output files
+           -o OUTPUT: prefix of the query (<OUTPUT>.seed) and output (<OUTPUT>.phmmer) files
+           FAMILYDIR [FAMILYDIR ...]: directories of the families of the batch
+
+"""
+
+import argparse
+import os
+import shlex
+import sys
+import threading
+
+import seed_alignment
+from build_families import submit_liftover
+from job_executor import FAILED, default_executor
+
+SCRIPT = os.path.realpath(__file__)
+
+
+def combine_seeds(familydirs, queryfile):
+    """
+    Write the SEED alignments of the families to queryfile (Stockholm), each alignment named by its family,
+    return the families whose SEED alignment was written
+    """
+    families = []
+    with open(queryfile, "w") as query:
+        for familydir in familydirs:
+            family = os.path.basename(os.path.abspath(familydir))
+            seedfile = os.path.join(familydir, f"{family}_SEED")
+            if not os.path.isfile(seedfile):
+                print(f"SEED alignment not found: {seedfile}")
+                continue
+            try:
+                alignment = seed_alignment.read_alignment(seedfile)
+            except ValueError as e:
+                print(f"Invalid SEED alignment for {family}: {e}")
+                continue
+            if len(alignment) == 0:
+                print(f"Empty SEED alignment for {family}")
+                continue
+            alignment.write_stockholm(query, family)
+            families.append(family)
+    return families
+
+
+def read_alignments(stockholmfile):
+    """
+    Yield (name, lines) for each alignment of a Stockholm file: name given by its #=GF ID line (None if missing),
+    lines of the sequences; an alignment without end line (//) is left out
+    """
+    name, lines = None, []
+    with open(stockholmfile, "r") as f:
+        for line in f:
+            if line.startswith("//"):
+                yield name, lines
+                name, lines = None, []
+            elif line.startswith("#=GF ID"):
+                fields = line.split()
+                name = fields[2] if len(fields) > 2 else None
+            elif line.strip() and not line.startswith("#"):
+                lines.append(line)
+
+
+def split_output(outputfile, familydirs):
+    """
+    Write the alignment of the hits of each family of the search output to its <family>_SEED.phmmer file
+    (mul format), return the families found in the output
+    """
+    familydirs = {os.path.basename(os.path.abspath(d)): d for d in familydirs}
+    found = []
+    for family, lines in read_alignments(outputfile):
+        if family not in familydirs or family in found or not lines:
+            continue
+        outfile = os.path.join(familydirs[family], f"{family}_SEED.phmmer")
+        hitsfile = f"{outfile}.sto"
+        with open(hitsfile, "w") as f:
+            f.writelines(lines)
+        try:
+            # written to a temporary file then renamed, check_lift_over may be waiting for it
+            seed_alignment.convert_to_mul(hitsfile, outfile)
+        except ValueError as e:
+            print(f"Invalid alignment of {family} in the batch output: {e}")
+            continue
+        finally:
+            os.remove(hitsfile)
+        found.append(family)
+    return found
+
+
+def run_batch(search, output, familydirs):
+    """
+    Lift over the families in a single search, the families missing from the output are lifted over
+    one by one, return the number of families lifted over by the search
+    """
+    queryfile, outputfile = f"{output}.seed", f"{output}.phmmer"
+    families = combine_seeds(familydirs, queryfile)
+    found = []
+    if families:
+        command = search.format(input=shlex.quote(queryfile), output=shlex.quote(outputfile))
+        print(f"Searching pfamseq for {len(families)} families")
+        status = os.system(command)
+        if status != 0:
+            print(f"Error while running {command} (status {status})")
+        elif os.path.isfile(outputfile):
+            found = split_output(outputfile, familydirs)
+
+    executor = default_executor()
+    for familydir in familydirs:
+        family = os.path.basename(os.path.abspath(familydir))
+        if family not in found:
+            print(f"{family} not found in the batch output, running its liftover")
+            submit_liftover(family, familydir, executor)
+    # the liftover jobs are submitted once liftover_alignment.pl returns
+    executor.wait(list(executor.jobs.values()))
+    return len(found)
+
+
+class liftover_batch:
+    """
+    Families waiting for their liftover, submitted to the executor by batches of size families
+    ("liftover_batch" stage, the batch files are written in batchdir)
+    on_submit(name, families) is called once a batch is submitted (with the batch lock held)
+    """
+
+    def __init__(self, executor, search, size, batchdir, on_submit=None):
+        self.executor = executor
+        self.search = search
+        self.size = size
+        self.batchdir = batchdir
+        os.makedirs(batchdir, exist_ok=True)
+        self.on_submit = on_submit
+        self.lock = threading.RLock()
+        self.waiting = []
+        self.batches = 0
+        # batch name: family directories
+        self.submitted = {}
+        # family: name of its batch, None until submitted
+        self.families = {}
+
+    def __contains__(self, family):
+        with self.lock:
+            return family in self.families
+
+    def job(self, family):
+        """
+        Job of the batch of the family, None if the batch isn't submitted
+        """
+        with self.lock:
+            name = self.families.get(family)
+        return self.executor.get("liftover_batch", name) if name else None
+
+    def add(self, family, familydir):
+        with self.lock:
+            self.families[family] = None
+            self.waiting.append(familydir)
+            if len(self.waiting) >= self.size:
+                self.submit()
+
+    def flush(self):
+        """
+        Submit the families waiting, e.g. once all the alignments are built
+        """
+        with self.lock:
+            if self.waiting:
+                self.submit()
+
+    def submit(self):
+        # called with the lock held
+        self.batches += 1
+        name = f"batch_{self.batches}"
+        familydirs = [os.path.abspath(d) for d in self.waiting]
+        self.waiting = []
+        self.submitted[name] = familydirs
+        families = [os.path.basename(d) for d in familydirs]
+        for family in families:
+            self.families[family] = name
+        command = " ".join(
+            [shlex.quote(sys.executable), shlex.quote(SCRIPT)]
+            + ["-s", shlex.quote(self.search), "-o", shlex.quote(os.path.join(self.batchdir, name))]
+            + [shlex.quote(d) for d in familydirs]
+        )
+        print(f"Submitting liftover {name} ({len(familydirs)} families)")
+        self.executor.submit("liftover_batch", name, command, self.batchdir)
+        if self.on_submit:
+            self.on_submit(name, families)
+
+    def failed_families(self):
+        """
+        Families of the batches which failed (to lift over one by one), returned once
+        """
+        families = []
+        with self.lock:
+            for name, familydirs in list(self.submitted.items()):
+                job = self.executor.get("liftover_batch", name)
+                if job and job.state == FAILED:
+                    families.extend(familydirs)
+                    del self.submitted[name]
+        return families
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--search",
+        help="search command, {input} and {output} replaced by the query and output files",
+        required=True,
+    )
+    parser.add_argument(
+        "-o", "--output", help="prefix of the query and output files", required=True
+    )
+    parser.add_argument("familydir", help="directories of the families of the batch", nargs="+")
+    args = parser.parse_args()
+
+    found = run_batch(args.search, args.output, args.familydir)
+    print(f"{found} families out of {len(args.familydir)} lifted over by the batch search")
@@ -11,26 +11,71 @@
 #
 ###################
 
-from complete_desc_file import check_pfambuild, complete_desc
+from complete_desc_file import (
+    PFBUILD_ERRORS,
+    check_pfambuild,
+    complete_desc,
+    run_in_dir,
+    store_pfbuild,
+    submit_pfbuild,
+)
+from artefact_cache import artefact_cache, family_key, pfamseq_version, save_key
+from cluster_archive import cluster_archive
+from job_events import directory_watcher, job_log
+from job_executor import EXECUTORS, FAILED, default_executor
+import seed_alignment
+import glob
 import os
 from shutil import copyfile, rmtree
 import argparse
 import time
-import re
-import subprocess
 import sys
 
+LIFTOVER_ERRORS = (r"^Exited with exit code",)
+LIFTOVER_SCRIPT = "/nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/liftover_alignment.pl"
+ALIGNMENT_SCRIPT = "/nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/create_alignment.pl"
+# the cached files of each stage depend on its input file, its tools and parameters
+# (and on pfamseq for the liftover, see artefact_cache.py)
+ALIGNMENT_TOOLS = (ALIGNMENT_SCRIPT, seed_alignment.__file__)
+ALIGNMENT_PARAMETERS = "create_alignment.pl -m"
+LIFTOVER_TOOLS = (LIFTOVER_SCRIPT,)
+# files of the stages, {family} replaced by the family name
+ALIGNMENT_FILES = ("{family}", "{family}_SEED")
+LIFTOVER_FILES = ("{family}_SEED.phmmer",)
+
+
+def submit_liftover(family, familydir=".", executor=None):
+    """
+    Run liftover_alignment.pl as a detached job of the "liftover" stage: it submits its own LSF job,
+    the job keeps its slot until check_lift_over finds the liftover complete or failed
+    """
+    executor = executor or default_executor()
+    executor.submit(
+        "liftover", family, f"perl {LIFTOVER_SCRIPT} -align {family}_SEED", familydir, detached=True
+    )
+
 
-def check_lift_over(family, outfile, count):
+def check_lift_over(family, outfile, count, familydir=".", log=None, executor=None, cache=None):
+    """
+    log: job_log of liftover.log, read from its last offset (the whole log is read if not given)
+    executor: executor the liftover was submitted to (local processes if not given)
+    cache: artefact_cache the liftover output is saved to
+    """
+    executor = executor or default_executor()
 
-    family_seed = f"{family}_SEED"
+    seed = os.path.join(familydir, "SEED")
+    logfile = os.path.join(familydir, "liftover.log")
 
     if os.path.isfile(outfile) and os.path.getsize(outfile) != 0:
-        copyfile(outfile, "SEED4")
+        executor.finish("liftover", family)
+        key = family_key(familydir, "liftover")
+        if cache and key:
+            cache.store(key, "liftover", familydir, family, LIFTOVER_FILES)
+        copyfile(outfile, os.path.join(familydir, "SEED4"))
         print(f"Liftover complete for {family}")
-        prepare_seed()
+        prepare_seed(familydir)
 
-        if os.path.isfile("SEED") and os.path.getsize("SEED") != 0:
+        if os.path.isfile(seed) and os.path.getsize(seed) != 0:
             print(f"Building Pfam from seed alignment for {family}")
             # os.system("pfbuild -withpfmake SEED")  # ~3 minutes run
             return True
@@ -41,64 +86,63 @@ def check_lift_over(family, outfile, count):
             else:
                 return "failed"
 
-    elif os.path.isfile("liftover.log") and os.path.getsize("liftover.log") != 0:
-        with open("liftover.log") as f:
-            datafile = f.readlines()
-            # verify that the process has finished running
-            if "Resource usage summary:\n" in datafile:
-                r = re.compile("Exited with exit code")
-                newlines = list(filter(r.match, datafile))
-                if len(newlines) > 0:  # if error found in the process
-                    print(newlines)
-                    if count < 1:  # number of failures below 1, try to run a second time
-                        to_delete = ["*.fa", "*.log", "*.aln", "*.hmm", "hmmsearch.tbl"]
-                        for filed in to_delete:
-                            try:
-                                os.remove(filed)
-                            except FileNotFoundError:
-                                pass
-                        # Memory limit issue, stop processing this family
-                        if "Exited with exit code 25.\n" in newlines:
-                            print("Memory limit error")
-                            return
-                        else:
-                            print("Error in liftover, trying again")
-                            os.system(
-                                f"perl /nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/liftover_alignment.pl -align {family_seed}"
-                            )
-                            return
-                    else:
-                        print(newlines)
+    elif os.path.isfile(logfile) and os.path.getsize(logfile) != 0:
+        if log is None:
+            log = job_log(logfile, LIFTOVER_ERRORS)
+        log.update()
+        # verify that the process has finished running
+        if log.finished:
+            newlines = log.errors
+            if len(newlines) > 0:  # if error found in the process
+                print(newlines)
+                if count < 1:  # number of failures below 1, try to run a second time
+                    to_delete = ["*.fa", "*.log", "*.aln", "*.hmm", "hmmsearch.tbl"]
+                    for filed in to_delete:
+                        for path in glob.glob(os.path.join(familydir, filed)):
+                            os.remove(path)
+                    log.reset()
+                    # Memory limit issue, stop processing this family
+                    if "Exited with exit code 25.\n" in newlines:
+                        print("Memory limit error")
+                        executor.finish("liftover", family, success=False)
                         return "failed"
+                    else:
+                        print("Error in liftover, trying again")
+                        submit_liftover(family, familydir, executor)
+                        return
+                else:
+                    print(newlines)
+                    executor.finish("liftover", family, success=False)
+                    return "failed"
 
     return False
 
 
-def prepare_seed():
-    trim_alignment_script = (
-        "/nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/trim_alignment.pl"
-    )
-    # Make non redundant at 80% identity
-    os.system("belvu -n 80 -o mul SEED4 | grep -v '//' > SEED3")
-
-    # Remove gappy columns from N and C terminus
-    print("Starting trim alignment")
+def prepare_seed(familydir="."):
+    # Make non redundant at 80% identity, remove gappy columns from N and C terminus
+    # and partial sequences, i.e. those with a gap character at start of end of alignment
+    # (see seed_alignment.py)
+    print("Starting SEED preparation")
     start_time = time.time()
-    os.system(f"perl {trim_alignment_script} -in SEED3 -out SEED2")
+    try:
+        count = seed_alignment.prepare_seed(
+            os.path.join(familydir, "SEED4"), os.path.join(familydir, "SEED")
+        )
+        print(f"{count} sequences in SEED")
+    except ValueError as e:
+        print(e)
     print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
 
-    # Remove partial sequences, i.e. those with a gap character at start of end of alignment
-    os.system("belvu -P -o mul SEED2 | grep -v '//' > SEED")
 
-
-def build_alignment(cluster_file, family):
-
-    liftover_alignment = (
-        "/nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/liftover_alignment.pl"
-    )
-    alignment_script = (
-        "/nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/create_alignment.pl"
-    )
+def build_alignment(cluster_file, family, familydir=".", executor=None, cache=None, batch=None):
+    """
+    Align the cluster sequences and submit the liftover of the alignment to executor, the commands
+    are run in familydir so several families can be built at the same time
+    cache: artefact_cache the alignment is restored from if the cluster was built before, and the liftover
+    output if the alignment was lifted over before (with the same pfamseq)
+    batch: batch_liftover.liftover_batch the family is added to, instead of running its own liftover
+    Return False if the cluster file is not found or the alignment failed
+    """
 
     print(f"Building family {family}")
 
@@ -106,21 +150,54 @@ def build_alignment(cluster_file, family):
     start_time = time.time()
     print(f"Starting alignment for {family}")
     if os.path.isfile(cluster_file):
-        os.system(f"perl {alignment_script} -fasta {cluster_file} -m > {family}")
-        print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-        # transform from aligned fasta to Pfam alignment format
-        family_seed = f"{family}_SEED"
-        while os.path.isfile(family_seed) == False or os.path.getsize(family_seed) == 0:
-            os.system(f"belvu -o mul {family} | grep -v '//' >  {family_seed}")
+        cluster_file = os.path.abspath(cluster_file)
+        key = None
+        if cache:
+            key = cache.stage_key(cluster_file, ALIGNMENT_TOOLS, ALIGNMENT_PARAMETERS)
+            save_key(familydir, "alignment", key)
+
+        if key and cache.restore(key, "alignment", familydir, family):
+            print(f"Alignment of {family} restored from the cache")
+        else:
+            run_in_dir(f"perl {ALIGNMENT_SCRIPT} -fasta {cluster_file} -m > {family}", familydir)
+            print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
+
+            # transform from aligned fasta to Pfam alignment format
+            try:
+                count = seed_alignment.convert_to_mul(
+                    os.path.join(familydir, family), os.path.join(familydir, f"{family}_SEED")
+                )
+            except (OSError, ValueError) as e:
+                print(f"Invalid alignment for {family}: {e}")
+                return False
+            if count == 0:
+                print(f"Empty alignment for {family}")
+                return False
+            if key:
+                cache.store(key, "alignment", familydir, family, ALIGNMENT_FILES)
 
         # align against pfamseq database
-        print(f"Starting Liftover")
-        os.system(f"perl {liftover_alignment} -align {family_seed}")  # ~7 minutes run
+        if cache:
+            # the batch search replaces liftover_alignment.pl
+            key = cache.stage_key(
+                os.path.join(familydir, f"{family}_SEED"),
+                LIFTOVER_TOOLS,
+                batch.search if batch else "",
+                pfamseq=True,
+            )
+            save_key(familydir, "liftover", key)
+        if key and cache.restore(key, "liftover", familydir, family):
+            print(f"Liftover of {family} restored from the cache")
+        elif batch:
+            batch.add(family, familydir)
+        else:
+            print(f"Starting Liftover")
+            submit_liftover(family, familydir, executor)  # ~7 minutes run
+        return True
 
     else:
         print(f"File not found error: {cluster_file}")
-        sys.exit()
+        return False
 
 
 if __name__ == "__main__":
@@ -134,10 +211,31 @@ if __name__ == "__main__":
     )
     parser.add_argument("-f", "--family", help="Family accession to process", required=True)
     parser.add_argument("-d", "--datadir", help="Directory where to save data", required=True)
+    parser.add_argument(
+        "-a",
+        "--archive",
+        help="clusters archive (without extension), the input is then the cluster representative",
+    )
+    parser.add_argument(
+        "-e",
+        "--executor",
+        help="where the liftover, pfbuild and DESC scripts are run (default=local)",
+        choices=EXECUTORS,
+        default="local",
+    )
+    parser.add_argument(
+        "-c", "--cache", help="directory of the cache of the alignment, liftover and pfbuild files"
+    )
+    parser.add_argument(
+        "--cache_size", help="maximum size of the cache in GB (default=100)", type=float, default=100
+    )
+    parser.add_argument(
+        "--pfamseq_version",
+        help="version of pfamseq in the cache keys (default: path, size and date of pfamseq in $PFAM_CONFIG)",
+    )
 
     args = parser.parse_args()
 
-    scriptdir = os.path.dirname(os.path.realpath(__file__))
     familydir = os.path.join(args.datadir, args.family)
     outfile = os.path.join(familydir, f"{args.family}_SEED.phmmer")
 
@@ -147,59 +245,89 @@ if __name__ == "__main__":
         pass
 
     os.makedirs(familydir, exist_ok=True)
-    os.chdir(familydir)
 
-    build_alignment(args.inputfile, args.family)
+    cluster_file = args.inputfile
+    if args.archive:
+        cluster_file = os.path.join(familydir, f"{args.inputfile}.fa")
+        with cluster_archive(args.archive) as archive:
+            archive.extract(args.inputfile, cluster_file)
+
+    if args.executor == "lsf":
+        executor = EXECUTORS["lsf"](logdir=os.path.join(familydir, "jobs"))
+    else:
+        executor = EXECUTORS[args.executor]()
+
+    # wait for lift_over to complete, woken up by the files written in the family directory
+    # and by the jobs ending
+    watcher = directory_watcher()
+    watcher.add(familydir)
+    executor.add_listener(watcher.wake)
+
+    cache = None
+    if args.cache:
+        pfamseq = args.pfamseq_version or pfamseq_version()
+        if not pfamseq:
+            parser.error("pfamseq not found in $PFAM_CONFIG, give its version with --pfamseq_version")
+        cache = artefact_cache(args.cache, int(args.cache_size * 1024 ** 3), pfamseq)
+
+    if not build_alignment(cluster_file, args.family, familydir, executor, cache):
+        sys.exit()
 
-    # wait for lift_over to complete
+    log = job_log(os.path.join(familydir, "liftover.log"), LIFTOVER_ERRORS)
     count_failed = 0
     success_liftover = False
     while True:
-        done = check_lift_over(args.family, outfile, count_failed)
+        done = check_lift_over(
+            args.family, outfile, count_failed, familydir, log, executor, cache
+        )
+        job = executor.get("liftover", args.family)
+        if job and job.state == FAILED:
+            print(f"Error while submitting the liftover of {args.family}")
+            break
         if done == True:  # liftover completed successfully
             success_liftover = True
             break
-        elif done == "failed":  # tried but failed running liftover, trying again
-            count_failed += 1
-        elif done == None:  # tried but failed running liftover with Memory limit
+        elif done == "failed":  # tried but failed running liftover twice, or memory limit
+            break
+        elif done == None:  # tried but failed running liftover, trying again
             count_failed += 1
         else:
-            continue
-
-        if count_failed > 1:
-            break
-        time.sleep(0.2)
+            watcher.wait()
 
     # if lift_over successfully completed, carry on with pfbuild
     # success_liftover = True
     if success_liftover:
-        pf = subprocess.Popen(
-            ["pfbuild", "-withpfmake", "SEED"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        err = pf.communicate()[1].decode("utf-8")
-        if pf.returncode != 0:
-            print(f"Error while running pfbuild: {err}")
-            sys.exit()
+        submit_pfbuild(args.family, familydir, executor, cache)
 
         count_failed = 0
+        log = job_log(os.path.join(familydir, "pfbuild.log"), PFBUILD_ERRORS)
         # wait for pfbuild to complete
         while True:
-            done = check_pfambuild()
+            job = executor.get("pfbuild", args.family)
+            if job and job.state == FAILED:
+                print(f"Error while running pfbuild for {args.family}")
+                break
+            done = check_pfambuild(familydir, log)
             if done == True:  # pfbuild completed, complete DESC file
-                complete_desc()
+                executor.finish("pfbuild", args.family)
+                store_pfbuild(args.family, familydir, cache)
+                complete_desc(familydir, executor)
                 break
             elif done == None:  # pfbuild failed to complete
                 if count_failed < 1:
-                    os.remove("pfbuild.log")
-                    os.system("pfbuild -withpfmake SEED")
+                    os.remove(os.path.join(familydir, "pfbuild.log"))
+                    log.reset()
+                    submit_pfbuild(args.family, familydir, executor, cache)
+                else:
+                    executor.finish("pfbuild", args.family, success=False)
                 count_failed += 1
             else:
+                watcher.wait()
                 continue
 
             if count_failed > 1:
                 break
+    executor.close()
+    watcher.close()
 
-            time.sleep(0.2)
-
-    os.chdir(scriptdir)
     os.system(f"chmod -R g+w {familydir}")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Packed storage of the selected clusters, replacing one fasta file per cluster
+        The clusters are appended to a single data file (<archive>.dat), and their offset and size
+        are appended to an index file (<archive>.index, rep\toffset\tsize)
+        Both files are written to temporary files, which replace the previous archive once it is closed
+        If a cluster is saved more than once, the last copy is used
+
+@arguments [-a archive]: archive path without extension (e.g. data/clusters)
+           [-r rep]: representative accession of the cluster to extract
+           [-o outputfile]: fasta file to write the cluster to (default stdout)
+"""
+
+import argparse
+import os
+import sys
+
+
+def archive_exists(archive):
+    return os.path.isfile(f"{archive}.index")
+
+
+class cluster_archive_writer:
+    def __init__(self, archive):
+        self.archive = archive
+        self.datafile = open(f"{archive}.dat.tmp", "wb")
+        self.indexfile = open(f"{archive}.index.tmp", "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add(self, rep, content):
+        offset = self.datafile.tell()
+        self.datafile.write(content)
+        # the data is flushed first so the index never points to missing data
+        self.datafile.flush()
+        self.indexfile.write(f"{rep}\t{offset}\t{len(content)}\n")
+
+    def close(self):
+        """
+        Replace the previous archive
+        """
+        self.datafile.close()
+        self.indexfile.close()
+        os.replace(f"{self.archive}.dat.tmp", f"{self.archive}.dat")
+        os.replace(f"{self.archive}.index.tmp", f"{self.archive}.index")
+
+    def discard(self):
+        """
+        Remove the clusters written, the previous archive is kept
+        """
+        self.datafile.close()
+        self.indexfile.close()
+        os.remove(f"{self.archive}.dat.tmp")
+        os.remove(f"{self.archive}.index.tmp")
+
+
+class cluster_archive:
+    def __init__(self, archive):
+        self.archive = archive
+        self.index = {}
+        with open(f"{archive}.index", "r") as f:
+            for line in f:
+                rep, offset, size = line.rstrip("\n").split("\t")
+                self.index[rep] = (int(offset), int(size))
+        self.datafile = open(f"{archive}.dat", "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, rep):
+        return rep in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def get(self, rep):
+        """
+        Content of the cluster (fasta), None if not in the archive
+        """
+        if rep not in self.index:
+            return None
+        offset, size = self.index[rep]
+        return os.pread(self.datafile.fileno(), size, offset)
+
+    def extract(self, rep, filename):
+        """
+        Write the cluster to filename, return False if not in the archive
+        """
+        content = self.get(rep)
+        if content is None:
+            return False
+        with open(filename, "wb") as f:
+            f.write(content)
+        return True
+
+    def close(self):
+        self.datafile.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--archive", help="archive path without extension", required=True)
+    parser.add_argument("-r", "--rep", help="representative accession of the cluster", required=True)
+    parser.add_argument("-o", "--outputfile", help="fasta file to write the cluster to")
+    args = parser.parse_args()
+
+    with cluster_archive(args.archive) as archive:
+        if args.rep not in archive:
+            print(f"Cluster {args.rep} not found in {args.archive}")
+            sys.exit(1)
+        if args.outputfile:
+            archive.extract(args.rep, args.outputfile)
+        else:
+            sys.stdout.buffer.write(archive.get(args.rep))
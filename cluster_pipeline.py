@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Run the clustering pipeline (previously cluster.sh) as a sequence of checkpointed steps:
+        fetch, filter, dedup, createdb, linclust, export, stats, select, table
+        With PREVIOUS_SUBDIR set, the clustering of the previous release is updated with mmseqs clusterupdate
+        (clusterupdate step instead of linclust), and the statistics of the clusters unchanged since the
+        previous release are reused by get_stats.py
+        Each completed step records the fingerprints of its inputs and outputs, its parameters and the
+        version of its tools in data/.pipeline/<step>.json (fetch, filter) or <SUBDIR>/.pipeline/<step>.json
+        A step is skipped when its record matches the current inputs, parameters and tools and its
+        outputs are unchanged, so a failed run can be started again without recomputing the finished steps
+        Outputs are written in a staging directory (or to temporary files) and moved in place once complete
+        The resources used by each command are recorded in data/.pipeline/ledger/<run>.jsonl
+        (see pipeline_ledger.py to compare the runs)
+
+@arguments [CONFIG_FILE]: config file (see clustering_model.cfg)
+           [-r STEP [STEP ...]]: run these steps again even if their record matches
+           [-n]: only print the steps that would be run
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+from pipeline_ledger import ledger
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+UNIPROT_RELNOTES = "/ebi/ftp/pub/databases/uniprot/relnotes.txt"
+MMSEQS = "/nfs/production/interpro/metagenomics/peptide_db/mmseqs"
+# UniProt version of the paths listed in dry run mode before UniProt is fetched
+UNKNOWN_VERSION = "UNKNOWN"
+# files bigger than this are identified by their size and modification time instead of their content
+HASHED_SIZE = 64 * 1024 * 1024
+# files of an MMseqs2 database, after the database name
+MMSEQS_DB_SUFFIXES = re.compile(
+    r"^(\.\d+|\.index|\.dbtype|\.lookup|\.source|_h(\.\d+|\.index|\.dbtype)?)?$"
+)
+
+
+def read_config(config_file):
+    """
+    Variables of a shell config file (NAME="value" lines)
+    """
+    config = {}
+    with open(config_file, "r") as f:
+        for line in f:
+            match = re.match(r'^\s*([A-Za-z_][A-Za-z0-9_]*)=(?:"([^"]*)"|(\S*))', line)
+            if match:
+                name, quoted, value = match.groups()
+                config[name] = quoted if quoted is not None else value
+    return config
+
+
+def db_files(db):
+    """
+    Files of the MMseqs2 database db (data, index, dbtype, lookup and header files)
+    """
+    dirname, name = os.path.split(db)
+    if not os.path.isdir(dirname or "."):
+        return []
+    return sorted(
+        os.path.join(dirname, f)
+        for f in os.listdir(dirname or ".")
+        if f.startswith(name) and MMSEQS_DB_SUFFIXES.match(f[len(name) :])
+    )
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    if stat.st_size > HASHED_SIZE:
+        return f"size:{stat.st_size}:mtime:{stat.st_mtime_ns}"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def fingerprint(path):
+    """
+    Fingerprint of a file or of an MMseqs2 database, None if missing
+    """
+    if os.path.isfile(path):
+        return file_fingerprint(path)
+    if not os.path.isfile(f"{path}.index"):
+        return None
+    return {os.path.basename(f): file_fingerprint(f) for f in db_files(path)}
+
+
+def run_command(command, secret=None, ledger=None):
+    """
+    Run a command, secret (e.g. password) is hidden when the command is printed
+    ledger: pipeline_ledger.ledger recording the resources used by the command
+    """
+    text = " ".join(command)
+    print(text.replace(secret, "****") if secret else text, flush=True)
+    if ledger:
+        ledger.run_command(command)
+    else:
+        subprocess.run(command, check=True)
+
+
+def move_outputs(stagingdir, targetdir):
+    """
+    Move the files written in the staging directory to the target directory
+    """
+    for name in sorted(os.listdir(stagingdir)):
+        path = os.path.join(stagingdir, name)
+        if os.path.isfile(path):
+            os.replace(path, os.path.join(targetdir, name))
+    shutil.rmtree(stagingdir)
+
+
+class pipeline_step:
+    """
+    name: step name
+    inputs, outputs: files or MMseqs2 databases read and written by the step
+    params: parameters of the step (JSON serialisable)
+    tools: scripts or executables used by the step
+    run: function running the step
+    always: run the step even if its record matches (the step checks its own inputs)
+    """
+
+    def __init__(self, name, inputs, outputs, params, tools, run, always=False):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.tools = tools
+        self.run = run
+        self.always = always
+
+
+class pipeline:
+    def __init__(self, statedir, ledger=None):
+        self.statedir = statedir
+        self.tool_versions = {}
+        self.ledger = ledger
+
+    def tool_version(self, tool):
+        """
+        Fingerprint of a script, or version reported by an MMseqs2 executable
+        """
+        if tool not in self.tool_versions:
+            if tool.endswith((".py", ".sh")):
+                self.tool_versions[tool] = file_fingerprint(tool)
+            else:
+                result = subprocess.run([tool, "version"], capture_output=True, text=True)
+                self.tool_versions[tool] = result.stdout.strip()
+        return self.tool_versions[tool]
+
+    def get_record_file(self, step):
+        return os.path.join(self.statedir, f"{step.name}.json")
+
+    def describe(self, step):
+        """
+        Current inputs, parameters and tools of a step
+        """
+        return {
+            "inputs": {path: fingerprint(path) for path in step.inputs},
+            "params": step.params,
+            "tools": {tool: self.tool_version(tool) for tool in step.tools},
+        }
+
+    def is_done(self, step):
+        recordfile = self.get_record_file(step)
+        if step.always or not os.path.isfile(recordfile):
+            return False
+        with open(recordfile, "r") as f:
+            record = json.load(f)
+        current = self.describe(step)
+        if any(record.get(key) != current[key] for key in current):
+            return False
+        outputs = {path: fingerprint(path) for path in step.outputs}
+        return record.get("outputs") == outputs and None not in outputs.values()
+
+    def save_record(self, step, description, started):
+        description["outputs"] = {path: fingerprint(path) for path in step.outputs}
+        description["started"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))
+        description["duration"] = round(time.time() - started, 1)
+        recordfile = self.get_record_file(step)
+        # created with the first record, nothing is written in dry run mode
+        os.makedirs(self.statedir, exist_ok=True)
+        with open(f"{recordfile}.tmp", "w") as f:
+            json.dump(description, f, indent=1)
+        os.replace(f"{recordfile}.tmp", recordfile)
+
+    def run(self, step, force=False, dry_run=False):
+        """
+        Run the step unless its record matches, return True if the step was run
+        """
+        if not force and self.is_done(step):
+            print(f"Step {step.name}: up to date")
+            return False
+        print(f"Step {step.name}: running", flush=True)
+        if dry_run:
+            return True
+        missing = [path for path in step.inputs if fingerprint(path) is None]
+        if missing:
+            raise FileNotFoundError(f"Step {step.name}: missing inputs {' '.join(missing)}")
+        # the record is removed first, so an interrupted step is never considered done
+        if os.path.isfile(self.get_record_file(step)):
+            os.remove(self.get_record_file(step))
+        started = time.time()
+        description = self.describe(step)
+        if self.ledger:
+            self.ledger.step = step.name
+        step.run()
+        self.save_record(step, description, started)
+        return True
+
+
+class clustering:
+    """
+    Steps of the clustering pipeline, with the same files as cluster.sh
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.mmseqs = config.get("MMSEQS") or MMSEQS
+        self.datadir = os.path.join(SCRIPTDIR, "data")
+        self.mgnify_version = config["MGNIFY_VERSION"]
+        self.mgnify_rel = os.path.join(config.get("MGNIFYDIR", ""), self.mgnify_version)
+        # sequences stores (see sequence_store.py)
+        self.mgnify_store = os.path.join(self.datadir, f"{self.mgnify_version}_clear.bgz")
+        self.pfam_dir = config.get("PFAM_DIR") or os.getcwd()
+        self.stats_shards = int(config.get("STATS_SHARDS") or 0)
+        self.password = config.get("PASSWORD", "")
+        # only list the steps, without writing anything
+        self.dry_run = False
+        # resources used by the commands of the run
+        self.ledger = ledger(os.path.join(self.datadir, ".pipeline", "ledger"), self.mgnify_version)
+        # clustering directory of the previous release, for the incremental update
+        self.previous_subdir = config.get("PREVIOUS_SUBDIR")
+        if self.previous_subdir:
+            self.previous_subdir = os.path.join(self.pfam_dir, self.previous_subdir)
+
+    @property
+    def uniprot_version(self):
+        # known once UniProt has been fetched, a placeholder is used in dry run mode until then
+        relnotes = os.path.join(self.datadir, "relnotes.txt")
+        if self.dry_run and not os.path.isfile(relnotes):
+            return UNKNOWN_VERSION
+        with open(relnotes, "r") as f:
+            return f.readline().split(" ")[2].strip()
+
+    def set_paths(self):
+        uniprot_version = self.uniprot_version
+        self.uniprot_store = os.path.join(self.datadir, f"uniprotkb_{uniprot_version}.bgz")
+        self.swissprot_acc = os.path.join(self.datadir, f"swissprot_acc_{uniprot_version}.txt")
+        self.prot_not_in_pfam = os.path.join(
+            self.datadir, f"proteins_not_in_pfam_{uniprot_version}.txt"
+        )
+        self.subdir = os.path.join(
+            self.pfam_dir, f"{self.mgnify_version}_{uniprot_version}_FULL_bidir"
+        )
+        if not self.dry_run:
+            os.makedirs(self.subdir, exist_ok=True)
+        self.ledger.release = os.path.basename(self.subdir)
+        self.db = os.path.join(self.subdir, "mgy_seqs")
+        # the unique sequences are read from the stores, without the duplicates saved in dups
+        self.dups = os.path.join(self.subdir, "mgy_seqs.dups")
+        self.cluster_file = f"{self.db}.cluster.tsv"
+        self.list_accessions = f"{self.cluster_file}_percent_mgnify_2+_no_pfam"
+        if self.previous_subdir:
+            # sequences of the release, merged with the previous sequences by clusterupdate
+            self.release_db = f"{self.db}_release.mmseqs"
+            self.previous_db = os.path.join(self.previous_subdir, "mgy_seqs")
+        else:
+            self.release_db = f"{self.db}.mmseqs"
+
+    def run_command(self, command, secret=None):
+        run_command(command, secret, self.ledger)
+
+    def staging(self, step):
+        stagingdir = os.path.join(self.subdir, f"staging_{step}")
+        shutil.rmtree(stagingdir, ignore_errors=True)
+        os.makedirs(stagingdir)
+        return stagingdir
+
+    def script(self, name):
+        return os.path.join(SCRIPTDIR, name)
+
+    def fetch_step(self):
+        def run():
+            self.run_command([self.script("update_uniprotkb.sh"), self.datadir])
+
+        # relnotes.txt is copied once the UniProt files are written
+        return pipeline_step(
+            "fetch",
+            [UNIPROT_RELNOTES],
+            [os.path.join(self.datadir, "relnotes.txt")],
+            {"datadir": self.datadir},
+            [self.script("update_uniprotkb.sh")],
+            run,
+        )
+
+    def filter_step(self):
+        inputs = sorted(
+            os.path.join(self.mgnify_rel, f)
+            for f in os.listdir(self.mgnify_rel)
+            if f.startswith("mgy_proteins_")
+        )
+
+        def run():
+            # truncated sequences removed while compressing
+            self.run_command(
+                ["python3", self.script("sequence_store.py"), "-f", *inputs]
+                + ["-o", self.mgnify_store, "-w", "16", "-m"]
+            )
+
+        return pipeline_step(
+            "filter",
+            inputs,
+            [self.mgnify_store, f"{self.mgnify_store}.npy"],
+            {"workers": 16},
+            [self.script("sequence_store.py"), self.script("filter_partial.py")],
+            run,
+        )
+
+    def dedup_step(self):
+        inputs = [self.uniprot_store, self.mgnify_store]
+
+        def run():
+            self.run_command(
+                ["python3", self.script("dedup_sequences.py"), "-f", *inputs, "-d", self.dups]
+            )
+
+        return pipeline_step(
+            "dedup",
+            inputs,
+            [self.dups, f"{self.dups}.npy", f"{self.dups}.records.npy"],
+            {},
+            [self.script("dedup_sequences.py"), self.script("filter_partial.py")],
+            run,
+        )
+
+    def createdb_step(self):
+        inputs = [self.uniprot_store, self.mgnify_store]
+
+        def run():
+            stagingdir = self.staging("createdb")
+            # the unique sequences are read from the stores and piped to createdb
+            unique = ["python3", self.script("dedup_sequences.py"), "-u", "-f", *inputs]
+            unique += ["-d", self.dups]
+            createdb = [self.mmseqs, "createdb", "stdin"]
+            createdb += [os.path.join(stagingdir, os.path.basename(self.release_db))]
+            pipe = f"{shlex.join(unique)} | {shlex.join(createdb)}"
+            self.run_command(["bash", "-o", "pipefail", "-c", pipe])
+            move_outputs(stagingdir, self.subdir)
+
+        return pipeline_step(
+            "createdb",
+            inputs + [f"{self.dups}.records.npy"],
+            [self.release_db],
+            {},
+            [self.mmseqs, self.script("dedup_sequences.py")],
+            run,
+        )
+
+    CLUSTER_PARAMS = {"min-seq-id": "0.5", "c": "0.75", "cov-mode": "0", "threads": "16"}
+
+    def cluster_options(self):
+        params = self.CLUSTER_PARAMS
+        return [
+            *("--min-seq-id", params["min-seq-id"], "-c", params["c"]),
+            *("--cov-mode", params["cov-mode"], "--threads", params["threads"]),
+        ]
+
+    def linclust_step(self):
+        params = dict(self.CLUSTER_PARAMS)
+
+        def run():
+            stagingdir = self.staging("linclust")
+            tmpdir = os.path.join(self.subdir, "tmp")
+            self.run_command(
+                [self.mmseqs, "linclust", f"{self.db}.mmseqs"]
+                + [os.path.join(stagingdir, os.path.basename(f"{self.db}.cluster")), tmpdir]
+                + self.cluster_options()
+            )
+            move_outputs(stagingdir, self.subdir)
+
+        return pipeline_step(
+            "linclust",
+            [f"{self.db}.mmseqs"],
+            [f"{self.db}.cluster"],
+            params,
+            [self.mmseqs],
+            run,
+        )
+
+    def clusterupdate_step(self):
+        """
+        Update the clustering of the previous release with the sequences of the release:
+        removed sequences are deleted from their cluster, new sequences are added to the existing
+        clusters or clustered together, the updated sequence database replaces mgy_seqs.mmseqs
+        """
+        params = dict(self.CLUSTER_PARAMS, previous=self.previous_subdir)
+
+        def run():
+            stagingdir = self.staging("clusterupdate")
+            staged = os.path.join(stagingdir, os.path.basename(self.db))
+            tmpdir = os.path.join(self.subdir, "tmp")
+            self.run_command(
+                [self.mmseqs, "clusterupdate", f"{self.previous_db}.mmseqs", self.release_db]
+                + [f"{self.previous_db}.cluster", f"{staged}.mmseqs", f"{staged}.cluster", tmpdir]
+                + self.cluster_options()
+            )
+            move_outputs(stagingdir, self.subdir)
+
+        return pipeline_step(
+            "clusterupdate",
+            [f"{self.previous_db}.mmseqs", f"{self.previous_db}.cluster", self.release_db],
+            [f"{self.db}.mmseqs", f"{self.db}.cluster"],
+            params,
+            [self.mmseqs],
+            run,
+        )
+
+    def cluster_step(self):
+        if self.previous_subdir:
+            return self.clusterupdate_step()
+        return self.linclust_step()
+
+    def previous_args(self):
+        """
+        Summary of the previous release given to get_stats.py, if saved
+        """
+        if not self.previous_subdir:
+            return []
+        summaryfile = os.path.join(self.previous_subdir, "mgy_seqs.cluster.tsv_summary")
+        if not os.path.isfile(f"{summaryfile}.state.npy"):
+            print(f"No statistics saved for the previous release in {self.previous_subdir}")
+            return []
+        return ["-v", summaryfile]
+
+    def export_step(self):
+        def run():
+            stagingdir = self.staging("export")
+            staged = os.path.join(stagingdir, os.path.basename(self.db))
+            seqdb, clusterdb = f"{self.db}.mmseqs", f"{self.db}.cluster"
+            self.run_command(
+                [self.mmseqs, "result2repseq", seqdb, clusterdb, f"{staged}.cluster_rep"]
+            )
+            self.run_command(
+                [self.mmseqs, "result2flat", seqdb, seqdb]
+                + [f"{staged}.cluster_rep", f"{staged}.cluster_rep.fa"]
+            )
+            self.run_command(
+                [self.mmseqs, "createtsv", seqdb, seqdb, clusterdb, f"{staged}.cluster.tsv"]
+            )
+            move_outputs(stagingdir, self.subdir)
+
+        return pipeline_step(
+            "export",
+            [f"{self.db}.mmseqs", f"{self.db}.cluster"],
+            [f"{self.db}.cluster_rep", f"{self.db}.cluster_rep.fa", self.cluster_file],
+            {},
+            [self.mmseqs],
+            run,
+        )
+
+    def stats_args(self):
+        return [
+            "python3",
+            self.script("get_stats.py"),
+            "-i",
+            self.cluster_file,
+            "-x",
+            f"{self.db}.mmseqs",
+            "-b",
+            self.uniprot_store,
+            self.mgnify_store,
+            "-y",
+            self.swissprot_acc,
+            "-g",
+            self.dups,
+            "-f",
+            self.prot_not_in_pfam,
+            "-u",
+            self.config.get("USERNAME", ""),
+            "-p",
+            self.password,
+            "-s",
+            self.config.get("SCHEMA", ""),
+            "-j",
+            "4",
+            "-k",
+            "10000",
+        ]
+
+    def stats_step(self):
+        def run():
+            self.run_command(self.stats_args() + ["-o"], self.password)
+
+        # the list of proteins not in Pfam is checked against the database versions by get_stats.py
+        return pipeline_step(
+            "stats",
+            [self.cluster_file, self.swissprot_acc],
+            [self.prot_not_in_pfam],
+            {"uniprot": self.uniprot_version},
+            [self.script("get_stats.py"), self.script("proteins_not_in_pfam.py")],
+            run,
+            always=True,
+        )
+
+    def select_step(self):
+        archive = os.path.join(self.subdir, "clusters")
+
+        previous = self.previous_args()
+
+        def run():
+            # outputs of a previous run
+            shutil.rmtree(archive, ignore_errors=True)
+            for path in (f"{archive}.index", f"{archive}.dat", self.list_accessions):
+                if os.path.isfile(path):
+                    os.remove(path)
+            if self.stats_shards > 1:
+                # one LSF job per shard of the cluster table, then merge of the partial statistics
+                shard = f"${{LSB_JOBINDEX}}/{self.stats_shards}"
+                job = " ".join(self.stats_args() + ["-w", "16", "-t", "-d", shard] + previous)
+                self.run_command(
+                    ["bsub", "-K", "-J", f"get_stats[1-{self.stats_shards}]", "-n", "16"]
+                    + ["-oo", os.path.join(self.subdir, "get_stats.%I.log"), job],
+                    self.password,
+                )
+                self.run_command(
+                    self.stats_args() + ["-a", "-m", str(self.stats_shards)], self.password
+                )
+            else:
+                self.run_command(
+                    self.stats_args() + ["-w", "16", "-t", "-a"] + previous, self.password
+                )
+
+        return pipeline_step(
+            "select",
+            [
+                self.cluster_file,
+                f"{self.db}.mmseqs",
+                self.uniprot_store,
+                self.mgnify_store,
+                self.prot_not_in_pfam,
+                self.swissprot_acc,
+                self.dups,
+            ],
+            [
+                self.list_accessions,
+                f"{archive}.index",
+                f"{archive}.dat",
+                f"{self.cluster_file}_summary.state.npy",
+            ],
+            {"top": 10000, "shards": self.stats_shards, "previous": previous},
+            [
+                self.script(name)
+                for name in (
+                    "get_stats.py",
+                    "cluster_tsv.py",
+                    "sequence_store.py",
+                    "cluster_state.py",
+                )
+            ],
+            run,
+        )
+
+    def table_step(self):
+        tabledir = f"{self.cluster_file}_table"
+
+        def run():
+            # computed again, get_stats.py only compares its age with the accession lists
+            shutil.rmtree(tabledir, ignore_errors=True)
+            self.run_command(self.stats_args() + ["-w", "16", "-c", "-e"], self.password)
+
+        # statistics of every cluster (see cluster_table.py), in a separate pass as the selection reuses
+        # the statistics of the previous release
+        return pipeline_step(
+            "table",
+            [
+                self.cluster_file,
+                f"{self.db}.mmseqs",
+                self.uniprot_store,
+                self.mgnify_store,
+                self.prot_not_in_pfam,
+                self.swissprot_acc,
+                self.dups,
+            ],
+            [os.path.join(tabledir, "meta.json")],
+            {},
+            [
+                self.script(name)
+                for name in (
+                    "get_stats.py",
+                    "cluster_tsv.py",
+                    "sequence_store.py",
+                    "mmseqs_db.py",
+                    "cluster_table.py",
+                )
+            ],
+            run,
+        )
+
+
+STEPS = [
+    "fetch",
+    "filter",
+    "dedup",
+    "createdb",
+    "linclust",
+    "clusterupdate",
+    "export",
+    "stats",
+    "select",
+    "table",
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="config file (see clustering_model.cfg)")
+    parser.add_argument(
+        "-r", "--rerun", help="steps to run again", nargs="+", choices=STEPS, default=[]
+    )
+    parser.add_argument(
+        "-n", "--dry_run", help="only print the steps that would be run", action="store_true"
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config_file):
+        print(f"Config file {args.config_file} not found")
+        sys.exit(1)
+    config = read_config(args.config_file)
+    cl = clustering(config)
+    cl.dry_run = args.dry_run
+    if not os.path.isdir(cl.mgnify_rel):
+        print(f"{cl.mgnify_rel} not found")
+        sys.exit(1)
+    os.makedirs(cl.datadir, exist_ok=True)
+
+    statedir = os.path.join(cl.datadir, ".pipeline")
+    pl = pipeline(statedir, cl.ledger)
+    if config.get("UPDATE_UNIPROT") == "yes":
+        pl.run(cl.fetch_step(), "fetch" in args.rerun, args.dry_run)
+    pl.run(cl.filter_step(), "filter" in args.rerun, args.dry_run)
+
+    # the clustering directory depends on the UniProt version
+    cl.set_paths()
+    pl = pipeline(os.path.join(cl.subdir, ".pipeline"), cl.ledger)
+    for step in [
+        cl.dedup_step(),
+        cl.createdb_step(),
+        cl.cluster_step(),
+        cl.export_step(),
+        cl.stats_step(),
+        cl.select_step(),
+        cl.table_step(),
+    ]:
+        # a step run again changes the inputs of the following steps, which are then run too
+        pl.run(step, step.name in args.rerun, args.dry_run)
+
+    if not args.dry_run and (
+        not os.path.isfile(cl.list_accessions) or os.path.getsize(cl.list_accessions) == 0
+    ):
+        print(
+            "Getting statistics failed or no cluster found with more than 2 sequences "
+            "and containing a UniProt sequence not in Pfam"
+        )
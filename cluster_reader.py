@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Byte-level reader for the flattened MMseqs2 cluster file (mgy_seqs.cluster_seq.fa)
+        The file is memory-mapped and only header lines are looked at, each cluster is returned
+        as a lightweight record (offsets into the mapped buffer and member headers)
+        The sequences are only copied out of the buffer when the body of a cluster is requested
+
+"""
+
+import mmap
+import os
+
+# characters allowed in a cluster separator line (>[A-Z0-9]+)
+SEPARATOR_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def is_cluster_separator(line):
+    """
+    Return True if the header line (bytes, with or without end of line) starts a new cluster
+    """
+    name = line[1:-1] if line.endswith(b"\n") else line[1:]
+    return line.startswith(b">") and len(name) > 0 and not name.translate(None, SEPARATOR_CHARS)
+
+
+class cluster_record:
+    """
+    A cluster of the flattened file
+    separator: cluster separator line (None for sequences found before the first separator)
+    start, end: byte span of the cluster in the file (separator line included)
+    body_start: offset of the first line following the separator
+    headers: list of (offset, header line) for each member of the cluster
+    """
+
+    __slots__ = ("buffer", "separator", "start", "body_start", "end", "headers")
+
+    def __init__(self, buffer, separator, start, body_start, end, headers):
+        self.buffer = buffer
+        self.separator = separator
+        self.start = start
+        self.body_start = body_start
+        self.end = end
+        self.headers = headers
+
+    def __len__(self):
+        return len(self.headers)
+
+    def body(self):
+        """
+        Copy of the cluster content (member headers and sequences)
+        """
+        return self.buffer[self.body_start : self.end]
+
+    def members(self):
+        """
+        Yield (header line, sequence lines) for each member of the cluster
+        """
+        buf = self.buffer
+        for i, (offset, header) in enumerate(self.headers):
+            next_offset = self.headers[i + 1][0] if i + 1 < len(self.headers) else self.end
+            yield header, buf[offset + len(header) : next_offset]
+
+
+class cluster_reader:
+    def __init__(self, inputfile):
+        self.inputfile = inputfile
+        self.file = None
+        self.buffer = b""
+
+    def open(self):
+        self.file = open(self.inputfile, "rb")
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = b""
+        self.file.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def align(self, offset):
+        """
+        Offset of the first cluster separator line starting at or after offset
+        """
+        buf = self.buffer
+        if offset <= 0:
+            return 0
+        if offset >= len(buf):
+            return len(buf)
+
+        pos = buf.find(b"\n>", offset - 1)
+        while pos != -1:
+            pos += 1
+            eol = buf.find(b"\n", pos)
+            eol = len(buf) if eol == -1 else eol + 1
+            if is_cluster_separator(buf[pos:eol]):
+                return pos
+            pos = buf.find(b"\n>", eol - 1)
+        return len(buf)
+
+    def shard(self, i, n):
+        """
+        (start, stop) byte range of the shard i (from 1 to n) when the file is split in n shards
+        The shard starts at the first cluster found after the (i-1)/n offset
+        """
+        size = len(self.buffer)
+        return self.align((i - 1) * size // n), self.align(i * size // n)
+
+    def batches(self, size=32 * 1024 * 1024, start=0, stop=None):
+        """
+        Split the file (or the range from start to stop, aligned on clusters)
+        into (start, stop) byte ranges of about size bytes, aligned on clusters
+        """
+        stop = len(self.buffer) if stop is None else stop
+        while start < stop:
+            end = min(self.align(start + size), stop)
+            yield start, end
+            start = end
+
+    def records(self, start=0, stop=None):
+        """
+        Yield the clusters found between the byte offsets start and stop
+        start must be the beginning of a line
+        """
+        buf = self.buffer
+        find = buf.find
+        stop = len(buf) if stop is None else stop
+
+        separator = None
+        cluster_start = body_start = start
+        headers = []
+        pos = start
+
+        while pos < stop:
+            if buf[pos] == 62:  # ">"
+                eol = find(b"\n", pos, stop)
+                eol = stop if eol == -1 else eol + 1
+                line = buf[pos:eol]
+                if is_cluster_separator(line):
+                    if headers:
+                        yield cluster_record(
+                            buf, separator, cluster_start, body_start, pos, headers
+                        )
+                    separator = line
+                    cluster_start = pos
+                    body_start = eol
+                    headers = []
+                else:
+                    headers.append((pos, line))
+                pos = eol
+            else:
+                # sequence lines, jump to the next header
+                nxt = find(b"\n>", pos, stop)
+                pos = stop if nxt == -1 else nxt + 1
+
+        if headers:
+            yield cluster_record(buf, separator, cluster_start, body_start, stop, headers)
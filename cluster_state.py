@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Statistics of every cluster of a release, kept to update the statistics of the next release
+        <summaryfile>.state.npy: membership digest and statistics of each cluster, sorted by digest
+        <summaryfile>.state.json: accession lists used to compute the statistics
+        (proteins not in Pfam and SwissProt indexes, duplicates mapping) and their digests; the lists are
+        copied next to the state (<summaryfile>.state.<list>), as they may be rewritten in place by the next
+        release (e.g. the list of proteins not in Pfam when only MGnify changed)
+        A cluster of the new release keeps its previous statistics if the same members were in a cluster
+        of the previous release, and none of them changed in the accession lists
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from accession_index import MAGIC
+from dedup_sequences import decode_member, encode_member, header_accession
+
+STATE_TYPE = np.dtype(
+    [
+        ("digest", "u8"),
+        ("members", "u4"),
+        ("mgnify", "u4"),
+        ("swissprot", "u4"),
+        ("trembl", "u4"),
+        ("inpfam", "u1"),
+    ]
+)
+
+
+def get_state_file(summaryfile):
+    return f"{summaryfile}.state.npy"
+
+
+# accession lists of the statistics, with the extension of their snapshot
+LISTS = {"proteinfile": "idx", "swissprotfile": "idx", "duplicates": "dups"}
+# changed accessions looked up in a set up to this number, by key above
+CHANGED_SET_SIZE = 5000000
+
+
+def get_lists_file(statefile):
+    return f"{os.path.splitext(statefile)[0]}.json"
+
+
+def get_snapshot_file(statefile, name):
+    return f"{os.path.splitext(statefile)[0]}.{name}.{LISTS[name]}"
+
+
+def file_digest(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_lists(lists, statefile):
+    """
+    Copy the accession lists next to the state, return the lists saved with the state
+    (snapshots and digests of the lists)
+    """
+    saved = {}
+    for name in LISTS:
+        path = lists.get(name)
+        saved[name] = None
+        if path is None:
+            continue
+        snapshot = get_snapshot_file(statefile, name)
+        if os.path.abspath(path) != os.path.abspath(snapshot):
+            shutil.copyfile(path, f"{snapshot}.tmp")
+            os.replace(f"{snapshot}.tmp", snapshot)
+        saved[name] = os.path.abspath(snapshot)
+        saved[f"{name}_digest"] = file_digest(snapshot)
+    return saved
+
+
+def membership_digest(accessions):
+    """
+    64 bits digest of the accessions (bytes) of the members of a cluster, in cluster order
+    """
+    digest = hashlib.blake2b(b"\n".join(accessions), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def index_values(indexfile):
+    """
+    Sorted values of an accession index file (see accession_index.py)
+    """
+    if os.path.getsize(indexfile) == len(MAGIC):
+        return np.zeros(0, dtype="u8")
+    return np.memmap(indexfile, dtype="u8", mode="r", offset=len(MAGIC))
+
+
+def duplicate_entries(dupsfile):
+    """
+    (representative key, duplicate key, entry digest) of each line of a duplicates mapping
+    """
+    reps, duplicates, digests = [], [], []
+    with open(dupsfile, "rb") as f:
+        for line in f:
+            rep, header = line.rstrip(b"\n").split(b"\t", 1)
+            reps.append(encode_member(rep))
+            try:
+                duplicates.append(encode_member(header_accession(header)))
+            except ValueError:
+                duplicates.append(0)
+            digests.append(membership_digest([rep, header]))
+    return (
+        np.array(reps, dtype="u8"),
+        np.array(duplicates, dtype="u8"),
+        np.array(digests, dtype="u8"),
+    )
+
+
+def changed_keys(previous, current):
+    """
+    Sorted keys (see dedup_sequences.encode_member) of the accessions whose Pfam or SwissProt status
+    or duplicates changed between the previous and current accession lists,
+    None if the lists can't be compared
+    """
+    def unchanged(name):
+        # states saved before the snapshots only have the path of the lists
+        digest = previous.get(f"{name}_digest")
+        return digest is not None and digest == file_digest(current[name])
+
+    changed = []
+    for name in ("proteinfile", "swissprotfile"):
+        if (previous.get(name) is None) != (current.get(name) is None):
+            return None
+        if current.get(name) is None:
+            continue
+        if not os.path.isfile(previous[name]):
+            return None
+        if not unchanged(name):
+            changed.append(np.setxor1d(index_values(previous[name]), index_values(current[name])))
+
+    if (previous.get("duplicates") is None) != (current.get("duplicates") is None):
+        return None
+    status = np.concatenate(changed) if changed else np.zeros(0, dtype="u8")
+    if current.get("duplicates") and not (len(status) == 0 and unchanged("duplicates")):
+        if not os.path.isfile(previous["duplicates"]):
+            return None
+        old_reps, old_duplicates, old_digests = duplicate_entries(previous["duplicates"])
+        new_reps, new_duplicates, new_digests = duplicate_entries(current["duplicates"])
+        # duplicates added or removed, and duplicates whose status changed
+        entries = np.setxor1d(old_digests, new_digests)
+        changed.append(old_reps[np.isin(old_digests, entries)])
+        changed.append(new_reps[np.isin(new_digests, entries)])
+        changed.append(new_reps[np.isin(new_duplicates, status)])
+
+    if not changed:
+        return np.zeros(0, dtype="u8")
+    return np.unique(np.concatenate(changed).astype("u8"))
+
+
+class cluster_state_writer:
+    def __init__(self, statefile, lists):
+        self.statefile = statefile
+        self.lists = lists
+        self.chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+    def append(self, digests, summaries):
+        chunk = np.empty(len(summaries), dtype=STATE_TYPE)
+        chunk["digest"] = digests
+        for name in STATE_TYPE.names[1:]:
+            chunk[name] = [getattr(summary, name) for summary in summaries]
+        self.chunks.append(chunk)
+
+    def close(self):
+        state = np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=STATE_TYPE)
+        state.sort(order="digest", kind="stable")
+        save_state(state, self.statefile, self.lists)
+
+
+def save_state(state, statefile, lists):
+    # np.save adds .npy to the file name
+    tmpfile = f"{statefile[: -len('.npy')]}.tmp.npy"
+    np.save(tmpfile, state)
+    with open(f"{get_lists_file(statefile)}.tmp", "w") as f:
+        json.dump(snapshot_lists(lists, statefile), f, indent=1)
+    os.replace(tmpfile, statefile)
+    os.replace(f"{get_lists_file(statefile)}.tmp", get_lists_file(statefile))
+
+
+def merge_states(statefiles, statefile):
+    """
+    Save the states of the shards of a release as a single state
+    """
+    state = np.concatenate([np.load(f) for f in statefiles])
+    state.sort(order="digest", kind="stable")
+    with open(get_lists_file(statefiles[0]), "r") as f:
+        lists = json.load(f)
+    save_state(state, statefile, lists)
+
+
+class cluster_state:
+    """
+    Statistics of the previous release, and keys of the accessions which changed since then
+    """
+
+    def __init__(self, statefile, changedfile):
+        self.statefile = statefile
+        self.changedfile = changedfile
+        self.open()
+
+    def open(self):
+        self.state = np.load(self.statefile, mmap_mode="r")
+        self.digests = self.state["digest"]
+        self.changed = np.load(self.changedfile, mmap_mode="r")
+        # accessions of the changed keys, built when first needed
+        self.changed_accessions = None
+
+    def get(self, digest):
+        """
+        Previous statistics (members, mgnify, swissprot, trembl, inpfam) of a cluster, None if not found
+        """
+        i = np.searchsorted(self.digests, digest)
+        if i < len(self.digests) and self.digests[i] == digest:
+            return tuple(int(v) for v in self.state[i])[1:]
+        return None
+
+    def is_changed(self, accessions):
+        """
+        Whether one of the accessions (bytes) changed in the accession lists
+        """
+        if len(self.changed) == 0:
+            return False
+        if len(self.changed) <= CHANGED_SET_SIZE:
+            # the accessions are only compared, without encoding them
+            if self.changed_accessions is None:
+                self.changed_accessions = frozenset(decode_member(int(k)) for k in self.changed)
+            return not self.changed_accessions.isdisjoint(accessions)
+        try:
+            keys = np.array([encode_member(acc) for acc in accessions], dtype="u8")
+        except ValueError:
+            return True
+        positions = np.minimum(np.searchsorted(self.changed, keys), len(self.changed) - 1)
+        return bool(np.any(self.changed[positions] == keys))
+
+    # only the file names are sent to other processes, the files are mapped again on their side
+    def __getstate__(self):
+        return {"statefile": self.statefile, "changedfile": self.changedfile}
+
+    def __setstate__(self, state):
+        self.statefile = state["statefile"]
+        self.changedfile = state["changedfile"]
+        self.open()
+
+
+def load_previous_state(previous_summaryfile, lists, changedfile):
+    """
+    State of the previous release, with the changed accessions saved in changedfile,
+    None if the previous state is missing or can't be compared with the current lists
+    """
+    statefile = get_state_file(previous_summaryfile)
+    if not os.path.isfile(statefile):
+        print(f"No clusters statistics found for the previous release ({statefile})")
+        return None
+    with open(get_lists_file(statefile), "r") as f:
+        previous = json.load(f)
+    changed = changed_keys(previous, lists)
+    if changed is None:
+        print("Accession lists of the previous release not comparable, computing all clusters")
+        return None
+    np.save(changedfile, changed)
+    return cluster_state(statefile, changedfile)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Columnar table of per-cluster statistics, so clusters can be selected again without reading
+        the cluster file
+        The table is a directory with one binary file per column (<column>.bin) and meta.json
+        (number of clusters and column types), the columns are memory-mapped as NumPy arrays
+
+@arguments [-t tabledir]: table directory (<cluster_file>_table)
+           [-k top]: number of clusters to display (default=20)
+           [-r score]: criterion used to rank the clusters: size, mgnify or swissprot (default=size)
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+# rep: representative accession, start/end: span of the cluster in the cluster file
+# inpfam: 1 if at least one UniProt sequence is found in Pfam
+# partial_classes: number of distinct partial flags (PL=xx) of the MGnify sequences
+COLUMNS = [
+    ("rep", "S20"),
+    ("start", "u8"),
+    ("end", "u8"),
+    ("members", "u4"),
+    ("mgnify", "u4"),
+    ("swissprot", "u4"),
+    ("trembl", "u4"),
+    ("inpfam", "u1"),
+    ("rep_length", "u4"),
+    ("min_length", "u4"),
+    ("max_length", "u4"),
+    ("median_length", "f4"),
+    ("partial_classes", "u1"),
+]
+ROW_TYPE = np.dtype(COLUMNS)
+
+
+class cluster_table_writer:
+    """
+    Append rows (tuples following COLUMNS) to a new table
+    The table is written in <tabledir>.tmp and renamed when closed
+    """
+
+    def __init__(self, tabledir):
+        self.tabledir = tabledir
+        self.tmpdir = f"{tabledir}.tmp"
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        os.makedirs(self.tmpdir)
+        self.files = {
+            name: open(os.path.join(self.tmpdir, f"{name}.bin"), "wb") for name, _ in COLUMNS
+        }
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files.values():
+                f.close()
+
+    def append(self, rows):
+        if not rows:
+            return
+        if max(len(row[0]) for row in rows) > ROW_TYPE["rep"].itemsize:
+            raise ValueError(f"Representative accession longer than {ROW_TYPE['rep']}")
+        data = np.array(rows, dtype=ROW_TYPE)
+        for name, _ in COLUMNS:
+            self.files[name].write(np.ascontiguousarray(data[name]).tobytes())
+        self.count += len(rows)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.tmpdir, "meta.json"), "w") as f:
+            json.dump({"count": self.count, "columns": COLUMNS}, f, indent=1)
+        shutil.rmtree(self.tabledir, ignore_errors=True)
+        os.replace(self.tmpdir, self.tabledir)
+
+
+def round_percent(counts, totals):
+    """
+    counts * 100 / totals rounded to 2 decimals as round() in get_stats.py: round() rounds the exact value of
+    the float, np.round rounds it once scaled, so they may differ when the scaled value is close to a half
+    """
+    values = counts.astype(np.float64) * 100 / totals.astype(np.float64)
+    rounded = np.round(values, 2)
+    scaled = values * 100
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        rounded[i] = round(float(values[i]), 2)
+    return rounded
+
+
+class cluster_table:
+    def __init__(self, tabledir):
+        self.tabledir = tabledir
+        with open(os.path.join(tabledir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.columns = {}
+        for name, dtype in meta["columns"]:
+            if self.count == 0:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(
+                    os.path.join(tabledir, f"{name}.bin"),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(self.count,),
+                )
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def percentages(self):
+        """
+        % of MGnify and SwissProt sequences of each cluster (rounded to 2 decimals)
+        """
+        members = np.maximum(self["members"], 1)
+        percentmgy = round_percent(self["mgnify"], members)
+        percentswiss = round_percent(self["swissprot"], members)
+        return percentmgy, percentswiss
+
+    def qualifying(self):
+        """
+        Clusters not found in Pfam, with at least 2 sequences, containing UniProt and MGnify sequences
+        """
+        percentmgy, _ = self.percentages()
+        return (
+            (self["inpfam"] == 0)
+            & (self["members"] > 1)
+            & (percentmgy > 0.0)
+            & (percentmgy < 100.0)
+        )
+
+    def top(self, top, score="size", mask=None):
+        """
+        Indices of the top clusters by decreasing score (ties in file order), among the mask if given
+        """
+        indices = np.nonzero(self.qualifying() if mask is None else mask)[0]
+        members = self["members"][indices].astype(np.int64)
+        percentmgy, percentswiss = self.percentages()
+        keys = {
+            "size": [-members],
+            "mgnify": [-members, -percentmgy[indices]],
+            "swissprot": [-members, -percentswiss[indices]],
+        }[score]
+        # np.lexsort uses the last key as primary key
+        order = np.lexsort([self["start"][indices]] + keys)
+        return indices[order[:top]]
+
+    def row(self, i):
+        return {name: column[i] for name, column in self.columns.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tabledir", help="table directory", required=True)
+    parser.add_argument(
+        "-k", "--top", help="number of clusters to display (default=20)", type=int, default=20
+    )
+    parser.add_argument(
+        "-r",
+        "--score",
+        help="criterion used to rank the clusters (default=size)",
+        choices=["size", "mgnify", "swissprot"],
+        default="size",
+    )
+    args = parser.parse_args()
+
+    table = cluster_table(args.tabledir)
+    print(f"{len(table)} clusters, {int(table.qualifying().sum())} not in Pfam")
+    print("\t".join(name for name, _ in COLUMNS))
+    for i in table.top(args.top, args.score):
+        row = table.row(i)
+        row["rep"] = row["rep"].decode("utf-8")
+        print("\t".join(str(row[name]) for name, _ in COLUMNS))
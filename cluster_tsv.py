@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Byte-level reader for the MMseqs2 cluster table ($DB.cluster.tsv, created by mmseqs createtsv)
+        Each line is rep\tmember, the members of a cluster are on consecutive lines and the
+        representative is its own first member
+        The file is memory-mapped, each cluster is returned as a record with its byte span and the
+        identifiers of its members, in the same order as in the flattened cluster file
+
+"""
+
+from cluster_reader import cluster_reader
+
+
+class tsv_record:
+    """
+    A cluster of the cluster table
+    start, end: byte span of the cluster in the file
+    identifiers: identifiers of the members (bytes), the representative first
+    """
+
+    __slots__ = ("start", "end", "identifiers")
+
+    def __init__(self, start, end, identifiers):
+        self.start = start
+        self.end = end
+        self.identifiers = identifiers
+
+    def __len__(self):
+        return len(self.identifiers)
+
+
+class tsv_reader(cluster_reader):
+    """
+    Same interface as cluster_reader (batches, shards, records), clusters being delimited
+    by a change of representative instead of a separator line
+    """
+
+    def line_end(self, pos):
+        eol = self.buffer.find(b"\n", pos)
+        return len(self.buffer) if eol == -1 else eol + 1
+
+    def rep_at(self, pos):
+        """
+        Representative identifier of the line starting at pos
+        """
+        return self.buffer[pos : self.buffer.find(b"\t", pos)]
+
+    def align(self, offset):
+        """
+        Offset of the first line starting a cluster at or after offset
+        """
+        buf = self.buffer
+        if offset <= 0:
+            return 0
+        if offset >= len(buf):
+            return len(buf)
+
+        # first line starting at or after offset, and representative of the line before it
+        pos = offset if buf[offset - 1] == 10 else self.line_end(offset)
+        previous = self.rep_at(buf.rfind(b"\n", 0, pos - 1) + 1)
+        while pos < len(buf):
+            if self.rep_at(pos) != previous:
+                return pos
+            pos = self.line_end(pos)
+        return len(buf)
+
+    def records(self, start=0, stop=None):
+        """
+        Yield the clusters found between the byte offsets start and stop
+        start must be the beginning of a cluster
+        """
+        buf = self.buffer
+        stop = len(buf) if stop is None else stop
+
+        rep = None
+        cluster_start = pos = start
+        identifiers = []
+        for line in buf[start:stop].splitlines(keepends=True):
+            current, member = line.rstrip(b"\n").split(b"\t")
+            if current != rep:
+                if identifiers:
+                    yield tsv_record(cluster_start, pos, identifiers)
+                rep = current
+                cluster_start = pos
+                identifiers = []
+            identifiers.append(member)
+            pos += len(line)
+
+        if identifiers:
+            yield tsv_record(cluster_start, stop, identifiers)
@@ -6,85 +6,235 @@
 #
 # @brief This script verifies if the pfbuild step has succedeed and runs extra scripts to complete the DESC file
 #       It should be run from the Pfam directory containing the files
+#       (the functions take the family directory, so several families can be processed at the same time)
+#       The DESC steps are run as a dependency graph (DESC_STEPS): the independent steps run at the same time,
+#       the exit status and times of each step are saved in complete_desc.json
 #
 ###################
 
+import json
 import time
 import os
-import re
-
-
-def check_pfambuild():
-    if os.path.isfile("PFAMOUT") == True and os.path.getsize("PFAMOUT") != 0:
+import subprocess
+
+from artefact_cache import family_key, save_key
+from job_events import job_log
+from job_executor import default_executor
+
+PFBUILD_ERRORS = (
+    r"cannot create temp file for here-document: No space left on device",
+    r"Exited with exit code",
+)
+# files saved in the artefact cache once pfbuild is complete (before the DESC file is completed),
+# they depend on the SEED alignment, pfbuild and pfamseq
+PFBUILD_FILES = ("SEED", "HMM", "PFAMOUT", "ALIGN", "scores", "DESC")
+PFBUILD_TOOLS = ("pfbuild",)
+# steps completing the DESC file: (description, command run in the family directory, steps required first)
+# the steps writing the DESC file run one after the other (PDB references, DUF identifier, extra DUF step),
+# the SwissProt and species lookups only read the family files and run meanwhile, and the overlap check runs
+# once all the other steps are done
+DESC_STEPS = {
+    "add_pdb_ref": ("Searching for PDB reference", "perl /homes/agb/Scripts/add_pdb_ref.pl", ()),
+    "swissprot": (
+        "Searching for SwissProt info",
+        "perl /nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/swissprot.pl -num 10",
+        (),
+    ),
+    "species_summary": ("Searching for species", "perl /homes/agb/Scripts/species_summary.pl .", ()),
+    "duffem": (
+        "Adding DUF identifier",
+        "perl /homes/agb/Scripts/duffem.pl -overwrite -duf .",
+        ("add_pdb_ref",),
+    ),
+    "nextDUF": (
+        "Adding DUF extra step",
+        "perl /nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/nextDUF.pl",
+        ("duffem",),
+    ),
+    "pqc-overlap-rdb": (
+        "Running final checks",
+        "/nfs/production/xfam/pfam/software/bin/pqc-overlap-rdb .",
+        ("add_pdb_ref", "swissprot", "species_summary", "nextDUF"),
+    ),
+}
+# steps writing the DESC file, which must not run at the same time
+DESC_WRITERS = ("add_pdb_ref", "duffem", "nextDUF")
+
+
+def run_in_dir(command, directory):
+    """
+    Run a shell command in directory, without changing the working directory of the process
+    """
+    return subprocess.run(command, shell=True, cwd=directory).returncode
+
+
+def submit_pfbuild(family, familydir=".", executor=None, cache=None):
+    """
+    Run pfbuild as a detached job of the "pfbuild" stage: it submits its own LSF job,
+    the job keeps its slot until check_pfambuild finds the build complete or failed
+    The pfbuild files are restored instead if the SEED alignment was built before (artefact cache)
+    """
+    key = None
+    if cache:
+        key = cache.stage_key(os.path.join(familydir, "SEED"), PFBUILD_TOOLS, pfamseq=True)
+        save_key(familydir, "pfbuild", key)
+    if key and cache.restore(key, "pfbuild", familydir, family):
+        print(f"pfbuild of {family} restored from the cache")
+        return
+    executor = executor or default_executor()
+    executor.submit("pfbuild", family, "pfbuild -withpfmake SEED", familydir, detached=True)
+
+
+def store_pfbuild(family, familydir=".", cache=None):
+    key = family_key(familydir, "pfbuild")
+    if cache and key:
+        cache.store(key, "pfbuild", familydir, family, PFBUILD_FILES)
+
+
+def check_pfambuild(familydir=".", log=None):
+    """
+    log: job_log of pfbuild.log, read from its last offset (the whole log is read if not given)
+    """
+    pfamout = os.path.join(familydir, "PFAMOUT")
+    logfile = os.path.join(familydir, "pfbuild.log")
+    if os.path.isfile(pfamout) == True and os.path.getsize(pfamout) != 0:
         return True
 
-    elif os.path.isfile("pfbuild.log") and os.path.getsize("pfbuild.log") != 0:
-        with open("pfbuild.log") as f:
-            datafile = f.readlines()
-            # verify that the process has finished running
-            if "Resource usage summary:\n" in datafile:
-                # if error found in the process
-                r = re.compile(
-                    r"cannot create temp file for here-document: No space left on device"
+    elif os.path.isfile(logfile) and os.path.getsize(logfile) != 0:
+        if log is None:
+            log = job_log(logfile, PFBUILD_ERRORS)
+        log.update()
+        # verify that the process has finished running
+        if log.finished:
+            # if error found in the process
+            newlines = [line for line in log.errors if "No space left on device" in line]
+            # if other error
+            newlines2 = [line for line in log.errors if "Exited with exit code" in line]
+
+            if len(newlines) > 0:  # if error found in the process
+                print(
+                    "An error occured when running pfbuild, run it again, please check the log file (pfbuild.log)"
                 )
-                newlines = list(filter(r.search, datafile))
-                # if other error
-                r = re.compile(r"Exited with exit code")
-                newlines2 = list(filter(r.search, datafile))
-
-                if len(newlines) > 0:  # if error found in the process
-                    print(
-                        "An error occured when running pfbuild, run it again, please check the log file (pfbuild.log)"
-                    )
-                    print(newlines)
-                    return
-                elif len(newlines2) > 0:
-                    print("Memory limit error")
-                    return
+                print(newlines)
+                return
+            elif len(newlines2) > 0:
+                print("Memory limit error")
+                return
 
     return False
 
 
-def complete_desc():
-
-    print("Searching for PDB reference")
-    start_time = time.time()
-    os.system(f"perl /homes/agb/Scripts/add_pdb_ref.pl")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-    print("Searching for SwissProt info")
-    start_time = time.time()
-    os.system(f"perl /nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/swissprot.pl -num 10")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-    print("Searching for species")
-    start_time = time.time()
-    os.system(f"perl /homes/agb/Scripts/species_summary.pl .")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-    print("Adding DUF identifier")
-    start_time = time.time()
-    os.system(f"perl /homes/agb/Scripts/duffem.pl -overwrite -duf .")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-    print("Adding DUF extra step")
-    start_time = time.time()
-    os.system(f"perl /nfs/production/xfam/pfam/software/Pfam/PfamScripts/make/nextDUF.pl")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
-
-    print("Running final checks")
+def required_steps(step):
+    """
+    Steps required before step, directly or not
+    """
+    required = set()
+    stack = list(DESC_STEPS[step][2])
+    while stack:
+        r = stack.pop()
+        if r not in required:
+            required.add(r)
+            stack.extend(DESC_STEPS.get(r, ((), (), ()))[2])
+    return required
+
+
+def desc_order():
+    """
+    Steps of DESC_STEPS sorted so each step comes after the steps it requires,
+    raise ValueError if a step requires an unknown step, if the requirements form a cycle,
+    or if two steps writing the DESC file (DESC_WRITERS) could run at the same time
+    """
+    order = []
+    visiting = set()
+
+    def visit(step, path):
+        if step in order:
+            return
+        if step not in DESC_STEPS:
+            raise ValueError(f"Unknown DESC step {step} (required by {path[-1]})")
+        if step in visiting:
+            raise ValueError(f"Cycle in the DESC steps: {' -> '.join(path + [step])}")
+        visiting.add(step)
+        for required in DESC_STEPS[step][2]:
+            visit(required, path + [step])
+        order.append(step)
+
+    for step in DESC_STEPS:
+        visit(step, [])
+
+    writers = [step for step in order if step in DESC_WRITERS]
+    for first, second in zip(writers, writers[1:]):
+        if first not in required_steps(second):
+            raise ValueError(f"DESC steps {first} and {second} both write the DESC file, one must require the other")
+    return order
+
+
+def complete_desc(familydir=".", executor=None):
+    """
+    The steps of DESC_STEPS are run as jobs of the "desc" stage of executor (local processes if not given),
+    each step as soon as the steps it requires succeeded (skipped if one of them failed), so the number of steps
+    running at the same time for all the families is the limit of the "desc" stage
+    Return {step: {"status": exit status (None if skipped), "queued": seconds waited for a slot,
+    "time": seconds run}}, also saved in complete_desc.json with the total time
+    """
+    executor = executor or default_executor()
+    family = os.path.basename(os.path.abspath(familydir))
+    order = desc_order()
     start_time = time.time()
-    os.system(f"/nfs/production/xfam/pfam/software/bin/pqc-overlap-rdb .")
-    print("--- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60))
 
-    os.system(f"chmod -R g+w *")
+    results = {}
+    # job: step
+    running = {}
+    while True:
+        for step in order:
+            if step in results or step in running.values():
+                continue
+            description, command, requires = DESC_STEPS[step]
+            if any(r in results and results[r]["status"] != 0 for r in requires):
+                print(f"{family}: {description} skipped")
+                results[step] = {"status": None, "queued": 0, "time": 0}
+            elif all(r in results for r in requires):
+                print(f"{family}: {description}")
+                running[executor.submit("desc", f"{family}:{step}", command, familydir)] = step
+        # the steps are in dependency order: the steps left without job are all done
+        if not running:
+            break
+        for job in executor.wait_any(list(running)):
+            step = running.pop(job)
+            ended = job.ended or time.time()
+            results[step] = {
+                "status": job.returncode,
+                "queued": round((job.started or ended) - job.submitted, 3),
+                "time": round(ended - (job.started or ended), 3),
+            }
+            if job.returncode == 0:
+                print(f"{family}: {step} completed in {results[step]['time'] / 60:.2f} minutes")
+            else:
+                print(f"{family}: {step} failed with exit status {job.returncode}")
+
+    total = time.time() - start_time
+    print(f"--- DESC file of {family} completed in {total / 60:.2f} minutes ---")
+    report = {
+        "family": family,
+        "time": round(total, 3),
+        "steps": {step: results[step] for step in order},
+    }
+    with open(os.path.join(familydir, "complete_desc.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    run_in_dir(f"chmod -R g+w *", familydir)
+    return report["steps"]
 
 
 if __name__ == "__main__":
     print("Verify if Pfam build has completed successfully")
     done = check_pfambuild()
     if done == True:
-        complete_desc()
+        steps = complete_desc()
+        failed = [step for step, result in steps.items() if result["status"] != 0]
+        if failed:
+            print(f"DESC steps failed or skipped: {', '.join(failed)}")
+            exit(1)
     elif done == False:
         print("Pfbuild hasn't completed yet")
     else:
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Collapse identical sequences before the clustering
+        The sequences (whitespace removed, upper case) are hashed in a first pass over the input files
+        (fasta files, gzipped or sequence stores, see sequence_store.py), the digests are written to bucket files
+        and the duplicates are found by sorting each bucket, so the memory used doesn't depend on the number
+        of sequences; the removed sequences are saved in a second pass over the input files, in
+        <dupsfile> (representative accession\tduplicate header) with a sorted index of the representative
+        accessions (<dupsfile>.npy), so the clusters members can be re-expanded by get_stats.py, and their
+        record numbers in the input files (<dupsfile>.records.npy, sorted)
+        The unique sequences are written to output fasta file(s), or read again from the input files
+        (e.g. sequence stores) without the duplicates saved, so no copy of the sequences is kept
+
+@arguments [-f INPUT_FILE [INPUT_FILE ...]]: fasta files (e.g. UniProtKB and filtered MGnify sequences)
+           [-o OUTPUT_FILE [OUTPUT_FILE ...]]: fasta file with the unique sequences, or one file per input file
+                                               (the files can then be given together to mmseqs createdb)
+           [-d DUPS_FILE]: duplicates mapping (default: <first OUTPUT_FILE>.dups)
+           [-u]: write the unique sequences of the input files to stdout, from the duplicates saved in DUPS_FILE
+                 (e.g. piped to mmseqs createdb stdin)
+
+"""
+
+import argparse
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import sys
+import tempfile
+from array import array
+
+import numpy as np
+
+from accession_index import decode_accession, encode_accession
+from filter_partial import BLOCK_SIZE, open_fasta
+
+INDEX_TYPE = np.dtype([("key", "u8"), ("offset", "u8")])
+# MGnify accessions (MGYP + 12 digits) are encoded above the UniProt accessions
+MGNIFY_KEY = 1 << 63
+# key of the sequences whose accession can't be used as representative
+NO_KEY = (1 << 64) - 1
+# sequence digest (2 x 64 bits), record number in the input files, accession key
+RECORD_TYPE = np.dtype([("digest", "u8"), ("digest2", "u8"), ("n", "u8"), ("key", "u8")])
+DUPLICATE_TYPE = np.dtype([("n", "u8"), ("key", "u8")])
+# number of digest buckets (each one sorted in memory), and of records per range of the duplicates
+BUCKETS = 256
+RANGE_SIZE = 1 << 24
+
+
+def header_accession(header):
+    """
+    Accession of a fasta header (with or without '>'), as parsed by get_stats.py
+    """
+    word = header.lstrip(b">").split(b" ")[0].rstrip(b"\n")
+    if b"|" in word:
+        return word.split(b"|")[1]
+    return word
+
+
+def encode_member(acc):
+    """
+    Integer key of a UniProt or MGnify accession (bytes), raises ValueError for other identifiers
+    """
+    if acc.startswith(b"MGYP"):
+        if not acc[4:].isdigit() or len(acc) > 16:
+            raise ValueError(f"Invalid accession {acc}")
+        return MGNIFY_KEY | int(acc[4:])
+    return encode_accession(acc)
+
+
+def get_duplicates_file(outputfile):
+    return f"{outputfile}.dups"
+
+
+def get_records_file(dupsfile):
+    return f"{dupsfile}.records.npy"
+
+
+def iter_fasta(buffer):
+    """
+    Yield (header line, sequence lines) for each sequence of a fasta buffer
+    """
+    pos = buffer.find(b">")
+    while pos != -1:
+        eol = buffer.find(b"\n", pos)
+        eol = len(buffer) if eol == -1 else eol + 1
+        nxt = buffer.find(b"\n>", eol - 1)
+        end = len(buffer) if nxt == -1 else nxt + 1
+        yield buffer[pos:eol], buffer[eol:end]
+        pos = -1 if nxt == -1 else end
+
+
+def iter_fasta_file(inputfile):
+    """
+    Yield (header line, sequence lines) for each sequence of a fasta file (gzipped, block-compressed
+    or not), read by blocks
+    """
+    remainder = b""
+    with open_fasta(inputfile) as input:
+        while True:
+            block = input.read(BLOCK_SIZE)
+            data = remainder + block
+            if block:
+                # only complete sequences are parsed, the last one is kept for the next block
+                cut = data.rfind(b"\n>") + 1
+                data, remainder = data[:cut], data[cut:]
+            yield from iter_fasta(data)
+            if not block:
+                break
+
+
+def decode_member(key):
+    """
+    Accession (bytes) of a key given by encode_member
+    """
+    if key & MGNIFY_KEY:
+        return b"MGYP%012d" % (key & ~MGNIFY_KEY)
+    return decode_accession(key).encode("ascii")
+
+
+def record_key(header):
+    """
+    Key of the accession of a fasta header, NO_KEY if it can't be used as representative
+    (unknown identifier, or accession not written back identically from its key)
+    """
+    acc = header_accession(header)
+    try:
+        key = encode_member(acc)
+    except ValueError:
+        return NO_KEY
+    return key if decode_member(key) == acc else NO_KEY
+
+
+class digest_buckets:
+    """
+    (digest, record number, accession key) of the sequences, appended to files by digest bucket
+    """
+
+    def __init__(self, tmpdir, buckets=BUCKETS, chunk_size=1 << 20):
+        self.buckets = buckets
+        self.chunk_size = chunk_size
+        self.files = [open(os.path.join(tmpdir, f"bucket_{i}"), "wb") for i in range(buckets)]
+        self.digests = bytearray()
+        self.keys = array("Q")
+        self.count = 0
+        self.flushed = 0
+
+    def add(self, digest, key):
+        self.digests += digest
+        self.keys.append(key)
+        self.count += 1
+        if self.count - self.flushed >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.count == self.flushed:
+            return
+        digests = np.frombuffer(bytes(self.digests), dtype="u8").reshape(-1, 2)
+        records = np.empty(len(digests), dtype=RECORD_TYPE)
+        records["digest"] = digests[:, 0]
+        records["digest2"] = digests[:, 1]
+        records["n"] = np.arange(self.flushed, self.count, dtype="u8")
+        records["key"] = np.frombuffer(self.keys, dtype="u8")
+        buckets = records["digest"] % np.uint64(self.buckets)
+        order = np.argsort(buckets, kind="stable")
+        records, buckets = records[order], buckets[order]
+        bounds = np.searchsorted(buckets, np.arange(self.buckets + 1, dtype="u8"))
+        for i, f in enumerate(self.files):
+            if bounds[i] < bounds[i + 1]:
+                records[bounds[i] : bounds[i + 1]].tofile(f)
+        self.digests = bytearray()
+        self.keys = array("Q")
+        self.flushed = self.count
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        return [f.name for f in self.files]
+
+
+def find_duplicates(bucketfile, tmpdir, range_size=RANGE_SIZE):
+    """
+    Find the duplicates among the sequences of a bucket: (record number, key of the representative) appended
+    to the files of the ranges of record numbers (range_<n // range_size>), return the number of duplicates
+    """
+    records = np.fromfile(bucketfile, dtype=RECORD_TYPE)
+    os.remove(bucketfile)
+    if len(records) == 0:
+        return 0
+    records = records[np.lexsort((records["n"], records["digest2"], records["digest"]))]
+    first = np.ones(len(records), dtype=bool)
+    first[1:] = (records["digest"][1:] != records["digest"][:-1]) | (
+        records["digest2"][1:] != records["digest2"][:-1]
+    )
+    # first occurrence of the sequence of each record
+    firsts = np.maximum.accumulate(np.where(first, np.arange(len(records)), 0))
+    rep_keys = records["key"][firsts]
+    # the duplicates of a sequence whose first accession is unknown are kept
+    duplicate = ~first & (rep_keys != NO_KEY)
+    duplicates = np.empty(int(duplicate.sum()), dtype=DUPLICATE_TYPE)
+    duplicates["n"] = records["n"][duplicate]
+    duplicates["key"] = rep_keys[duplicate]
+    ranges = duplicates["n"] // np.uint64(range_size)
+    for r in np.unique(ranges):
+        with open(os.path.join(tmpdir, f"range_{r}"), "ab") as f:
+            duplicates[ranges == r].tofile(f)
+    return len(duplicates)
+
+
+def read_range(tmpdir, r):
+    """
+    (record numbers, keys of the representatives) of the duplicates of range r, sorted by record number
+    """
+    rangefile = os.path.join(tmpdir, f"range_{r}")
+    if not os.path.isfile(rangefile):
+        return [], []
+    duplicates = np.fromfile(rangefile, dtype=DUPLICATE_TYPE)
+    os.remove(rangefile)
+    duplicates.sort(order="n")
+    return duplicates["n"].tolist(), duplicates["key"].tolist()
+
+
+class duplicate_index_writer:
+    """
+    (key, offset) entries of the duplicates mapping, sorted by chunks saved into temporary files,
+    then merged into the index, as accession_index_writer
+    """
+
+    def __init__(self, indexfile, tmpdir, chunk_size=5000000):
+        self.indexfile = indexfile
+        self.tmpdir = tmpdir
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, key, offset):
+        self.chunk.append((key, offset))
+        self.count += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            # offsets increase in each chunk, the entries of a key stay in file order
+            self.chunk.sort()
+            run = tempfile.TemporaryFile(dir=self.tmpdir)
+            np.array(self.chunk, dtype="u8").tofile(run)
+            run.seek(0)
+            self.runs.append(run)
+            self.chunk = []
+
+    def read_run(self, run, block=1 << 16):
+        while True:
+            entries = np.fromfile(run, dtype="u8", count=2 * block).reshape(-1, 2)
+            if len(entries) == 0:
+                break
+            yield from map(tuple, entries.tolist())
+
+    def close(self):
+        """
+        Merge the sorted chunks into the index (written to a temporary file then renamed)
+        """
+        self.flush()
+        tmpfile = f"{self.indexfile}.tmp.npy"
+        index = np.lib.format.open_memmap(tmpfile, mode="w+", dtype=INDEX_TYPE, shape=(self.count,))
+        merged = heapq.merge(*[self.read_run(run) for run in self.runs])
+        start = 0
+        while start < self.count:
+            entries = np.array(list(itertools.islice(merged, 1 << 20)), dtype="u8")
+            index["key"][start : start + len(entries)] = entries[:, 0]
+            index["offset"][start : start + len(entries)] = entries[:, 1]
+            start += len(entries)
+        index.flush()
+        del index
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        os.replace(tmpfile, self.indexfile)
+
+
+def dedup_files(inputfiles, outputfiles=None, dupsfile=None, buckets=BUCKETS, range_size=RANGE_SIZE):
+    """
+    Save the duplicates mapping of the input files and write their unique sequences to the output file
+    (or of each input file to the corresponding output file) if given,
+    return (number of sequences, number of duplicates)
+    The digests are kept on disk: the input files are read a first time to write the digests by bucket,
+    the duplicates are found bucket by bucket, then the input files are read again to save the duplicates
+    """
+    outputfiles = outputfiles or []
+    if len(outputfiles) == 1:
+        outputfiles = outputfiles * len(inputfiles)
+    elif outputfiles and len(outputfiles) != len(inputfiles):
+        raise ValueError("Expected one output file, or one output file per input file")
+    if not outputfiles and not dupsfile:
+        raise ValueError("Expected output files or a duplicates file")
+    dupsfile = dupsfile or get_duplicates_file(outputfiles[0])
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dupsfile))) as tmpdir:
+        writer = digest_buckets(tmpdir, buckets)
+        for inputfile in inputfiles:
+            for header, sequence in iter_fasta_file(inputfile):
+                digest = hashlib.blake2b(
+                    sequence.translate(None, b" \t\r\n").upper(), digest_size=16
+                ).digest()
+                writer.add(digest, record_key(header))
+        total = writer.count
+        count = 0
+        for bucketfile in writer.close():
+            count += find_duplicates(bucketfile, tmpdir, range_size)
+
+        index = duplicate_index_writer(f"{dupsfile}.npy", tmpdir)
+        records = np.lib.format.open_memmap(
+            f"{dupsfile}.records.tmp.npy", mode="w+", dtype="u8", shape=(count,)
+        )
+        outputs = {}
+        n = 0
+        duplicates, keys, i = [], [], 0
+        with open(f"{dupsfile}.tmp", "wb") as dups:
+            for inputfile, outputfile in itertools.zip_longest(inputfiles, outputfiles):
+                if outputfile and outputfile not in outputs:
+                    outputs[outputfile] = open(f"{outputfile}.tmp", "wb")
+                output = outputs.get(outputfile)
+                for header, sequence in iter_fasta_file(inputfile):
+                    if n % range_size == 0:
+                        duplicates, keys = read_range(tmpdir, n // range_size)
+                        i = 0
+                    n += 1
+                    if i < len(duplicates) and duplicates[i] == n - 1:
+                        records[index.count] = n - 1
+                        index.add(keys[i], dups.tell())
+                        dups.write(decode_member(keys[i]) + b"\t" + header[1:])
+                        if not header.endswith(b"\n"):
+                            dups.write(b"\n")
+                        i += 1
+                        continue
+                    if output:
+                        write_record(output, header, sequence)
+        for output in outputs.values():
+            output.close()
+        index.close()
+        records.flush()
+        del records
+
+    os.replace(f"{dupsfile}.records.tmp.npy", get_records_file(dupsfile))
+    os.replace(f"{dupsfile}.tmp", dupsfile)
+    for outputfile in outputs:
+        os.replace(f"{outputfile}.tmp", outputfile)
+    return total, index.count
+
+
+def write_record(output, header, sequence):
+    output.write(header)
+    output.write(sequence)
+    if sequence and not sequence.endswith(b"\n"):
+        # last sequence of a file without end of line
+        output.write(b"\n")
+
+
+def iter_unique(inputfiles, dupsfile):
+    """
+    Yield (header line, sequence lines) for the sequences of the input files which aren't duplicates
+    (record numbers saved by dedup_files with the same input files)
+    """
+    records = np.load(get_records_file(dupsfile), mmap_mode="r")
+    i = 0
+    # the record numbers are read by blocks
+    block, start = records[:RANGE_SIZE].tolist(), 0
+    n = 0
+    for inputfile in inputfiles:
+        for header, sequence in iter_fasta_file(inputfile):
+            if i - start == len(block) and i < len(records):
+                block, start = records[i : i + RANGE_SIZE].tolist(), i
+            if i < len(records) and block[i - start] == n:
+                i += 1
+            else:
+                yield header, sequence
+            n += 1
+    if i != len(records):
+        raise ValueError(f"The duplicates of {dupsfile} weren't found in the input files")
+
+
+class duplicate_index:
+    """
+    Duplicates of the representative sequences, read from the mapping written by dedup_files
+    """
+
+    def __init__(self, dupsfile):
+        self.dupsfile = dupsfile
+        self.open()
+
+    def open(self):
+        self.file = open(self.dupsfile, "rb")
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b""
+        self.index = np.load(f"{self.dupsfile}.npy", mmap_mode="r")
+        if len(self.index) == 0:
+            self.index = np.zeros(0, dtype=INDEX_TYPE)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, acc):
+        """
+        Headers (without '>', with end of line) of the duplicates of the representative acc (bytes)
+        """
+        try:
+            key = encode_member(acc)
+        except ValueError:
+            return []
+        keys = self.index["key"]
+        i = np.searchsorted(keys, key, side="left")
+        headers = []
+        while i < len(keys) and keys[i] == key:
+            offset = int(self.index["offset"][i])
+            eol = self.buffer.find(b"\n", offset)
+            eol = len(self.buffer) if eol == -1 else eol + 1
+            headers.append(self.buffer[offset + len(acc) + 1 : eol])
+            i += 1
+        return headers
+
+    # only the file name is sent to other processes, the files are mapped again on their side
+    def __getstate__(self):
+        return {"dupsfile": self.dupsfile}
+
+    def __setstate__(self, state):
+        self.dupsfile = state["dupsfile"]
+        self.open()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--input_file", help="input fasta files", nargs="+", required=True)
+    parser.add_argument("-o", "--output_file", help="output fasta file(s)", nargs="+")
+    parser.add_argument("-d", "--dups_file", help="duplicates mapping")
+    parser.add_argument(
+        "-u",
+        "--unique",
+        help="write the unique sequences of the input files to stdout, from the duplicates saved",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.output_file and len(args.output_file) not in (1, len(args.input_file)):
+        parser.error("Expected one output file, or one output file per input file")
+    if not args.output_file and not args.dups_file:
+        parser.error("Expected output files (-o) or a duplicates file (-d)")
+
+    missing = [f for f in args.input_file if not os.path.isfile(f)]
+    if missing:
+        print(f"Input files not found: {' '.join(missing)}")
+        sys.exit(1)
+
+    dupsfile = args.dups_file or get_duplicates_file(args.output_file[0])
+    if args.unique:
+        output = sys.stdout.buffer
+        for header, sequence in iter_unique(args.input_file, dupsfile):
+            write_record(output, header, sequence)
+        output.flush()
+        sys.exit()
+    total, duplicates = dedup_files(args.input_file, args.output_file, dupsfile)
+    print(f"{total - duplicates} unique sequences out of {total}")
+    print(f"{duplicates} duplicates saved in {dupsfile}")
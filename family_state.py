@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief State of the families built by generate_alignments.py, kept in a SQLite database (WAL mode)
+        in the output folder (<folder>/families.db), so a run started again resumes the families in progress
+        Each family goes through ALIGNING -> LIFTOVER -> PFBUILD -> DESC -> DONE, or ends in
+        ALIGNMENT_FAILED, LIFTOVER_FAILED or PFBUILD_FAILED; a stage run again (retry) keeps the same state
+        with one more attempt
+        The transitions are checked against the current state of the family, and a batch of transitions
+        is applied in a single transaction (all or none)
+        For each family: cluster representative, state, attempts in the current stage, job waited for,
+        creation and last update times
+
+@arguments DATABASE: families database (e.g. Pfam-M/families.db)
+           [-s STATE [STATE ...]]: families in these states (default: number of families per state)
+
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+ALIGNING = "ALIGNING"
+LIFTOVER = "LIFTOVER"
+PFBUILD = "PFBUILD"
+DESC = "DESC"
+DONE = "DONE"
+ALIGNMENT_FAILED = "ALIGNMENT_FAILED"
+LIFTOVER_FAILED = "LIFTOVER_FAILED"
+PFBUILD_FAILED = "PFBUILD_FAILED"
+
+TRANSITIONS = {
+    ALIGNING: {LIFTOVER, ALIGNMENT_FAILED},
+    LIFTOVER: {LIFTOVER, PFBUILD, LIFTOVER_FAILED},
+    PFBUILD: {PFBUILD, DESC, PFBUILD_FAILED},
+    DESC: {DONE},
+}
+STATES = (
+    ALIGNING,
+    LIFTOVER,
+    PFBUILD,
+    DESC,
+    DONE,
+    ALIGNMENT_FAILED,
+    LIFTOVER_FAILED,
+    PFBUILD_FAILED,
+)
+# seconds waited for the lock held by another connection
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS families (
+    family TEXT PRIMARY KEY,
+    cluster_rep TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    job TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS families_state ON families (state);
+"""
+
+
+def get_database(aligned_dir):
+    return os.path.join(aligned_dir, "families.db")
+
+
+class family_db:
+    """
+    Families database, with a connection per thread
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.local = threading.local()
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def connection(self):
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.dbfile, timeout=BUSY_TIMEOUT)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            # with WAL, the database stays consistent after a crash without syncing every commit
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+    def add(self, families):
+        """
+        Add the families [(family, cluster representative)] in the ALIGNING state,
+        families already known are left unchanged
+        """
+        now = time.time()
+        with self.connection() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO families (family, cluster_rep, state, created, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(family, cluster_rep, ALIGNING, now, now) for family, cluster_rep in families],
+            )
+
+    def get(self, family):
+        return self.connection().execute(
+            "SELECT * FROM families WHERE family = ?", (family,)
+        ).fetchone()
+
+    def families(self, *states):
+        """
+        Families in the given states, by name
+        """
+        placeholders = ",".join("?" * len(states))
+        return self.connection().execute(
+            f"SELECT * FROM families WHERE state IN ({placeholders}) ORDER BY family", states
+        ).fetchall()
+
+    def transition(self, family, source, target, job=None):
+        self.transitions([(family, source, target, job)])
+
+    def transitions(self, changes):
+        """
+        Apply the transitions [(family, source state, target state, job)] in a single transaction,
+        raise ValueError (nothing applied) if a transition isn't allowed or a family isn't in its source state
+        """
+        now = time.time()
+        db = self.connection()
+        with db:
+            for family, source, target, job in changes:
+                if target not in TRANSITIONS.get(source, ()):
+                    raise ValueError(f"Invalid transition {source} -> {target} for {family}")
+                # attempts counted in the current stage
+                attempts = "attempts + 1" if source == target else "1"
+                cursor = db.execute(
+                    f"UPDATE families SET state = ?, attempts = {attempts}, job = ?, updated = ? "
+                    "WHERE family = ? AND state = ?",
+                    (target, job, now, family, source),
+                )
+                if cursor.rowcount != 1:
+                    raise ValueError(f"{family} isn't in the {source} state")
+
+    def set_job(self, family, state, job):
+        """
+        Save the job waited for by a family in the given state (e.g. started after its transition,
+        or submitted again), without changing its state
+        """
+        with self.connection() as db:
+            cursor = db.execute(
+                "UPDATE families SET job = ?, updated = ? WHERE family = ? AND state = ?",
+                (job, time.time(), family, state),
+            )
+            if cursor.rowcount != 1:
+                raise ValueError(f"{family} isn't in the {state} state")
+
+    def counts(self):
+        """
+        {state: number of families}
+        """
+        rows = self.connection().execute("SELECT state, COUNT(*) FROM families GROUP BY state")
+        return dict(rows.fetchall())
+
+    def close(self):
+        if hasattr(self.local, "db"):
+            self.local.db.close()
+            del self.local.db
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", help="families database (e.g. Pfam-M/families.db)")
+    parser.add_argument(
+        "-s", "--states", help="families in these states", nargs="+", choices=STATES
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print(f"Database not found: {args.database}")
+        sys.exit(1)
+
+    db = family_db(args.database)
+    if args.states:
+        for row in db.families(*args.states):
+            updated = time.strftime("%d %b %Y %H:%M", time.localtime(row["updated"]))
+            print(
+                f"{row['family']}\t{row['cluster_rep']}\t{row['state']}\t{row['attempts']}\t{row['job'] or '-'}\t{updated}"
+            )
+    else:
+        counts = db.counts()
+        for state in STATES:
+            if counts.get(state):
+                print(f"{state}\t{counts[state]}")
@@ -3,34 +3,128 @@
 """
 @author T. Paysan-Lafosse
 
-@brief This script filters truncated sequences from a fasta file
+@brief This script filters truncated sequences from fasta files (MGnify peptide files, gzipped or not)
+        Each input file is filtered by a separate process into a part file, the parts are appended
+        to the output file in the order of the input files as soon as they are complete
+
+@arguments [-f INPUT_FILE [INPUT_FILE ...]]: fasta files with sequences to remove (e.g. mgy_proteins_*.fa.gz)
+           [-o OUTPUT_FILE]: filtered fasta file (default: <INPUT_FILE>_clear if only one input file)
+           [-w WORKERS]: number of input files filtered in parallel (default=1)
 
-@arguments [-f INPUT_FILE]: fasta file with sequences to remove
-           
 """
 
 
 import argparse
+import gzip
 import os
-import re
+import shutil
+import sys
+from multiprocessing import Pool
+
+# full length sequences and sequences truncated at one end only
+KEEP_FLAGS = (b"PL=00", b"PL=01", b"PL=10")
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def open_fasta(filename):
+    # gzipped or block-compressed (sequence_store.py) files
+    if filename.endswith((".gz", ".bgz")):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def filter_block(data, keep, output):
+    """
+    Write the MGnify sequences of data (complete lines) with a kept partial flag
+    keep: whether the sequence continued from the previous block is kept
+    Return (keep, number of MGnify sequences, number of sequences kept)
+    """
+    total = kept = 0
+    pos = 0
+    view = memoryview(data)
+    while pos < len(data):
+        if data.startswith(b">MGY", pos):
+            eol = data.find(b"\n", pos)
+            header = data[pos:] if eol == -1 else data[pos:eol]
+            keep = any(flag in header for flag in KEEP_FLAGS)
+            total += 1
+            kept += keep
+        # lines up to the next MGnify header
+        nxt = data.find(b"\n>MGY", pos)
+        nxt = len(data) if nxt == -1 else nxt + 1
+        if keep:
+            output.write(view[pos:nxt])
+        pos = nxt
+    return keep, total, kept
+
+
+def filter_file(inputfile, outputfile):
+    """
+    Filter inputfile into outputfile, return (number of MGnify sequences, number of sequences kept)
+    """
+    total = kept = 0
+    keep = False
+    remainder = b""
+    with open_fasta(inputfile) as input, open(outputfile, "wb") as output:
+        while True:
+            block = input.read(BLOCK_SIZE)
+            data = remainder + block
+            if block:
+                # only complete lines are filtered, the last line is kept for the next block
+                cut = data.rfind(b"\n") + 1
+                data, remainder = data[:cut], data[cut:]
+            keep, block_total, block_kept = filter_block(data, keep, output)
+            total += block_total
+            kept += block_kept
+            if not block:
+                break
+    return total, kept
+
+
+def filter_part(job):
+    return filter_file(*job)
+
+
+def filter_files(inputfiles, outputfile, workers=1):
+    """
+    Filter the input files into outputfile (written to a temporary file then renamed),
+    return (number of MGnify sequences, number of sequences kept)
+    """
+    jobs = [(inputfile, f"{outputfile}.part_{i}") for i, inputfile in enumerate(inputfiles)]
+    tmpfile = f"{outputfile}.tmp"
+    total = kept = 0
+    with open(tmpfile, "wb") as output, Pool(max(1, min(workers, len(jobs)))) as pool:
+        for (_, partfile), (part_total, part_kept) in zip(jobs, pool.imap(filter_part, jobs)):
+            with open(partfile, "rb") as part:
+                shutil.copyfileobj(part, output, BLOCK_SIZE)
+            os.remove(partfile)
+            total += part_total
+            kept += part_kept
+    os.replace(tmpfile, outputfile)
+    return total, kept
+
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--input_file", help="input file", required=True)
+    parser.add_argument("-f", "--input_file", help="input files", nargs="+", required=True)
+    parser.add_argument("-o", "--output_file", help="output file")
+    parser.add_argument(
+        "-w", "--workers", help="number of files filtered in parallel (default=1)", type=int, default=1
+    )
     args = parser.parse_args()
 
-    if os.path.isfile(args.input_file):
-        with open(args.input_file, "r") as input, open(f"{args.input_file}_clear", "w") as output:
-
-            line = input.readline()
-            count = 0
-            while line:
-                if re.search(r"^>MGY", line):
-                    count = 0
-                    if "PL=00" in line or "PL=01" in line or "PL=10" in line:
-                        output.write(line)
-                        count = 1
-                elif count == 1:
-                    output.write(line)
-                line = input.readline()
+    if args.output_file:
+        outputfile = args.output_file
+    elif len(args.input_file) == 1:
+        outputfile = f"{args.input_file[0]}_clear"
+    else:
+        parser.error("An output file is required with several input files")
+
+    missing = [f for f in args.input_file if not os.path.isfile(f)]
+    if missing:
+        print(f"Input files not found: {' '.join(missing)}")
+        sys.exit(1)
+
+    total, kept = filter_files(args.input_file, outputfile, args.workers)
+    print(f"{kept} sequences kept out of {total} MGnify sequences")
@@ -33,10 +33,9 @@ if __name__ == "__main__":
                 outs = outs.decode("utf-8")
                 if outs != "":
                     print(family)
-                    os.chdir(familydir)
-                    if check_pfambuild():
+                    if check_pfambuild(familydir):
                         # print("pfbuild completed")
-                        complete_desc()
+                        complete_desc(familydir)
                     else:
                         print("Pfbuild failed")
             else:
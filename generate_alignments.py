@@ -11,8 +11,33 @@
 #                                     [-d "yes" (delete previous files)]
 #                                     [-b family to start building from]
 #                                     [-n number of families to build]
+#                                     [-w number of alignments built (and DESC files completed) at the same time]
+#                                     [-e executor running the liftover, pfbuild and DESC scripts (local or lsf)]
+#                                     [-l maximum number of jobs running per stage, e.g. liftover=20 pfbuild=10 desc=4]
+#                                     [--bsub_options options given to bsub with the lsf executor]
+#                                     [-c cache directory (default=artefact_cache next to the input file)]
+#                                     [--cache_size maximum size of the cache in GB, 0 to disable it]
+#                                     [--pfamseq_version version of pfamseq in the cache keys (default: from $PFAM_CONFIG)]
+#                                     [--batch_liftover search command lifting over a batch of families]
+#                                     [--batch_size number of families per batch (default=20)]
 #
-# !!!! start redis server (redis-server &) before running this script, need the graphic interface should be enabled (-x) !!!
+# The alignments are built by a pool of workers, each alignment is queued for the liftover as soon as
+# it is built, while the liftover and pfbuild stages run in separate threads
+# The liftover and pfbuild stages wait for the files written by the jobs in the family directories
+# (see job_events.py), only the new lines of the job logs are read
+# The liftover, pfbuild and DESC scripts are run through an executor (see job_executor.py), which limits
+# the number of families in each stage
+# The state of each family is kept in <folder>/families.db (see family_state.py): a run started again
+# resumes the families in progress, without checking the family directories; the job saved for a family in
+# the liftover or pfbuild stage (the LSF job submitted by liftover_alignment.pl or pfbuild once they returned)
+# is checked, and submitted again if it isn't running and wrote no output
+# The alignment, liftover and pfbuild files are cached by content (see artefact_cache.py): cluster sequences,
+# SEED alignments, tools of each stage and pfamseq version, a cluster already built in a previous run is restored
+# instead of running these stages again
+# With --batch_liftover, the liftover of the families is run by batches, pfamseq is searched once per batch
+# with a query per family (see batch_liftover.py)
+#
+# !!!! the graphic interface should be enabled (-x) !!!
 #
 ###################
 
@@ -20,30 +45,130 @@ import os
 import sys
 import shutil
 import argparse
-import redis
 import time
-import subprocess
-from multiprocessing import Process
+import threading
+from multiprocessing.pool import ThreadPool
 
 import build_families
-from complete_desc_file import complete_desc, check_pfambuild
+from artefact_cache import artefact_cache, pfamseq_version
+from batch_liftover import liftover_batch
+from cluster_archive import cluster_archive, archive_exists
+from complete_desc_file import (
+    PFBUILD_ERRORS,
+    check_pfambuild,
+    complete_desc,
+    store_pfbuild,
+    submit_pfbuild,
+)
+from family_state import (
+    ALIGNING,
+    ALIGNMENT_FAILED,
+    DESC,
+    DONE,
+    LIFTOVER,
+    LIFTOVER_FAILED,
+    PFBUILD,
+    PFBUILD_FAILED,
+    family_db,
+    get_database,
+)
+from job_events import directory_watcher, job_log
+from job_executor import EXECUTORS, FAILED, local_executor, parse_limits
 
 
 class alignments:
     def __init__(self):
         self.cluster_dir = ""
+        # cluster_archive if the clusters were saved in a packed archive by get_stats.py
+        self.archive = None
         self.aligned_dir = ""
         self.datadir = ""
         self.scriptdir = os.path.dirname(os.path.realpath(__file__))
-        self.queue_in = "lift_over_in"
-        self.queue_done = "lift_over_done"
-        self.pfam_in = "pfam_in"
         self.folder = ""
-        self.pfam_failed = dict()
-        self.liftover_failed = dict()
-        self.server = redis.StrictRedis(
-            port=6379, host="localhost", db=0, charset="utf-8", decode_responses=True
+        # family_db of the output folder
+        self.db = None
+        # artefact_cache of the files of the families built in the previous runs, None if disabled
+        self.cache = None
+        # liftover_batch if the liftover is run by batches
+        self.batch = None
+        # set when all the alignments are queued for the liftover, and when the liftover stage is over
+        self.alignments_done = threading.Event()
+        self.liftover_done = threading.Event()
+        # the liftover and pfbuild stages wait for the files written by their jobs
+        self.liftover_events = directory_watcher()
+        self.pfbuild_events = directory_watcher()
+        # number of families whose DESC file is completed at the same time
+        self.desc_workers = 4
+        # runs the liftover, pfbuild and DESC scripts, the stages are woken up when a job starts or ends
+        self.executor = None
+        self.set_executor(local_executor())
+
+    def set_executor(self, executor):
+        self.executor = executor
+        executor.add_listener(self.liftover_events.wake)
+        executor.add_listener(self.pfbuild_events.wake)
+
+    def job_handle(self, stage, family):
+        """
+        Handle of the job running the stage of the family (farm job submitted, process or LSF job, or job of
+        its liftover batch), None if not started
+        """
+        job = self.executor.get(stage, family)
+        if job is None and stage == "liftover" and self.batch:
+            job = self.batch.job(family)
+        return job.handle if job else None
+
+    def record_jobs(self, stage, state, families, recorded):
+        """
+        Save the jobs of the families started since their transition (the jobs queued have no identifier)
+        recorded: {family: job saved}
+        """
+        for family in families:
+            handle = self.job_handle(stage, family)
+            if handle is not None and handle != recorded.get(family):
+                self.db.set_job(family, state, handle)
+                recorded[family] = handle
+
+    def resume_family(self, stage, family, outputs, submit):
+        """
+        Submit again the job of a family of the database (family: row) not submitted by this run, if the job
+        saved by the previous run isn't running and none of its output files (outputs, {family} replaced by
+        the family name) were written, return True if submitted again
+        """
+        name = family["family"]
+        if self.executor.get(stage, name) or (self.batch and name in self.batch):
+            return False
+        familydir = os.path.join(self.aligned_dir, name)
+        for output in outputs:
+            path = os.path.join(familydir, output.format(family=name))
+            if os.path.isfile(path) and os.path.getsize(path) != 0:
+                return False
+        if family["job"] and self.executor.alive(family["job"]):
+            return False
+        print(f"No {stage} job running for {name}, submitting it again")
+        submit(name, familydir)
+        self.db.set_job(name, family["state"], self.job_handle(stage, name))
+        return True
+
+    def batch_submitted(self, name, families):
+        """
+        Move the families of a liftover batch to the liftover stage once the batch is submitted
+        """
+        self.db.transitions(
+            [(family, ALIGNING, LIFTOVER, self.job_handle("liftover", family)) for family in families]
         )
+        self.liftover_events.wake()
+
+    def failed_jobs(self, stage, families):
+        """
+        Families whose job failed (e.g. submission error)
+        """
+        failed = set()
+        for family in families:
+            job = self.executor.get(stage, family)
+            if job and job.state == FAILED:
+                failed.add(family)
+        return failed
 
     def chunks(self, lst, n):
         """Yield successive n-sized chunks from lst."""
@@ -57,8 +182,13 @@ class alignments:
             print("Can't find pfamrc file")
             sys.exit()
 
-    def get_cluster_file(self, cluster_rep):
-        if cluster_rep[0:3] == "MGY":
+    def get_cluster_file(self, cluster_rep, familydir):
+        if self.archive:
+            # extract the cluster from the archive into the family directory
+            cluster_file = os.path.join(familydir, f"{cluster_rep}.fa")
+            self.archive.extract(cluster_rep, cluster_file)
+            return cluster_file
+        elif cluster_rep[0:3] == "MGY":
             return os.path.join(self.cluster_dir, f"{cluster_rep[0:8]}/{cluster_rep}.fa")
         else:
             return os.path.join(self.cluster_dir, f"{cluster_rep[0:3]}/{cluster_rep}.fa")
@@ -71,16 +201,24 @@ class alignments:
 
         return f"{cluster_align}{count}"
 
-    def get_alignment(self, count, line):
+    def prepare_family(self, count, line):
+        """
+        Return the line of the family in corresponding_clusters.txt and (family, cluster representative)
+        to add to the database, (None, None) if the family is skipped
+        """
         line = line.strip()
         cluster_rep = line.split("\t")[0]
 
-        cluster_file = self.get_cluster_file(cluster_rep)
         cluster_align = self.get_cluster_align(count)
-
-        familydir = os.path.join(self.aligned_dir, cluster_align)
         print(cluster_rep, cluster_align)
 
+        family = self.db.get(cluster_align)
+        if family is not None:
+            print(f"Family {cluster_align} ({cluster_rep}) ignored, {family['state']}")
+            return None, None
+
+        # families built before the database, or sorted by the curators
+        familydir = os.path.join(self.aligned_dir, cluster_align)
         donefamily = os.path.join(self.aligned_dir, f"DONE/{cluster_align}")
         donemfamily = os.path.join(self.aligned_dir, f"DONE_MERGED/{cluster_align}")
         ignorefamily = os.path.join(self.aligned_dir, f"IGNORE/{cluster_align}")
@@ -99,99 +237,281 @@ class alignments:
             and not os.path.isdir(failedfamily)
         ):
             text = f"{cluster_align}\t{line}\n"
-
-            # build good quality pfam family
-            os.makedirs(familydir, exist_ok=True)
-            os.chdir(familydir)
-            build_families.build_alignment(cluster_file, cluster_align)
-            self.server.rpush(self.queue_in, cluster_align)
-            os.chdir(self.scriptdir)
+            return text, (cluster_align, cluster_rep)
         else:
             print(
                 f"Family {cluster_align} ({cluster_rep}) ignored, processing or already processed"
             )
-            text = None
-        return text
+            return None, None
+
+    def align_family(self, family):
+        """
+        Create the family directory with the cluster sequences and build the alignment
+        (family: row of the database)
+        """
+        familydir = os.path.join(self.aligned_dir, family["family"])
+        os.makedirs(familydir, exist_ok=True)
+        cluster_file = self.get_cluster_file(family["cluster_rep"], familydir)
+        return family["family"], build_families.build_alignment(
+            cluster_file,
+            family["family"],
+            familydir,
+            self.executor,
+            self.cache,
+            self.batch,
+        )
+
+    def get_alignments(self, families, workers):
+        """
+        Build the alignments of the families with a pool of workers, each family is moved to
+        the liftover stage once its alignment is built
+        """
+        faileddir = os.path.join(self.aligned_dir, "FAILED")
+        try:
+            with ThreadPool(max(1, workers)) as pool:
+                for family, built in pool.imap_unordered(self.align_family, families):
+                    if built and self.batch and family in self.batch:
+                        # moved to the liftover stage once its batch is submitted (batch_submitted)
+                        continue
+                    elif built:
+                        self.db.transition(
+                            family, ALIGNING, LIFTOVER, self.job_handle("liftover", family)
+                        )
+                        self.liftover_events.wake()
+                    else:
+                        self.db.transition(family, ALIGNING, ALIGNMENT_FAILED)
+                        os.system(f"mv {os.path.join(self.aligned_dir, family)} {faileddir}")
+        finally:
+            if self.batch:
+                self.batch.flush()
+            # the liftover stage stops once its families are processed
+            self.alignments_done.set()
+            self.liftover_events.wake()
+
+    def new_families(self, watcher, pending, patterns, logname, *states, resume=None):
+        """
+        Add the families of the database in the states which aren't pending yet to the pending families
+        (family: [job_log, attempts]), watching their directory, return the families added
+        resume: function called with the database row of each family added (e.g. resume_family)
+        """
+        added = set()
+        for family in self.db.families(*states):
+            name = family["family"]
+            if name in pending:
+                continue
+            if resume:
+                resume(family)
+            familydir = os.path.join(self.aligned_dir, name)
+            pending[name] = [job_log(os.path.join(familydir, logname), patterns), family["attempts"]]
+            watcher.add(familydir)
+            added.add(name)
+        return added
 
     def wait_liftover(self):
         print("waiting for liftover to complete")
-        print(f"{self.server.llen(self.queue_in)} families to process")
+
+        # families whose liftover is running: [liftover.log, attempts]
+        pending = {}
+        # families: job saved in the database
+        recorded = {}
+        changed = set()
+        faileddir = os.path.join(self.aligned_dir, "FAILED")
+
+        def resume(family):
+            # the families of the previous run are lifted over one by one
+            self.resume_family(
+                "liftover",
+                family,
+                build_families.LIFTOVER_FILES + ("liftover.log",),
+                lambda name, familydir: build_families.submit_liftover(name, familydir, self.executor),
+            )
 
         while True:
-            family = self.server.lpop(self.queue_in)
-            if not family:
-                break
-            # print(family)
-
-            familydir = os.path.join(self.aligned_dir, family)
-            os.chdir(familydir)
-            faileddir = os.path.join(self.aligned_dir, "FAILED")
-
-            outfile = os.path.join(familydir, f"{family}_SEED.phmmer")
-            count = self.liftover_failed[family] if family in self.liftover_failed else 0
-            done = build_families.check_lift_over(family, outfile, count)
-
-            if done == False:  # liftover hasn't completed yet
-                self.server.rpush(self.queue_in, family)
-            elif done == True:  # liftover completed successfully
-                pf = subprocess.Popen(
-                    ["pfbuild", "-withpfmake", "SEED"],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                err = pf.communicate()[1].decode("utf-8")
-                if pf.returncode != 0:
-                    print(f"Error while running pfbuild: {err}")
-                    self.pfam_failed[family] = 1
-                    os.system(f"mv {familydir} {faileddir}")
+            changed |= self.new_families(
+                self.liftover_events,
+                pending,
+                build_families.LIFTOVER_ERRORS,
+                "liftover.log",
+                LIFTOVER,
+                resume=resume,
+            )
+            failed = self.failed_jobs("liftover", pending)
+            if self.batch:
+                # families of the failed batches lifted over one by one
+                for familydir in self.batch.failed_families():
+                    family = os.path.basename(familydir)
+                    print(f"Batch liftover failed for {family}, running its liftover")
+                    build_families.submit_liftover(family, familydir, self.executor)
+            # transitions saved together once the families are checked
+            transitions = []
+            # families checked again straight away
+            recheck = set()
+            for family in sorted(changed | failed):
+                familydir = os.path.join(self.aligned_dir, family)
+                outfile = os.path.join(familydir, f"{family}_SEED.phmmer")
+                log, attempts = pending[family]
+                if family in failed:  # liftover_alignment.pl failed
+                    print(f"Error while running the liftover of {family}")
+                    done = "failed"
                 else:
-                    self.server.rpush(self.queue_done, family)
-                    print(err)
-            elif done == "failed":  # tried but failed running liftover twice
-                self.liftover_failed[family] += 1
-                os.system(f"mv {familydir} {faileddir}")
-            else:  # tried but failed running liftover once, trying again
-                self.liftover_failed[family] = 1
-                self.server.rpush(self.queue_in, family)
-
-            time.sleep(0.2)
-        # print(f"All liftover completed" , {len(self.liftover_failed)} failed {self.liftover_failed.keys()}")
+                    done = build_families.check_lift_over(
+                        family, outfile, attempts - 1, familydir, log, self.executor, self.cache
+                    )
+
+                if done == False:  # liftover hasn't completed yet
+                    continue
+                elif done == True:  # liftover completed successfully
+                    # pfbuild submits its job, the pfbuild stage waits for it
+                    submit_pfbuild(family, familydir, self.executor, self.cache)
+                    transitions.append(
+                        (family, LIFTOVER, PFBUILD, self.job_handle("pfbuild", family))
+                    )
+                elif done == "failed":  # tried but failed running liftover twice
+                    transitions.append((family, LIFTOVER, LIFTOVER_FAILED, None))
+                    os.system(f"mv {familydir} {faileddir}")
+                else:  # tried but failed running liftover once, trying again
+                    pending[family][1] += 1
+                    transitions.append(
+                        (family, LIFTOVER, LIFTOVER, self.job_handle("liftover", family))
+                    )
+                    recheck.add(family)
+                    continue
+                self.liftover_events.remove(familydir)
+                del pending[family]
+
+            if transitions:
+                self.db.transitions(transitions)
+                self.pfbuild_events.wake()
+            self.record_jobs("liftover", LIFTOVER, pending, recorded)
+
+            if recheck:
+                changed = recheck
+            elif (
+                not pending
+                and self.alignments_done.is_set()
+                and not self.db.families(LIFTOVER)
+            ):
+                break
+            else:
+                # woken up by the files written in the family directories, or by new families
+                directories = self.liftover_events.wait()
+                changed = {
+                    family
+                    for family in pending
+                    if os.path.join(self.aligned_dir, family) in directories
+                }
+        self.liftover_done.set()
+        self.pfbuild_events.wake()
+
+    def complete_family(self, family):
+        """
+        Complete the DESC file of a family whose pfbuild is complete
+        """
+        familydir = os.path.join(self.aligned_dir, family)
+        steps = complete_desc(familydir, self.executor)
+        failed = [step for step, result in steps.items() if result["status"] != 0]
+        if failed:
+            print(f"DESC steps failed or skipped for {family}: {', '.join(failed)}")
+        self.db.transition(family, DESC, DONE)
+        print(f"Family {family} successfully built")
+        os.system(f"chmod -R g+w {familydir}")
 
     def wait_pfbuild(self):
         print("waiting for pfbuild to complete")
+        # the DESC files are completed by a pool of threads, the pfbuild stage goes on meanwhile
+        desc_pool = ThreadPool(max(1, self.desc_workers))
+        completing = []
+
+        # families interrupted while completing their DESC file
+        for family in self.db.families(DESC):
+            completing.append(desc_pool.apply_async(self.complete_family, (family["family"],)))
+
+        # families whose pfbuild is running: [pfbuild.log, attempts]
+        pending = {}
+        # families: job saved in the database
+        recorded = {}
+        changed = set()
+        faileddir = os.path.join(self.aligned_dir, "FAILED")
+
+        def resume(family):
+            self.resume_family(
+                "pfbuild",
+                family,
+                ("PFAMOUT", "pfbuild.log"),
+                lambda name, familydir: submit_pfbuild(name, familydir, self.executor, self.cache),
+            )
+
         while True:
-            if not self.server.llen(self.queue_in) and not self.server.llen(self.queue_done):
-                break
-            family = self.server.lpop(self.queue_done)
-            if not family:
-                time.sleep(0.2)
-                continue
-            # print(family)
-
-            self.server.rpush(self.pfam_in, family)
-            familydir = os.path.join(self.aligned_dir, family)
-            faileddir = os.path.join(self.aligned_dir, "FAILED")
-            os.chdir(familydir)
-            done = check_pfambuild()
-
-            if done == False:  # pfbuild hasn't completed yet
-                self.server.rpush(self.queue_done, family)
-            elif done == None:  # pfbuild failed to complete
-                if family not in self.pfam_failed:  # attempt to run pfbuild a second time
-                    os.remove("pfbuild.log")
-                    os.system("pfbuild -withpfmake SEED")
-                    self.server.rpush(self.queue_done, family)
-                    self.pfam_failed[family] = 1
+            changed |= self.new_families(
+                self.pfbuild_events, pending, PFBUILD_ERRORS, "pfbuild.log", PFBUILD, resume=resume
+            )
+            failed = self.failed_jobs("pfbuild", pending)
+            transitions = []
+            # families whose pfbuild is complete
+            complete = []
+            for family in sorted(changed | failed):
+                familydir = os.path.join(self.aligned_dir, family)
+                log, attempts = pending[family]
+                if family in failed:  # pfbuild couldn't submit its job
+                    print(f"Error while running pfbuild for {family}")
+                    done = "failed"
                 else:
-                    self.pfam_failed[family] += 1
-                    os.chdir(self.scriptdir)
+                    done = check_pfambuild(familydir, log)
+
+                finished = True
+                if done == "failed":
+                    transitions.append((family, PFBUILD, PFBUILD_FAILED, None))
                     os.system(f"mv {familydir} {faileddir}")
-            else:  # pfbuild completed successfully
-                complete_desc()
-                print(f"Family {family} successfully built")
-                os.chdir(self.scriptdir)
-                os.system(f"chmod -R g+w {familydir}")
-            self.server.lpop(self.pfam_in)
+                elif done == False:  # pfbuild hasn't completed yet
+                    finished = False
+                elif done == None:  # pfbuild failed to complete
+                    if attempts < 2:  # attempt to run pfbuild a second time
+                        os.remove(os.path.join(familydir, "pfbuild.log"))
+                        log.reset()
+                        submit_pfbuild(family, familydir, self.executor, self.cache)
+                        pending[family][1] += 1
+                        transitions.append(
+                            (family, PFBUILD, PFBUILD, self.job_handle("pfbuild", family))
+                        )
+                        finished = False
+                    else:
+                        self.executor.finish("pfbuild", family, success=False)
+                        transitions.append((family, PFBUILD, PFBUILD_FAILED, None))
+                        os.system(f"mv {familydir} {faileddir}")
+                else:  # pfbuild completed successfully
+                    self.executor.finish("pfbuild", family)
+                    store_pfbuild(family, familydir, self.cache)
+                    transitions.append((family, PFBUILD, DESC, None))
+                    complete.append(family)
+                if finished:
+                    self.pfbuild_events.remove(familydir)
+                    del pending[family]
+
+            if transitions:
+                self.db.transitions(transitions)
+            self.record_jobs("pfbuild", PFBUILD, pending, recorded)
+            for family in complete:
+                completing.append(desc_pool.apply_async(self.complete_family, (family,)))
+
+            if (
+                not pending
+                and self.liftover_done.is_set()
+                and not self.db.families(PFBUILD)
+            ):
+                break
+            # woken up by the files written in the family directories, or by new families
+            directories = self.pfbuild_events.wait()
+            changed = {
+                family
+                for family in pending
+                if os.path.join(self.aligned_dir, family) in directories
+            }
+
+        desc_pool.close()
+        desc_pool.join()
+        for result in completing:
+            # errors raised while completing a DESC file
+            result.get()
 
 
 # verify input parameters are given
@@ -226,9 +546,63 @@ if __name__ == "__main__":
         help="Number of clusters to process (default=100)",
         default=100,
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of alignments built, and of DESC files completed, at the same time (default=4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "-e",
+        "--executor",
+        help="where the liftover, pfbuild and DESC scripts are run (default=local)",
+        choices=EXECUTORS,
+        default="local",
+    )
+    parser.add_argument(
+        "-l",
+        "--limits",
+        help="maximum number of jobs running per stage (e.g. liftover=20 pfbuild=10 desc=4)",
+        nargs="+",
+    )
+    parser.add_argument("--bsub_options", help="options given to bsub with the lsf executor", default="")
+    parser.add_argument(
+        "-c",
+        "--cache",
+        help="directory of the cache of the alignment, liftover and pfbuild files (default=artefact_cache next to the input file)",
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="maximum size of the cache in GB, 0 to disable it (default=100)",
+        type=float,
+        default=100,
+    )
+    parser.add_argument(
+        "--pfamseq_version",
+        help="version of pfamseq in the cache keys (default: path, size and date of pfamseq in $PFAM_CONFIG)",
+    )
+    parser.add_argument(
+        "--batch_liftover",
+        help="search command lifting over a batch of families ({input}: Stockholm file with the SEED alignment of each family, {output}: Stockholm file with the hits of each family, see batch_liftover.py)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="number of families per batch with --batch_liftover (default=20)",
+        type=int,
+        default=20,
+    )
 
     args = parser.parse_args()
-    # clusters_to_align_file=mgy_seqs.cluster_seq.fa_percent_mgnify_2+_no_pfam_sorted
+    try:
+        limits = parse_limits(args.limits)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.batch_liftover and (
+        "{input}" not in args.batch_liftover or "{output}" not in args.batch_liftover
+    ):
+        parser.error("--batch_liftover expects a command with {input} and {output}")
+    # clusters_to_align_file=mgy_seqs.cluster.tsv_percent_mgnify_2+_no_pfam (sorted by get_stats.py)
 
     al = alignments()
     al.folder = args.folder_name
@@ -236,6 +610,24 @@ if __name__ == "__main__":
     al.aligned_dir = os.path.join(al.datadir, args.folder_name)
     # al.aligned_dir = os.path.join(al.datadir, "Pfam-M_test")
     al.cluster_dir = os.path.join(al.datadir, "clusters")
+    if archive_exists(al.cluster_dir):
+        print(f"Reading clusters from archive {al.cluster_dir}.dat")
+        al.archive = cluster_archive(al.cluster_dir)
+
+    if args.cache_size > 0:
+        # the liftover and pfbuild files depend on the pfamseq release
+        pfamseq = args.pfamseq_version or pfamseq_version()
+        if not pfamseq:
+            parser.error(
+                "pfamseq not found in $PFAM_CONFIG, give its version with --pfamseq_version "
+                "or disable the cache with --cache_size 0"
+            )
+        # kept out of the output folder, which is deleted with -d
+        al.cache = artefact_cache(
+            args.cache or os.path.join(al.datadir, "artefact_cache"),
+            int(args.cache_size * 1024 ** 3),
+            pfamseq,
+        )
 
     pfam_m_names = os.path.join(al.datadir, "corresponding_clusters.txt")
     # pfam_m_names = os.path.join(al.datadir, "corresponding_clusters_test.txt")
@@ -257,6 +649,29 @@ if __name__ == "__main__":
 
     print(al.aligned_dir)
     os.makedirs(al.aligned_dir, exist_ok=True)
+    # failed families are moved there
+    os.makedirs(os.path.join(al.aligned_dir, "FAILED"), exist_ok=True)
+    al.db = family_db(get_database(al.aligned_dir))
+    started = time.time()
+
+    if args.executor == "lsf":
+        al.set_executor(
+            EXECUTORS["lsf"](
+                limits, os.path.join(al.aligned_dir, ".jobs"), args.bsub_options.split()
+            )
+        )
+    else:
+        al.set_executor(EXECUTORS[args.executor](limits))
+    al.desc_workers = args.workers
+
+    if args.batch_liftover:
+        al.batch = liftover_batch(
+            al.executor,
+            args.batch_liftover,
+            max(1, args.batch_size),
+            os.path.join(al.aligned_dir, ".liftover_batches"),
+            al.batch_submitted,
+        )
 
     print("Starting clusters alignments")
     count = int(args.begin_count)
@@ -273,34 +688,42 @@ if __name__ == "__main__":
             else:
                 pf.write("pf_id\tcluster_rep\tnb_seq\tperecent_swissprot\n")
 
+        new_families = []
         tmp_count = 0  # used if do not want to start building from first cluster
         for line in f:
             tmp_count += 1
             if tmp_count >= count:  # start building from given file line
                 if count <= final_cluster:
-                    text = al.get_alignment(count, line)
+                    text, family = al.prepare_family(count, line)
                     if text != None:
                         pf.write(text)
+                        new_families.append(family)
                     count += 1
                 else:
                     break
             else:
                 pass
 
-    liftover_failed = dict()
-    liftover = Process(target=al.wait_liftover())
+    al.db.add(new_families)
+    # families whose alignment was interrupted are built again, the other families in progress
+    # are resumed by the liftover and pfbuild stages
+    families = al.db.families(ALIGNING)
+    print(f"{len(families)} alignments to build ({len(new_families)} new families)")
+
+    # the liftover and pfbuild stages process the families while the other alignments are built
+    liftover = threading.Thread(target=al.wait_liftover)
     liftover.start()
 
-    pfam_failed = dict()
-    pfambuild = Process(target=al.wait_pfbuild())
+    pfambuild = threading.Thread(target=al.wait_pfbuild)
     pfambuild.start()
 
+    al.get_alignments(families, args.workers)
+
     liftover.join()
     pfambuild.join()
+    al.executor.close()
 
-    os.chdir(al.scriptdir)
-
-    logfile = "generate_alignments.log"
+    logfile = os.path.join(al.scriptdir, "generate_alignments.log")
 
     with open(logfile, "a") as log:
         logtime = {time.strftime("%d %b %Y %H:%M", time.localtime())}
@@ -308,13 +731,18 @@ if __name__ == "__main__":
         print(f"Pfam building done, {args.number_to_process} clusters processed")
         log.write(f"Pfam building done, {args.number_to_process} clusters processed\n")
 
-        if len(al.liftover_failed) > 0:
-            print(
-                f"{len(al.liftover_failed)} failed liftover: {' '.join(al.liftover_failed.keys())}"
-            )
-            log.write(
-                f"{len(al.liftover_failed)} failed liftover: {' '.join(al.liftover_failed.keys())}\n"
-            )
-        if len(al.pfam_failed) > 0:
-            print(f"{len(al.pfam_failed)} failed pfbuild: {' '.join(al.pfam_failed.keys())}")
-            log.write(f"{len(al.pfam_failed)} failed pfbuild: {' '.join(al.pfam_failed.keys())}\n")
+        for state, stage in (
+            (ALIGNMENT_FAILED, "alignment"),
+            (LIFTOVER_FAILED, "liftover"),
+            (PFBUILD_FAILED, "pfbuild"),
+        ):
+            # families failed during this run
+            failed = [f["family"] for f in al.db.families(state) if f["updated"] >= started]
+            if len(failed) > 0:
+                print(f"{len(failed)} failed {stage}: {' '.join(failed)}")
+                log.write(f"{len(failed)} failed {stage}: {' '.join(failed)}\n")
+
+        for stage, counts in al.executor.summary().items():
+            states = ", ".join(f"{count} {state.lower()}" for state, count in counts.items() if count)
+            print(f"{stage} jobs: {states}")
+            log.write(f"{stage} jobs: {states}\n")
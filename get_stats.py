@@ -5,35 +5,158 @@
 
 @brief This script split the clusters into multiple files 
         and counts the number of sequences per cluster and the percentage of MGnify and SwissProt sequences
+        The top clusters (by size by default) are selected over the whole file and written ranked
 
 @arguments [-i inputfile]: file countaining clustered sequences (fasta)
             [-f proteinfile]: file countaining the list of proteins not found in the Pfam database (can be empty or non existing)
             [-u username]: username for database connection
             [-p password]: password for database connection
             [-s schema]: schema for database connection (VIPREAD)
+            [-w workers]: number of processes computing the statistics (default=1)
+            [-t]: two-phase mode, save a summary of the headers of all clusters (inputfile_summary)
+                  then only read the sequences of the selected clusters
+            [-c]: save the statistics of every cluster (counts, Pfam status, sequence lengths, MGnify partial classes)
+                  in a columnar table (<inputfile>_table, see cluster_table.py), and select the clusters from it
+            [-e]: only save the statistics table (with -c), no cluster is selected
+            [-k top]: number of clusters to select (default=10000)
+            [-r score]: criterion used to rank the clusters: size, mgnify or swissprot percentage (default=size)
+            [-a]: save the clusters in clusters.dat with the offsets in clusters.index instead of one file per cluster
+            [-j db_threads]: number of accession ranges fetched concurrently from the database (default=1),
+                             the list of proteins is then cached with the UniProt and Pfam versions and updated if outdated
+            [-d i/N]: shard mode, only process the clusters found in the i-th Nth of the cluster file
+                      the statistics are saved in <inputfile>_percent_mgnify_2+_no_pfam.shard_<i>_of_<N>
+            [-m N]: merge the statistics of the N shards, and save the selected clusters
+            [-o]: only get the list of proteins not in Pfam and its index
+            [-x database]: MMseqs2 sequence database (e.g. mgy_seqs.mmseqs), the input file is then the cluster table
+                           created by mmseqs createtsv ($DB.cluster.tsv): the statistics are computed from the accessions
+                           and only the sequences of the selected clusters are read from the database
+                           (the sequences of all the clusters with -c, for the lengths and partial classes)
+            [-b store [store ...]]: sequence stores (e.g. uniprotkb_<version>.bgz <MGnify version>_clear.bgz, see
+                                    sequence_store.py) the sequences of the selected clusters are read from,
+                                    instead of the MMseqs2 database (with -x)
+            [-y swissprotfile]: file containing the list of SwissProt accessions, used with -x as the cluster table
+                                doesn't tell SwissProt and TrEMBL accessions apart
+            [-v previous_summaryfile]: incremental mode (with -t), summary of the clusters of the previous release
+                                       (e.g. <previous SUBDIR>/mgy_seqs.cluster.tsv_summary), the statistics of the
+                                       clusters with the same members are reused (see cluster_state.py)
+            [-g dupsfile]: duplicates of the clustered sequences (<fasta>.dups, see dedup_sequences.py),
+                           counted and saved with the members they were removed for
            
 """
 import argparse
 import os
 import sys
-import re
-import cx_Oracle
 import traceback
 
-from multiprocessing.dummy import Pool
-import itertools
+from multiprocessing import Pool
+from collections import deque, namedtuple
+import heapq
+import statistics
+
+from cluster_reader import cluster_reader
+from cluster_tsv import tsv_reader, tsv_record
+from mmseqs_db import mmseqs_db
+from sequence_store import store_group
+from dedup_sequences import duplicate_index
+from cluster_state import (
+    cluster_state_writer,
+    get_state_file,
+    load_previous_state,
+    membership_digest,
+    merge_states,
+)
+from cluster_archive import cluster_archive_writer
+from cluster_table import cluster_table, cluster_table_writer
+from proteins_not_in_pfam import oracle_database, protein_cache
+from accession_index import accession_index, accession_index_writer, build_index, get_index_file
+
+
+MGNIFY = "mgnify"
+SWISSPROT = "swissprot"
+TREMBL = "trembl"
+
+cluster_summary = namedtuple(
+    "cluster_summary",
+    ["rep", "start", "end", "members", "mgnify", "swissprot", "trembl", "inpfam"],
+)
+
+
+def parse_header(header):
+    """
+    Return the source database and the accession of a cluster member
+    """
+    if header.startswith(b">sp"):
+        return SWISSPROT, header.split(b"|")[1]
+    elif header.startswith(b">MGY"):
+        return MGNIFY, header.split(b">")[1].split(b" ")[0]
+    else:
+        return TREMBL, header.split(b"|")[1]
+
+
+def parse_identifier(identifier, swissprot=None):
+    """
+    Return the source database and the accession of a cluster member identifier (cluster table),
+    MMseqs2 identifiers only keep the accession of the UniProt headers
+    """
+    if identifier.startswith(b"MGY"):
+        return MGNIFY, identifier
+    elif b"|" in identifier:
+        return parse_header(b">" + identifier)
+    elif swissprot is not None and identifier in swissprot:
+        return SWISSPROT, identifier
+    else:
+        return TREMBL, identifier
+
+
+def load_accession_index(accessionfile):
+    """
+    Index of a list of accessions, built from accessionfile if missing or older than the list
+    """
+    indexfile = get_index_file(accessionfile)
+    if not os.path.isfile(indexfile) or os.path.getmtime(indexfile) < os.path.getmtime(
+        accessionfile
+    ):
+        print(f"Building {os.path.basename(accessionfile)} accessions index")
+        with open(accessionfile, "r") as f:
+            build_index((line.strip("\n") for line in f if line.strip("\n")), indexfile)
+    return accession_index(indexfile)
+
+
+def summary_statistics(summary):
+    """
+    Same selection and statistics as process_cluster.get_statistics, from a cluster summary
+    """
+    if summary.inpfam == 0 and summary.members > 1:
+        percentmgy = round(summary.mgnify * 100 / summary.members, 2)
+        percentswiss = round(summary.swissprot * 100 / summary.members, 2)
+        if percentmgy < 100.0 and percentmgy > 0.0:
+            return summary.rep, summary.members, percentmgy, percentswiss
 
 
 class process_cluster:
     def __init__(self, inputfile):
+        # accessions of the UniProt proteins not found in Pfam (accession_index)
         self.protein_dict = {}
+        # accessions of the SwissProt proteins (accession_index), for the cluster table
+        self.swissprot = None
+        # duplicates of the clustered sequences (duplicate_index)
+        self.duplicates = None
+        # statistics of the previous release (cluster_state), for the incremental mode
+        self.previous = None
+        # MMseqs2 database or sequence stores (store_group) the members of the cluster table are read from,
+        # for the statistics table
+        self.sequence_db = None
         self.dirname = inputfile
         self.clusterdir = os.path.join(inputfile, "clusters")
+        # cluster_archive_writer if the clusters are saved in a packed archive
+        self.archive = None
 
     def getConnection(self, user, password, schema):
         """
         Set database connection
         """
+        import cx_Oracle
+
         print("Connection to the database")
         connectString = "".join([user, "/", password, "@", schema])
         connection = cursor = None
@@ -57,6 +180,12 @@ class process_cluster:
 
         return connection, cursor
 
+    def __getstate__(self):
+        # the clusters are only saved by the main process, the archive isn't sent to the workers
+        state = self.__dict__.copy()
+        state["archive"] = None
+        return state
+
     def get_proteins_not_in_pfam(self, user, password, schema, proteinfile):
         connection, cursor = self.getConnection(user, password, schema)
 
@@ -67,57 +196,134 @@ class process_cluster:
             """
 
         cursor.execute(sql)
-        self.protein_dict = [row[0] for row in cursor]
-        # print(protein_dict)
-        with open(proteinfile, "w") as f:
-            for protein in self.protein_dict:
-                f.write(f"{str(protein)}\n")
+        # accessions are written to the list and to the index as they are fetched
+        with accession_index_writer(get_index_file(proteinfile)) as writer:
+            with open(proteinfile, "w") as f:
+                for row in cursor:
+                    protein = str(row[0])
+                    f.write(f"{protein}\n")
+                    writer.add(protein)
 
         cursor.close()
         connection.close()
 
-    def cluster_separator(self, line):
-        if re.match(r"^>[A-Z0-9]+$", line):
-            return line
+    def load_proteins_not_in_pfam(self, proteinfile):
+        """
+        Load the index of accessions not found in Pfam, built from proteinfile if missing
+        """
+        self.protein_dict = load_accession_index(proteinfile)
+
+    def load_swissprot(self, swissprotfile):
+        self.swissprot = load_accession_index(swissprotfile)
+
+    def load_duplicates(self, dupsfile):
+        self.duplicates = duplicate_index(dupsfile)
+
+    def member_accessions(self, record):
+        """
+        Accessions of the members of a cluster (without their duplicates)
+        """
+        if isinstance(record, tsv_record):
+            return [parse_identifier(i)[1] for i in record.identifiers]
+        return [parse_header(header)[1] for _, header in record.headers]
 
-    def process(self, chunk):
+    def previous_summary(self, record, accessions, digest):
+        """
+        Summary of a cluster with the same members (membership digest) in the previous release,
+        None if the cluster is new or if one of its members changed in the accession lists
+        """
+        previous = self.previous.get(digest)
+        if previous is None:
+            return None
+        if self.previous.is_changed(accessions):
+            return None
+        return cluster_summary(accessions[0].decode("utf-8"), record.start, record.end, *previous)
+
+    def get_sources(self, record):
+        """
+        Yield (source, accession) for each member of a cluster (cluster file or cluster table)
+        """
+        if isinstance(record, tsv_record):
+            sources = (parse_identifier(i, self.swissprot) for i in record.identifiers)
+        else:
+            sources = (parse_header(header) for _, header in record.headers)
+        for source, acc in sources:
+            yield source, acc
+            if self.duplicates:
+                for duplicate in self.duplicates.get(acc):
+                    yield parse_header(b">" + duplicate)
+
+    def expand(self, members):
+        """
+        Yield (header, sequence) for each member and its duplicates (identical sequences removed
+        before the clustering, see dedup_sequences.py)
+        """
+        for header, sequence in members:
+            yield header, sequence
+            if self.duplicates:
+                for duplicate in self.duplicates.get(parse_header(header)[1]):
+                    yield b">" + duplicate, sequence
+
+    def format_header(self, header):
+        """
+        Remove the UniProt database prefix and separators from a member header
+        """
+        if header.startswith(b">sp"):
+            header = header.replace(b"sp|", b"")
+        elif not header.startswith(b">MGY"):
+            header = header.replace(b"tr|", b"")
+        return header.replace(b"|", b" ")
+
+    def format_cluster(self, record):
+        """
+        Content of the cluster file, built from the record body
+        """
+        content = [record.buffer[record.body_start : record.headers[0][0]]]
+        for header, sequence in self.expand(record.members()):
+            content.append(self.format_header(header))
+            content.append(sequence)
+        return b"".join(content)
+
+    def format_members(self, members):
+        """
+        Content of the cluster file, built from the (header, sequence) of the members
+        read from the MMseqs2 database or the sequence stores
+        """
+        content = []
+        for header, sequence in self.expand((b">" + h, s) for h, s in members):
+            content.append(self.format_header(header))
+            content.append(sequence)
+        return b"".join(content)
+
+    def get_statistics(self, record):
+        """
+        Return (rep, count_total, percentmgy, percentswiss) for clusters not found in Pfam,
+        with at least 2 sequences and containing both UniProt and MGnify sequences, None otherwise
+        """
         inpfam = 0
         countswiss = 0
         countmgy = 0
         count_total = 0
-        content = ""
         rep = ""
-        counting = ""
 
-        for item in chunk:
+        for source, acc in self.get_sources(record):
             skip = False
-            if re.match(r"^>", item):
-                if re.match(r">sp", item):  # seq from SwissProt
-                    countswiss += 1
-                    acc = item.split("|")[1]
-                    item = item.replace("sp|", "")
-                elif re.match(r">MGY", item):  # seq from MGnify
-                    countmgy += 1
-                    acc = item.split(">")[1].split(" ")[0]
-                    skip = True
-                else:  # seq from TrEMBL
-                    acc = item.split("|")[1]
-                    item = item.replace("tr|", "")
-
-                # print(acc)
-
-                if not skip and acc not in self.protein_dict:
-                    inpfam += 1
-                    break
+            if source == SWISSPROT:  # seq from SwissProt
+                countswiss += 1
+            elif source == MGNIFY:  # seq from MGnify
+                countmgy += 1
+                skip = True
+
+            if not skip and acc not in self.protein_dict:
+                inpfam += 1
+                break
 
-                # total number of seq
-                count_total += 1
+            # total number of seq
+            count_total += 1
 
-                # update rep to new representative accession
-                if count_total == 1:
-                    rep = acc
-                item = item.replace("|", " ")
-            content += item
+            # update rep to new representative accession
+            if count_total == 1:
+                rep = acc.decode("utf-8")
 
         # for clusters not found in Pfam and with at least 2 sequences
         if inpfam == 0 and count_total > 1:
@@ -128,20 +334,343 @@ class process_cluster:
             # generate % SwissProt sequences found in cluster
             percentswiss = round(countswiss * 100 / count_total, 2)
 
-            # create sub directories to save clusters files if at least 1 UniProt seq and 1 mgnify seq
+            # keep clusters with at least 1 UniProt seq and 1 mgnify seq
             if percentmgy < 100.0 and percentmgy > 0.0:
-                if rep[0:3] == "MGY":
-                    subdir = os.path.join(self.clusterdir, rep[0:8])
-                else:
-                    subdir = os.path.join(self.clusterdir, rep[0:3])
-                os.makedirs(subdir, exist_ok=True)
+                return rep, count_total, percentmgy, percentswiss
+
+    def summarise(self, record):
+        """
+        Header summary of a cluster: span in the file, number of sequences per source and Pfam status
+        (1 if at least one UniProt sequence is found in Pfam)
+        """
+        counts = {MGNIFY: 0, SWISSPROT: 0, TREMBL: 0}
+        inpfam = 0
+        rep = ""
+        for i, (source, acc) in enumerate(self.get_sources(record)):
+            counts[source] += 1
+            if i == 0:
+                rep = acc.decode("utf-8")
+            if not inpfam and source != MGNIFY and acc not in self.protein_dict:
+                inpfam = 1
+
+        return cluster_summary(
+            rep,
+            record.start,
+            record.end,
+            sum(counts.values()),
+            counts[MGNIFY],
+            counts[SWISSPROT],
+            counts[TREMBL],
+            inpfam,
+        )
+
+    def describe(self, record, sequences=None):
+        """
+        Row of the clusters statistics table (see cluster_table.COLUMNS)
+        sequences: {identifier: (header, sequence)} of the members of a cluster of the cluster table,
+        read from the MMseqs2 database or the sequence stores
+        """
+        summary = self.summarise(record)
+        if isinstance(record, tsv_record):
+            if any(i not in sequences for i in record.identifiers):
+                raise KeyError(
+                    f"Sequences of cluster {summary.rep} not found in {self.sequence_db.database}"
+                )
+            members = ((b">" + sequences[i][0], sequences[i][1]) for i in record.identifiers)
+        else:
+            members = record.members()
+        lengths = []
+        partial_classes = set()
+        for header, sequence in self.expand(members):
+            lengths.append(len(sequence) - sequence.count(b"\n"))
+            if header.startswith(b">MGY"):
+                pos = header.find(b" PL=")
+                if pos != -1:
+                    partial_classes.add(header[pos + 4 : pos + 6])
+
+        return (
+            summary.rep.encode("utf-8"),
+            summary.start,
+            summary.end,
+            summary.members,
+            summary.mgnify,
+            summary.swissprot,
+            summary.trembl,
+            summary.inpfam,
+            lengths[0],
+            min(lengths),
+            max(lengths),
+            statistics.median(lengths),
+            len(partial_classes),
+        )
+
+    def save_cluster(self, rep, content):
+        """
+        Write the cluster sequences in clusters/<MGYPxxxx>/ or clusters/<A0A>/,
+        or in the clusters archive
+        """
+        if self.archive:
+            self.archive.add(rep, content)
+            return
+
+        if rep[0:3] == "MGY":
+            subdir = os.path.join(self.clusterdir, rep[0:8])
+        else:
+            subdir = os.path.join(self.clusterdir, rep[0:3])
+        os.makedirs(subdir, exist_ok=True)
+
+        with open(os.path.join(subdir, f"{rep}.fa"), "wb") as clusterf:
+            clusterf.write(content)
+
 
-                # save clusters in different files
-                with open(os.path.join(subdir, f"{rep}.fa"), "w") as clusterf:
-                    clusterf.write(content)
+def is_outdated(filename, dependencies):
+    """
+    Return True if filename is missing or older than one of its dependencies
+    """
+    if not os.path.isfile(filename):
+        return True
+    mtime = os.path.getmtime(filename)
+    return any(os.path.getmtime(dep) > mtime for dep in dependencies if os.path.exists(dep))
 
-                counting = f"{rep}\t{count_total}\t{percentmgy}\t{percentswiss}\n"
-                return counting
+
+# state of the worker processes, set by init_worker
+worker_pc = None
+worker_reader = None
+
+
+def init_worker(pc, reader_class, inputfile):
+    global worker_pc, worker_reader
+    worker_pc = pc
+    worker_reader = reader_class(inputfile).open()
+
+
+def process_batch(span):
+    """
+    Compute the statistics of the clusters found in the byte range span (run by the workers)
+    The clusters files are written by the main process, the span of each cluster is returned
+    """
+    results = []
+    for record in worker_reader.records(*span):
+        stats = worker_pc.get_statistics(record)
+        if stats:
+            results.append((stats, record.start, record.end))
+    return results
+
+
+def summarise_batch(span):
+    """
+    Header summaries and membership digests of the clusters found in the byte range span
+    (run by the workers), the summaries of the previous release are reused when possible
+    Return (summaries, digests, number of summaries reused)
+    """
+    summaries, digests = [], []
+    reused = 0
+    for record in worker_reader.records(*span):
+        accessions = worker_pc.member_accessions(record)
+        digest = membership_digest(accessions)
+        summary = None
+        if worker_pc.previous:
+            summary = worker_pc.previous_summary(record, accessions, digest)
+            reused += summary is not None
+        summaries.append(summary or worker_pc.summarise(record))
+        digests.append(digest)
+    return summaries, digests, reused
+
+
+def describe_batch(span):
+    """
+    Rows of the clusters statistics table for the clusters found in the byte range span
+    The sequences of the clusters of a cluster table are read at once for the batch
+    """
+    records = list(worker_reader.records(*span))
+    sequences = None
+    if worker_pc.sequence_db is not None:
+        sequences = worker_pc.sequence_db.fetch(
+            identifier for record in records for identifier in record.identifiers
+        )
+    return [worker_pc.describe(record, sequences) for record in records]
+
+
+def map_batches(function, pc, reader, workers, batch_size, start=0, stop=None):
+    """
+    Yield function(span) for each batch of clusters of the file (or between start and stop),
+    in file order
+    Batches are sent to a pool of workers, with at most 2 batches per worker waiting
+    """
+    if workers <= 1:
+        init_worker(pc, type(reader), reader.inputfile)
+        for span in reader.batches(batch_size, start, stop):
+            yield function(span)
+        return
+
+    initargs = (pc, type(reader), reader.inputfile)
+    with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+        pending = deque()
+        batches = reader.batches(batch_size, start, stop)
+        while True:
+            while len(pending) < 2 * workers:
+                span = next(batches, None)
+                if span is None:
+                    break
+                pending.append(pool.apply_async(function, (span,)))
+            if not pending:
+                break
+            yield pending.popleft().get()
+
+
+def iter_candidates(pc, reader, workers, start=0, stop=None, batch_size=32 * 1024 * 1024):
+    """
+    Yield (stats, start, end) for the clusters passing the selection, in file order
+    """
+    for results in map_batches(process_batch, pc, reader, workers, batch_size, start, stop):
+        yield from results
+
+
+def write_summaries(
+    pc, reader, summaryfile, workers, start=0, stop=None, batch_size=32 * 1024 * 1024, lists=None
+):
+    """
+    Two-phase mode, phase one: scan the headers only and save the summary of every cluster
+    The statistics are also saved with the membership digests (see cluster_state.py),
+    for the next release
+    """
+    tmpfile = f"{summaryfile}.tmp"
+    reused = total = 0
+    with open(tmpfile, "w") as output, cluster_state_writer(
+        get_state_file(summaryfile), lists or {}
+    ) as state:
+        batches = map_batches(summarise_batch, pc, reader, workers, batch_size, start, stop)
+        for summaries, digests, batch_reused in batches:
+            for summary in summaries:
+                output.write("\t".join(map(str, summary)) + "\n")
+            state.append(digests, summaries)
+            reused += batch_reused
+            total += len(summaries)
+    os.replace(tmpfile, summaryfile)
+    if pc.previous:
+        print(f"{reused} clusters unchanged since the previous release, {total - reused} computed")
+
+
+def read_summaries(summaryfile):
+    with open(summaryfile, "r") as f:
+        for line in f:
+            rep, *values = line.rstrip("\n").split("\t")
+            yield cluster_summary(rep, *map(int, values))
+
+
+def write_table(pc, reader, tabledir, workers, start=0, stop=None, batch_size=32 * 1024 * 1024):
+    """
+    Save the statistics of every cluster in a columnar table (see cluster_table.py)
+    """
+    with cluster_table_writer(tabledir) as writer:
+        for rows in map_batches(describe_batch, pc, reader, workers, batch_size, start, stop):
+            writer.append(rows)
+
+
+def iter_table_candidates(tabledir, top, score="size"):
+    """
+    Yield (stats, start, end) for the top clusters of the table, selected with vectorised filters
+    """
+    table = cluster_table(tabledir)
+    for i in table.top(top, score):
+        summary = cluster_summary(
+            table["rep"][i].decode("utf-8"),
+            *(int(table[name][i]) for name in cluster_summary._fields[1:]),
+        )
+        stats = summary_statistics(summary)
+        if stats:
+            yield stats, summary.start, summary.end
+
+
+def iter_summary_candidates(summaryfile):
+    """
+    Two-phase mode, phase two: yield (stats, start, end) for the clusters passing the selection
+    """
+    for summary in read_summaries(summaryfile):
+        stats = summary_statistics(summary)
+        if stats:
+            yield stats, summary.start, summary.end
+
+
+# ranking keys of the clusters statistics (rep, count_total, percentmgy, percentswiss)
+SCORES = {
+    "size": lambda stats: (stats[1],),
+    "mgnify": lambda stats: (stats[2], stats[1]),
+    "swissprot": lambda stats: (stats[3], stats[1]),
+}
+
+
+def select_top(candidates, top, score="size"):
+    """
+    Keep the top clusters according to score, streaming over all the candidates
+    Return the selected (stats, start, end) by decreasing score, ties in file order
+    """
+    if top <= 0:
+        return []
+    key = SCORES[score]
+    heap = []
+    for stats, start, end in candidates:
+        item = (key(stats), -start, stats, start, end)
+        if len(heap) < top:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    return [(stats, start, end) for _, _, stats, start, end in sorted(heap, reverse=True)]
+
+
+def get_partial_file(outputfile, i, n):
+    return f"{outputfile}.shard_{i}_of_{n}"
+
+
+def write_partial(selected, partialfile):
+    """
+    Shard mode: save the statistics and the span of the clusters selected in the shard
+    """
+    tmpfile = f"{partialfile}.tmp"
+    with open(tmpfile, "w") as output:
+        for (rep, count_total, percentmgy, percentswiss), start, end in selected:
+            output.write(f"{rep}\t{count_total}\t{percentmgy}\t{percentswiss}\t{start}\t{end}\n")
+    os.replace(tmpfile, partialfile)
+
+
+def read_partials(partialfiles):
+    """
+    Merge mode: yield (stats, start, end) for the clusters selected in each shard
+    """
+    for partialfile in partialfiles:
+        with open(partialfile, "r") as f:
+            for line in f:
+                rep, count_total, percentmgy, percentswiss, start, end = line.split("\t")
+                stats = (rep, int(count_total), float(percentmgy), float(percentswiss))
+                yield stats, int(start), int(end)
+
+
+def write_selected(pc, reader, selected, output, database=None):
+    """
+    Write the statistics of the selected clusters and save their sequences
+    With a cluster table, the sequences of all the selected clusters are read at once from the
+    MMseqs2 database or the sequence stores
+    """
+    records = [next(reader.records(start, end)) for _, start, end in selected]
+    if database:
+        print("Reading the selected clusters sequences")
+        sequences = database.fetch(
+            identifier for record in records for identifier in record.identifiers
+        )
+
+    for (stats, _, _), record in zip(selected, records):
+        rep, count_total, percentmgy, percentswiss = stats
+        if database:
+            if any(i not in sequences for i in record.identifiers):
+                raise KeyError(f"Sequences of cluster {rep} not found in {database.database}")
+            content = pc.format_members(sequences[i] for i in record.identifiers)
+        else:
+            # the sequences are only read at this point
+            content = pc.format_cluster(record)
+        pc.save_cluster(rep, content)
+        output.write(f"{rep}\t{count_total}\t{percentmgy}\t{percentswiss}\n")
+    return len(selected)
 
 
 if __name__ == "__main__":
@@ -159,47 +688,241 @@ if __name__ == "__main__":
     parser.add_argument("-u", "--user", help="username for database connection", required=True)
     parser.add_argument("-p", "--password", help="password for database connection", required=True)
     parser.add_argument("-s", "--schema", help="database schema to connect to", required=True)
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes computing the statistics (default=1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-t",
+        "--two_phase",
+        help="scan all the clusters headers first, then read the sequences of the selected clusters",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-c",
+        "--table",
+        help="save the statistics of every cluster in a columnar table, select the clusters from it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-e",
+        "--table_only",
+        help="only save the statistics table (with -c), no cluster is selected",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-k",
+        "--top",
+        help="number of clusters to select (default=10000)",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "-r",
+        "--score",
+        help="criterion used to rank the clusters (default=size)",
+        choices=sorted(SCORES),
+        default="size",
+    )
+    parser.add_argument(
+        "-a",
+        "--archive",
+        help="save the clusters in clusters.dat/clusters.index instead of clusters/",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--db_threads",
+        help="number of accession ranges fetched concurrently from the database (default=1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-d",
+        "--shard",
+        help="only process the shard i/N of the cluster file (i from 1 to N), save partial statistics",
+    )
+    parser.add_argument(
+        "-m",
+        "--merge",
+        help="merge the partial statistics of the N shards, and save the selected clusters",
+        type=int,
+    )
+    parser.add_argument(
+        "-o",
+        "--proteins_only",
+        help="only get the list of proteins not in Pfam and its index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-x",
+        "--mmseqs_db",
+        help="MMseqs2 sequence database, the input file is then the cluster table ($DB.cluster.tsv)",
+    )
+    parser.add_argument(
+        "-b",
+        "--sequence_store",
+        help="sequence stores (see sequence_store.py) the selected clusters are read from, instead of the MMseqs2 database (with -x)",
+        nargs="+",
+    )
+    parser.add_argument("-y", "--swissprotfile", help="file containing the SwissProt accessions")
+    parser.add_argument(
+        "-v",
+        "--previous",
+        help="summary of the clusters of the previous release, only changed clusters are computed (with -t)",
+    )
+    parser.add_argument(
+        "-g",
+        "--duplicates",
+        help="duplicates of the clustered sequences (<fasta>.dups, see dedup_sequences.py)",
+    )
     args = parser.parse_args()
 
-    pc = process_cluster(os.path.dirname(args.inputfile))
-    os.makedirs(pc.clusterdir, exist_ok=True)
+    if args.table_only and (not args.table or args.merge):
+        parser.error("The statistics table only (-e) is saved with -c, and not when merging shards (-m)")
+    if args.sequence_store and not args.mmseqs_db:
+        parser.error("Sequence stores (-b) are only used with a cluster table (-x)")
 
-    # get list of UniProt accessions not found in Pfam
-    if not os.path.isfile(args.proteinfile) or os.path.getsize(args.proteinfile) == 0:
-        pc.get_proteins_not_in_pfam(args.user, args.password, args.schema, args.proteinfile)
+    pc = process_cluster(os.path.dirname(args.inputfile))
+    outputfile = f"{args.inputfile}_percent_mgnify_2+_no_pfam"
+
+    shard = None
+    if args.shard:
+        shard = tuple(int(v) for v in args.shard.split("/"))
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            parser.error(f"Invalid shard {args.shard}, expected i/N with 1 <= i <= N")
+
+    if not args.merge:
+        # get list of UniProt accessions not found in Pfam
+        if args.db_threads > 1:
+            # check the cached list against the database versions, fetch the differences if needed
+            print("Checking proteins not matching Pfam in the database")
+            database = oracle_database(args.user, args.password, args.schema, args.db_threads)
+            protein_cache(database, args.proteinfile, args.db_threads).update()
+            database.close()
+        elif not os.path.isfile(args.proteinfile) or os.path.getsize(args.proteinfile) == 0:
+            pc.get_proteins_not_in_pfam(args.user, args.password, args.schema, args.proteinfile)
+        print("Loading proteins accessions index")
+        pc.load_proteins_not_in_pfam(args.proteinfile)
+        if args.mmseqs_db and args.swissprotfile:
+            pc.load_swissprot(args.swissprotfile)
+        elif args.mmseqs_db:
+            print("No SwissProt accessions given, all UniProt sequences are counted as TrEMBL")
+
+        if args.proteins_only:
+            sys.exit()
+
+    if args.duplicates:
+        pc.load_duplicates(args.duplicates)
+
+    # the statistics files depend on the accessions lists
+    dependencies = [args.inputfile, get_index_file(args.proteinfile)]
+    if args.mmseqs_db:
+        reader_class = tsv_reader
+        if args.sequence_store:
+            sequence_db = store_group(args.sequence_store)
+        else:
+            sequence_db = mmseqs_db(args.mmseqs_db)
+        if args.swissprotfile:
+            dependencies.append(get_index_file(args.swissprotfile))
     else:
-        print("Loading proteins accessions into memory")
-        with open(args.proteinfile, "r") as f:
-            pc.protein_dict = {line.strip("\n"): 1 for line in f}
-
-    print("Getting clusters' statistics")
+        reader_class = cluster_reader
+        sequence_db = None
+    if args.duplicates:
+        dependencies.append(args.duplicates)
+    # accession lists used for the statistics, compared with the lists of the next release
+    lists = {
+        "proteinfile": os.path.abspath(get_index_file(args.proteinfile)),
+        "swissprotfile": (
+            os.path.abspath(get_index_file(args.swissprotfile))
+            if args.mmseqs_db and args.swissprotfile
+            else None
+        ),
+        "duplicates": os.path.abspath(args.duplicates) if args.duplicates else None,
+    }
+
+    if args.table and args.mmseqs_db:
+        # the lengths and partial classes are computed from the sequences of all the clusters
+        pc.sequence_db = sequence_db
+
+    # clusters are only saved when the final selection is known
+    if not shard and not args.table_only:
+        if args.archive:
+            pc.archive = cluster_archive_writer(pc.clusterdir)
+        else:
+            os.makedirs(pc.clusterdir, exist_ok=True)
+
+    if args.merge:
+        partialfiles = [
+            get_partial_file(outputfile, i, args.merge) for i in range(1, args.merge + 1)
+        ]
+        missing = [f for f in partialfiles if not os.path.isfile(f)]
+        if missing:
+            print(f"Missing shards statistics: {' '.join(missing)}")
+            sys.exit(1)
+
+        print(f"Merging statistics of {args.merge} shards")
+        # the clusters statistics of the shards are kept together for the next release
+        summaryfile = f"{args.inputfile}_summary"
+        statefiles = [
+            get_state_file(get_partial_file(summaryfile, i, args.merge))
+            for i in range(1, args.merge + 1)
+        ]
+        if all(os.path.isfile(f) for f in statefiles):
+            merge_states(statefiles, get_state_file(summaryfile))
+        with reader_class(args.inputfile) as reader, open(outputfile, "w") as output:
+            selected = select_top(read_partials(partialfiles), args.top, args.score)
+            counter = write_selected(pc, reader, selected, output, sequence_db)
+        print(f"Clustering check done, {counter} clusters saved")
+
+    elif os.path.isfile(args.inputfile):
+        print("Getting clusters' statistics")
+
+        with reader_class(args.inputfile) as reader:
+            start, stop = reader.shard(*shard) if shard else (0, None)
+            if args.table:
+                tabledir = f"{args.inputfile}_table"
+                if shard:
+                    tabledir = get_partial_file(tabledir, *shard)
+                if is_outdated(os.path.join(tabledir, "meta.json"), dependencies):
+                    print("Computing clusters statistics table")
+                    write_table(pc, reader, tabledir, args.workers, start, stop)
+                else:
+                    print(f"Using clusters statistics table {tabledir}")
+                if args.table_only:
+                    sys.exit()
+                candidates = iter_table_candidates(tabledir, args.top, args.score)
+            elif args.two_phase:
+                summaryfile = f"{args.inputfile}_summary"
+                if shard:
+                    summaryfile = get_partial_file(summaryfile, *shard)
+                if is_outdated(summaryfile, dependencies):
+                    if args.previous:
+                        pc.previous = load_previous_state(
+                            args.previous, lists, f"{summaryfile}.changed.npy"
+                        )
+                    print("Scanning clusters headers")
+                    write_summaries(
+                        pc, reader, summaryfile, args.workers, start, stop, lists=lists
+                    )
+                else:
+                    print(f"Using clusters headers summary {summaryfile}")
+                candidates = iter_summary_candidates(summaryfile)
+            else:
+                candidates = iter_candidates(pc, reader, args.workers, start, stop)
 
-    num_chunks = 5
-    results = []
-    counter = 0
-
-    if os.path.isfile(args.inputfile):
-        with open(args.inputfile, "r") as inputf, open(
-            f"{args.inputfile}_percent_mgnify_2+_no_pfam", "w"
-        ) as output:
-            chunks = itertools.groupby(inputf, pc.cluster_separator)
-            try:
-                while True:
-                    groups = []
-                    for key, chunk in itertools.islice(chunks, num_chunks):
-                        if not key:
-                            groups.append(list(chunk))
-                    if groups:
-                        with Pool(5) as pool:
-                            for cluster in pool.imap(pc.process, groups):
-                                if cluster != None:
-                                    counter += 1
-                                    output.write(cluster)
-                                # end search if 10K clusters found
-                                if counter >= 10000:
-                                    raise ValueError("Stop!!!")
-                    else:
-                        break
-            except ValueError:
+            selected = select_top(candidates, args.top, args.score)
+            if shard:
+                partialfile = get_partial_file(outputfile, *shard)
+                write_partial(selected, partialfile)
+                print(f"Shard {args.shard} done, {len(selected)} clusters saved in {partialfile}")
+            else:
+                with open(outputfile, "w") as output:
+                    counter = write_selected(pc, reader, selected, output, sequence_db)
                 print(f"Clustering check done, {counter} clusters saved")
 
+    if pc.archive:
+        pc.archive.close()
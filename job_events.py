@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Wait for the jobs submitted by the Pfam scripts (liftover, pfbuild) without polling
+        directory_watcher: inotify watches on the family directories, woken up by the files written
+        by the jobs (outputs, LSF logs), or by wake() when new families are queued
+        Files written by other hosts on NFS don't raise inotify events, so the watched directories are
+        also checked every POLL_TIMEOUT seconds (the only way of waiting where inotify isn't available)
+        job_log: LSF log read incrementally from the last offset, so only the new lines are parsed
+
+"""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+WATCH_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# wd, mask, cookie, length of the name following the event
+EVENT_HEADER = struct.Struct("iIII")
+POLL_TIMEOUT = 30
+# last line written by LSF in the job output
+JOB_FINISHED = "Resource usage summary:\n"
+
+
+def load_inotify():
+    """
+    libc with the inotify functions, None if not available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class directory_watcher:
+    def __init__(self):
+        self.libc = load_inotify()
+        self.fd = None
+        if self.libc:
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            self.fd = fd if fd >= 0 else None
+        # watch descriptor: directory
+        self.directories = {}
+        # directory: watch descriptor (None without inotify)
+        self.watches = {}
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+
+    def add(self, directory):
+        wd = None
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_EVENTS)
+            if wd < 0:
+                wd = None
+            else:
+                self.directories[wd] = directory
+        self.watches[directory] = wd
+
+    def remove(self, directory):
+        wd = self.watches.pop(directory, None)
+        if wd is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            self.directories.pop(wd, None)
+
+    def wake(self):
+        """
+        Interrupt wait() (called from another thread)
+        """
+        os.write(self.wake_write, b"\0")
+
+    def read_events(self):
+        directories = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return directories
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + length
+                if wd in self.directories:
+                    directories.add(self.directories[wd])
+
+    def wait(self, timeout=POLL_TIMEOUT):
+        """
+        Wait for changes in the watched directories, return the directories changed,
+        all the watched directories after timeout seconds without event,
+        and no directory when woken up
+        """
+        fds = [self.wake_read] + ([self.fd] if self.fd is not None else [])
+        ready, _, _ = select.select(fds, [], [], timeout)
+        if not ready:
+            return set(self.watches)
+        directories = set()
+        if self.fd in ready:
+            directories = self.read_events()
+        if self.wake_read in ready:
+            try:
+                while os.read(self.wake_read, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        return directories
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+
+class job_log:
+    """
+    Log of an LSF job, read from the last offset: finished once the resource usage summary is written,
+    the lines matching one of the error patterns are kept
+    """
+
+    def __init__(self, logfile, patterns=()):
+        self.logfile = logfile
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.reset()
+
+    def reset(self):
+        """
+        Read the log from the start (e.g. log removed before running the job again)
+        """
+        self.offset = 0
+        self.partial = b""
+        self.finished = False
+        self.errors = []
+
+    def update(self):
+        """
+        Parse the lines written since the last update
+        """
+        try:
+            size = os.path.getsize(self.logfile)
+        except FileNotFoundError:
+            return
+        if size < self.offset:
+            # log written again
+            self.reset()
+        if size == self.offset:
+            return
+        with open(self.logfile, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        lines = (self.partial + data).split(b"\n")
+        # incomplete last line, parsed once complete
+        self.partial = lines.pop()
+        for line in lines:
+            text = line.decode("utf-8", "replace") + "\n"
+            if text == JOB_FINISHED:
+                self.finished = True
+            if any(pattern.search(text) for pattern in self.patterns):
+                self.errors.append(text)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Run the commands of the family building stages (liftover, pfbuild, DESC scripts) through an executor
+        Jobs are submitted by stage, with at most limits[stage] jobs of a stage running at the same time,
+        the other jobs are queued and started when a job of their stage ends
+        Job states: PENDING (queued), RUNNING, DONE, FAILED
+        Detached jobs are commands submitting their own farm job (liftover_alignment.pl, pfbuild): they keep
+        their slot once the command returned, until the stage marks them finished (finish())
+        Backends: local_executor (local processes), lsf_executor (job arrays submitted with bsub, each element
+        writing its exit status in the log directory), fake_executor (nothing run, for tests)
+        The job handles can be saved and checked by a later run (alive()): the farm job submitted by a detached
+        job once its command returned (LSF job ID printed by bsub, lsf:<id>), the LSF element or the process
+        (with its start time, <pid>@<start>, so a process reusing the PID isn't taken for the job) before
+
+"""
+
+import abc
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from job_events import directory_watcher
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+STATES = (PENDING, RUNNING, DONE, FAILED)
+# states of the LSF jobs not ended
+LSF_ACTIVE = ("PEND", "PROV", "RUN", "PSUSP", "USUSP", "SSUSP", "WAIT")
+# printed by bsub
+FARM_JOB = re.compile(r"Job <(\d+)> is submitted")
+
+
+def parse_limits(values):
+    """
+    {stage: limit} from stage=limit strings
+    """
+    limits = {}
+    for value in values or []:
+        stage, _, limit = value.partition("=")
+        if not stage or not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f"Invalid limit {value}, expected stage=N with N >= 1")
+        limits[stage] = int(limit)
+    return limits
+
+
+def farm_job(output):
+    """
+    ID of the last LSF job submitted according to the output of a command, None if none
+    """
+    ids = FARM_JOB.findall(output or "")
+    return ids[-1] if ids else None
+
+
+def lsf_alive(jobid):
+    """
+    Whether the LSF job (or array element) jobid is pending or running
+    """
+    if not re.fullmatch(r"\d+(\[\d+\])?", str(jobid)):
+        return False
+    result = subprocess.run(
+        ["bjobs", "-noheader", "-o", "stat", str(jobid)], capture_output=True, text=True
+    )
+    return result.stdout.strip() in LSF_ACTIVE
+
+
+def process_start(pid):
+    """
+    Start time of the process pid (clock ticks since boot), None if unknown
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the fields after the command name, which may contain spaces
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+class job:
+    def __init__(self, stage, name, command, cwd, detached):
+        self.stage = stage
+        self.name = name
+        self.command = command
+        self.cwd = os.path.abspath(cwd)
+        self.detached = detached
+        self.state = PENDING
+        self.returncode = None
+        # process or LSF job identifier
+        self.id = None
+        # LSF job submitted by the command of a detached job
+        self.farm_id = None
+        self.submitted = time.time()
+        self.started = None
+        self.ended = None
+
+    @property
+    def handle(self):
+        """
+        Identifier saved to check the job from a later run, None if not started
+        """
+        if self.farm_id is not None:
+            return f"lsf:{self.farm_id}"
+        return str(self.id) if self.id is not None else None
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    def __repr__(self):
+        return f"{self.stage}:{self.name} {self.state}"
+
+
+class executor(abc.ABC):
+    """
+    Queue and limits shared by the backends, which implement launch(jobs)
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self.condition = threading.Condition()
+        # (stage, name): last job submitted
+        self.jobs = {}
+        self.queue = deque()
+        # functions called when a job starts or ends (e.g. directory_watcher.wake)
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def running(self, stage):
+        return sum(1 for j in self.jobs.values() if j.stage == stage and j.state == RUNNING)
+
+    def get(self, stage, name):
+        return self.jobs.get((stage, name))
+
+    def submit(self, stage, name, command, cwd=".", detached=False):
+        """
+        Queue a command run in cwd, a job of the same stage and name not finished is replaced
+        """
+        with self.condition:
+            previous = self.jobs.get((stage, name))
+            if previous and not previous.finished:
+                self.end(previous, FAILED)
+            new = job(stage, name, command, cwd, detached)
+            self.jobs[(stage, name)] = new
+            self.queue.append(new)
+        self.dispatch()
+        return new
+
+    def dispatch(self):
+        """
+        Start the queued jobs within the limits of their stage
+        """
+        ready = []
+        with self.condition:
+            running = {}
+            for j in list(self.queue):
+                if j.stage not in running:
+                    running[j.stage] = self.running(j.stage)
+                limit = self.limits.get(j.stage)
+                if limit is None or running[j.stage] < limit:
+                    self.queue.remove(j)
+                    j.state = RUNNING
+                    j.started = time.time()
+                    running[j.stage] += 1
+                    ready.append(j)
+        if ready:
+            self.launch(ready)
+            self.notify()
+
+    @abc.abstractmethod
+    def launch(self, jobs):
+        """
+        Start the jobs (called with the jobs leaving the queue), the backend calls completed() when
+        the command of a job returned
+        """
+
+    @abc.abstractmethod
+    def alive(self, handle):
+        """
+        Whether the job with this handle (saved by a previous run) is still running
+        """
+
+    def end(self, j, state):
+        # called with the condition held
+        if j in self.queue:
+            self.queue.remove(j)
+        j.state = state
+        j.ended = time.time()
+        self.condition.notify_all()
+
+    def completed(self, j, returncode, output=None):
+        """
+        Called by the backends when the command of a job returned, with the output of the command of
+        the detached jobs (the LSF job it submitted is then checked instead)
+        """
+        with self.condition:
+            if j.finished:
+                # replaced or finished by its stage in the meantime
+                return
+            j.returncode = returncode
+            if j.detached:
+                j.farm_id = farm_job(output)
+            if returncode != 0:
+                self.end(j, FAILED)
+            elif not j.detached:
+                self.end(j, DONE)
+            else:
+                self.condition.notify_all()
+        self.dispatch()
+        self.notify()
+
+    def finish(self, stage, name, success=True):
+        """
+        End a detached job (or cancel a queued job) once its stage is complete
+        """
+        with self.condition:
+            j = self.jobs.get((stage, name))
+            if not j or j.finished:
+                return
+            self.end(j, DONE if success else FAILED)
+        self.dispatch()
+        self.notify()
+
+    def wait(self, jobs, timeout=None):
+        """
+        Wait until the commands of the jobs returned, return True if they all did
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: all(j.finished or j.returncode is not None for j in jobs), timeout
+            )
+
+    def wait_any(self, jobs, timeout=None):
+        """
+        Wait until the command of one of the jobs returned, return the jobs whose command returned
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: any(j.finished or j.returncode is not None for j in jobs), timeout
+            )
+            return [j for j in jobs if j.finished or j.returncode is not None]
+
+    def run(self, stage, name, command, cwd="."):
+        """
+        Run a command and wait for it, return its exit status
+        """
+        j = self.submit(stage, name, command, cwd)
+        self.wait([j])
+        return j.returncode
+
+    def summary(self):
+        """
+        {stage: {state: number of jobs}}
+        """
+        counts = {}
+        with self.condition:
+            for j in self.jobs.values():
+                counts.setdefault(j.stage, dict.fromkeys(STATES, 0))[j.state] += 1
+        return counts
+
+    def close(self):
+        pass
+
+
+class local_executor(executor):
+    """
+    Commands run as local processes, each one awaited by a thread
+    The output of the detached jobs is written to a temporary file (not a pipe, kept open by the processes
+    they leave running), then printed
+    """
+
+    def launch(self, jobs):
+        for j in jobs:
+            output = tempfile.TemporaryFile("w+") if j.detached else None
+            process = subprocess.Popen(j.command, shell=True, cwd=j.cwd, stdout=output)
+            start = process_start(process.pid)
+            j.id = f"{process.pid}@{start}" if start else process.pid
+            threading.Thread(target=self.reap, args=(j, process, output), daemon=True).start()
+
+    def reap(self, j, process, output):
+        returncode = process.wait()
+        text = None
+        if output:
+            with output:
+                output.seek(0)
+                text = output.read()
+            sys.stdout.write(text)
+        self.completed(j, returncode, text)
+
+    def alive(self, handle):
+        handle = str(handle)
+        if handle.startswith("lsf:"):
+            return lsf_alive(handle[4:])
+        pid, _, start = handle.partition("@")
+        if not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # process of another user
+            pass
+        # another process with the same PID
+        return not start or process_start(pid) in (start, None)
+
+
+class lsf_executor(executor):
+    """
+    The jobs of a stage started together are submitted as one LSF job array, each element runs its command
+    in its directory and writes its exit status in logdir (<array>.<index>.exit), where its output is also
+    saved (<array>.<index>.log)
+    Elements ended by LSF without exit status (e.g. memory limit) are found with bjobs
+    The output of the commands of the detached jobs is written to logdir (<array>.<index>.out, the LSF log may
+    only be copied once the element ended), and read once their exit status is written for the LSF job they
+    submitted
+    """
+
+    def __init__(self, limits=None, logdir="lsf_jobs", bsub_options=()):
+        super().__init__(limits)
+        self.logdir = os.path.abspath(logdir)
+        os.makedirs(self.logdir, exist_ok=True)
+        self.bsub_options = list(bsub_options)
+        self.arrays = 0
+        # exit file: job
+        self.waiting = {}
+        self.watcher = directory_watcher()
+        self.watcher.add(self.logdir)
+        self.closed = False
+        self.monitor = None
+
+    def write_script(self, array, jobs):
+        script = os.path.join(self.logdir, f"{array}.sh")
+        with open(script, "w") as f:
+            f.write("#!/bin/bash\ncase $LSB_JOBINDEX in\n")
+            for index, j in enumerate(jobs, start=1):
+                exitfile = os.path.join(self.logdir, f"{array}.{index}.exit")
+                output = os.path.join(self.logdir, f"{array}.{index}.out") if j.detached else None
+                redirect = f" > '{output}'" if output else ""
+                f.write(f"{index}) cd '{j.cwd}' && {{ {j.command} ; }}{redirect}\n")
+                f.write(f"   echo $? > '{exitfile}.tmp' && mv '{exitfile}.tmp' '{exitfile}' ;;\n")
+            f.write("esac\n")
+        return script
+
+    def launch(self, jobs):
+        stages = {}
+        for j in jobs:
+            stages.setdefault(j.stage, []).append(j)
+        for stage, stage_jobs in stages.items():
+            self.arrays += 1
+            array = f"{stage}_{os.getpid()}_{self.arrays}"
+            script = self.write_script(array, stage_jobs)
+            command = ["bsub", "-J", f"{array}[1-{len(stage_jobs)}]"]
+            command += ["-oo", os.path.join(self.logdir, f"{array}.%I.log")]
+            command += self.bsub_options + ["bash", script]
+            result = subprocess.run(command, capture_output=True, text=True)
+            match = re.search(r"Job <(\d+)>", result.stdout)
+            if result.returncode != 0 or not match:
+                print(f"Error while submitting {array}: {result.stderr.strip()}")
+                for j in stage_jobs:
+                    self.completed(j, result.returncode or 1)
+                continue
+            with self.condition:
+                for index, j in enumerate(stage_jobs, start=1):
+                    j.id = f"{match.group(1)}[{index}]"
+                    self.waiting[os.path.join(self.logdir, f"{array}.{index}.exit")] = j
+        if self.monitor is None:
+            self.monitor = threading.Thread(target=self.watch, daemon=True)
+            self.monitor.start()
+
+    def ended_by_lsf(self):
+        """
+        Jobs whose LSF element ended without writing its exit status
+        """
+        with self.condition:
+            jobs = {j.id: j for j in self.waiting.values()}
+        if not jobs:
+            return []
+        result = subprocess.run(
+            ["bjobs", "-noheader", "-o", "jobid jobindex stat", *jobs],
+            capture_output=True,
+            text=True,
+        )
+        ended = []
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "EXIT":
+                j = jobs.get(f"{fields[0]}[{fields[1]}]")
+                if j:
+                    ended.append(j)
+        return ended
+
+    def alive(self, handle):
+        handle = str(handle)
+        return lsf_alive(handle[4:] if handle.startswith("lsf:") else handle)
+
+    def watch(self):
+        while not self.closed:
+            directories = self.watcher.wait()
+            if not directories:
+                continue
+            for exitfile, j in list(self.waiting.items()):
+                if os.path.isfile(exitfile):
+                    with open(exitfile, "r") as f:
+                        status = f.read().strip()
+                    with self.condition:
+                        del self.waiting[exitfile]
+                    output = None
+                    if j.detached:
+                        try:
+                            with open(exitfile[: -len(".exit")] + ".out", "r", errors="replace") as f:
+                                output = f.read()
+                        except OSError:
+                            pass
+                    self.completed(j, int(status) if status.isdigit() else 1, output)
+            for j in self.ended_by_lsf():
+                # the exit status may have been written in the meantime
+                with self.condition:
+                    exitfiles = [f for f, waiting in self.waiting.items() if waiting is j]
+                    if not exitfiles or os.path.isfile(exitfiles[0]):
+                        continue
+                    del self.waiting[exitfiles[0]]
+                self.completed(j, 1)
+
+    def close(self):
+        self.closed = True
+        self.watcher.wake()
+
+
+class fake_executor(executor):
+    """
+    Nothing is run: the jobs end straight away with the exit status given in results
+    ({(stage, name): status} or {stage: status}, 0 by default), or when complete() is called if auto is False
+    Jobs get the identifiers fake_<n>, running: identifiers of the jobs of a previous run still running
+    """
+
+    def __init__(self, limits=None, results=None, auto=True, running=()):
+        super().__init__(limits)
+        self.results = results or {}
+        self.auto = auto
+        self.running_handles = set(running)
+        # jobs in launch order
+        self.launched = []
+
+    def launch(self, jobs):
+        for j in jobs:
+            j.id = f"fake_{len(self.launched)}"
+            self.launched.append(j)
+        if self.auto:
+            for j in jobs:
+                self.complete(j)
+
+    def complete(self, j, returncode=None, output=None):
+        if returncode is None:
+            returncode = self.results.get((j.stage, j.name), self.results.get(j.stage, 0))
+        self.completed(j, returncode, output)
+
+    def alive(self, handle):
+        with self.condition:
+            return handle in self.running_handles or any(
+                j.handle == handle and not j.finished and (j.returncode is None or j.farm_id)
+                for j in self.jobs.values()
+            )
+
+
+EXECUTORS = {"local": local_executor, "lsf": lsf_executor}
+_default = None
+
+
+def default_executor():
+    """
+    Local executor without limits, used when no executor is given
+    """
+    global _default
+    if _default is None:
+        _default = local_executor()
+    return _default
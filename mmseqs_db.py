@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Random access to the sequences of an MMseqs2 sequence database (created by mmseqs createdb)
+        <db>.lookup: key\tidentifier\tfile number
+        <db>.index, <db>_h.index: key\toffset\tlength of each entry of the sequence and header data files
+        Entries end with a null byte, sequences and headers with an end of line
+        The lookup and index files are read once to build <db>.keys.npy: accession key
+        (see dedup_sequences.encode_member), offset and length of the sequence and header entries,
+        sorted by accession key; it is memory-mapped and searched with a binary search, the entries
+        are then read with pread, so only the selected clusters are read from the database
+        The index is built again when the lookup or index files are more recent
+
+@arguments [-d database]: MMseqs2 sequence database (e.g. mgy_seqs.mmseqs)
+           [-a accessions]: identifiers of the sequences to extract (fasta written to stdout)
+"""
+
+import argparse
+import os
+import sys
+from array import array
+
+import numpy as np
+
+from dedup_sequences import encode_member
+from filter_partial import BLOCK_SIZE
+
+KEY_INDEX_TYPE = np.dtype(
+    [
+        ("key", "u8"),
+        ("offset", "u8"),
+        ("length", "u4"),
+        ("header_offset", "u8"),
+        ("header_length", "u4"),
+    ]
+)
+
+
+def get_key_index(database):
+    return f"{database}.keys.npy"
+
+
+def read_index(indexfile):
+    """
+    (keys, offsets, lengths) of the entries of an MMseqs2 index file, sorted by key
+    """
+    parts = []
+    remainder = b""
+    with open(indexfile, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            block = remainder + block
+            cut = block.rfind(b"\n") + 1
+            block, remainder = block[:cut], block[cut:]
+            if block:
+                parts.append(np.array(block.split()).astype(np.uint64).reshape(-1, 3))
+    if remainder.strip():
+        parts.append(np.array(remainder.split()).astype(np.uint64).reshape(-1, 3))
+    entries = np.concatenate(parts) if parts else np.zeros((0, 3), dtype=np.uint64)
+    # mmseqs writes the index sorted by key, sorted here in case it isn't
+    if np.any(entries[1:, 0] < entries[:-1, 0]):
+        entries = entries[np.argsort(entries[:, 0], kind="stable")]
+    return entries[:, 0], entries[:, 1], entries[:, 2]
+
+
+def read_lookup(lookupfile):
+    """
+    (MMseqs2 keys, accession keys) of the identifiers of the lookup file,
+    the identifiers which aren't UniProt or MGnify accessions are left out
+    """
+    keys, accessions = array("Q"), array("Q")
+    with open(lookupfile, "rb") as f:
+        for line in f:
+            key, identifier, _ = line.split(b"\t")
+            try:
+                accessions.append(encode_member(identifier))
+            except ValueError:
+                continue
+            keys.append(int(key))
+    return np.frombuffer(keys, dtype=np.uint64), np.frombuffer(accessions, dtype=np.uint64)
+
+
+def locate_entries(index, keys):
+    """
+    (found, offsets, lengths) of the entries of keys in index (keys, offsets, lengths)
+    """
+    index_keys, offsets, lengths = index
+    if len(index_keys) == 0:
+        empty = np.zeros(len(keys), dtype=np.uint64)
+        return np.zeros(len(keys), dtype=bool), empty, empty
+    positions = np.minimum(np.searchsorted(index_keys, keys), len(index_keys) - 1)
+    found = index_keys[positions] == keys
+    return found, offsets[positions], lengths[positions]
+
+
+def build_key_index(database):
+    """
+    Write the index of the database entries by accession (written to a temporary file then renamed),
+    return the number of entries
+    """
+    keys, accessions = read_lookup(f"{database}.lookup")
+    found, offsets, lengths = locate_entries(read_index(f"{database}.index"), keys)
+    header_found, header_offsets, header_lengths = locate_entries(
+        read_index(f"{database}_h.index"), keys
+    )
+    found &= header_found
+
+    index = np.empty(int(found.sum()), dtype=KEY_INDEX_TYPE)
+    index["key"] = accessions[found]
+    index["offset"] = offsets[found]
+    index["length"] = lengths[found]
+    index["header_offset"] = header_offsets[found]
+    index["header_length"] = header_lengths[found]
+    # the first entry of an accession is found first
+    index.sort(order="key", kind="stable")
+
+    tmpfile = f"{database}.keys.tmp_{os.getpid()}.npy"
+    np.save(tmpfile, index)
+    os.replace(tmpfile, get_key_index(database))
+    return len(index)
+
+
+def is_outdated(database):
+    indexfile = get_key_index(database)
+    if not os.path.isfile(indexfile):
+        return True
+    sources = [f"{database}.lookup", f"{database}.index", f"{database}_h.index"]
+    return any(os.path.getmtime(source) > os.path.getmtime(indexfile) for source in sources)
+
+
+class mmseqs_db:
+    def __init__(self, database):
+        self.database = database
+        if is_outdated(database):
+            print(f"Indexing the accessions of {database}")
+            count = build_key_index(database)
+            print(f"{count} accessions indexed")
+        self.open()
+
+    def open(self):
+        self.index = np.load(get_key_index(self.database), mmap_mode="r")
+        if len(self.index) == 0:
+            self.index = np.zeros(0, dtype=KEY_INDEX_TYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def locate(self, identifier):
+        """
+        Position of identifier (bytes) in the index, None if not found
+        """
+        try:
+            key = encode_member(identifier)
+        except ValueError:
+            return None
+        i = np.searchsorted(self.index["key"], key)
+        if i < len(self.index) and self.index["key"][i] == key:
+            return int(i)
+        return None
+
+    def read_entries(self, datafile, entries):
+        """
+        Return {identifier: content} for the entries {identifier: (offset, length)}, without the null byte
+        """
+        content = {}
+        with open(datafile, "rb") as f:
+            # reading in file order
+            for identifier, (offset, length) in sorted(entries.items(), key=lambda item: item[1]):
+                content[identifier] = os.pread(f.fileno(), length, offset).rstrip(b"\0")
+        return content
+
+    def fetch(self, identifiers):
+        """
+        Return {identifier: (header, sequence)} for the requested identifiers (bytes),
+        the header without '>', both ending with an end of line
+        Missing identifiers are left out
+        """
+        rows = {}
+        for identifier in identifiers:
+            i = self.locate(identifier)
+            if i is not None:
+                rows[identifier] = self.index[i]
+        sequences = self.read_entries(
+            self.database,
+            {identifier: (int(row["offset"]), int(row["length"])) for identifier, row in rows.items()},
+        )
+        headers = self.read_entries(
+            f"{self.database}_h",
+            {
+                identifier: (int(row["header_offset"]), int(row["header_length"]))
+                for identifier, row in rows.items()
+            },
+        )
+        return {identifier: (headers[identifier], sequences[identifier]) for identifier in rows}
+
+    # only the database name is sent to other processes, the index is opened again on their side
+    def __getstate__(self):
+        return {"database": self.database}
+
+    def __setstate__(self, state):
+        self.database = state["database"]
+        self.open()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", help="MMseqs2 sequence database", required=True)
+    parser.add_argument(
+        "-a", "--accessions", help="identifiers of the sequences to extract", nargs="+", required=True
+    )
+    args = parser.parse_args()
+
+    identifiers = [acc.encode("utf-8") for acc in args.accessions]
+    entries = mmseqs_db(args.database).fetch(identifiers)
+    for identifier in identifiers:
+        if identifier not in entries:
+            print(f"{identifier.decode('utf-8')} not found in {args.database}", file=sys.stderr)
+            continue
+        header, sequence = entries[identifier]
+        sys.stdout.buffer.write(b">" + header + sequence)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Resources used by the commands of the clustering pipeline, and comparison of the pipeline runs
+        Each command run by cluster_pipeline.py is measured and appended to the ledger of the run
+        (data/.pipeline/ledger/<date>_<time>.jsonl), one JSON record per line:
+        run, release, step, command, status, started, wall time, user and system CPU time (seconds),
+        peak RSS (bytes) and bytes read from and written to disk by the command and its child processes
+        Commands submitted to LSF (bsub -K) are only measured on the submission side,
+        the resources of the jobs are reported by LSF in their log files
+
+@arguments [LEDGER_FILE [LEDGER_FILE ...]]: ledgers of the runs to compare (e.g. data/.pipeline/ledger/*.jsonl)
+           [-m METRIC [METRIC ...]]: metrics reported (default: all)
+
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# rusage block counts are in 512 bytes units
+BLOCK_SIZE = 512
+METRICS = {
+    "wall": "wall time (s)",
+    "cpu": "CPU time (s)",
+    "peak_rss": "peak RSS (GB)",
+    "read_bytes": "read (GB)",
+    "write_bytes": "written (GB)",
+}
+
+
+def command_name(command):
+    """
+    Short name of a command: script or executable name, with the subcommand (e.g. mmseqs linclust),
+    and the script of the jobs submitted to LSF
+    """
+    if os.path.basename(command[0]) == "bsub":
+        return f"bsub {command_name(command[-1].split(' '))}"
+    if os.path.basename(command[0]).startswith("python"):
+        command = command[1:]
+    name = os.path.basename(command[0])
+    if len(command) > 1 and re.match(r"^[a-z0-9]+$", command[1]):
+        return f"{name} {command[1]}"
+    return name
+
+
+def run_measured(command):
+    """
+    Run a command, return (exit status, resources used by the command and its child processes)
+    """
+    started = time.time()
+    process = subprocess.Popen(command)
+    # wait4 gives the resources of the command, including its child processes it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, {
+        "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)),
+        "wall": round(time.time() - started, 3),
+        "cpu_user": round(usage.ru_utime, 3),
+        "cpu_system": round(usage.ru_stime, 3),
+        # kilobytes on Linux
+        "peak_rss": usage.ru_maxrss * 1024,
+        "read_bytes": usage.ru_inblock * BLOCK_SIZE,
+        "write_bytes": usage.ru_oublock * BLOCK_SIZE,
+    }
+
+
+class ledger:
+    """
+    Ledger of a run of the pipeline, the file is created with the first record
+    """
+
+    def __init__(self, ledgerdir, release):
+        self.run = time.strftime("%Y%m%d_%H%M%S")
+        self.ledgerfile = os.path.join(ledgerdir, f"{self.run}.jsonl")
+        self.release = release
+        # name of the step running
+        self.step = None
+
+    def record(self, command, status, usage):
+        os.makedirs(os.path.dirname(self.ledgerfile), exist_ok=True)
+        record = {
+            "run": self.run,
+            "release": self.release,
+            "step": self.step,
+            "command": command_name(command),
+            "status": status,
+        }
+        record.update(usage)
+        with open(self.ledgerfile, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def run_command(self, command):
+        """
+        Run and record a command, raise subprocess.CalledProcessError if it fails
+        """
+        status, usage = run_measured(command)
+        self.record(command, status, usage)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, command)
+
+
+def read_ledger(ledgerfile):
+    with open(ledgerfile, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_totals(records):
+    """
+    Return {(step, command): metrics} for the successful commands of a run,
+    times and bytes added up for repeated commands, the highest peak RSS kept
+    """
+    totals = {}
+    for record in records:
+        if record["status"] != 0:
+            continue
+        key = (record["step"], record["command"])
+        metrics = {
+            "wall": record["wall"],
+            "cpu": record["cpu_user"] + record["cpu_system"],
+            "peak_rss": record["peak_rss"] / 1024 ** 3,
+            "read_bytes": record["read_bytes"] / 1024 ** 3,
+            "write_bytes": record["write_bytes"] / 1024 ** 3,
+        }
+        if key not in totals:
+            totals[key] = metrics
+            continue
+        for name, value in metrics.items():
+            if name == "peak_rss":
+                totals[key][name] = max(totals[key][name], value)
+            else:
+                totals[key][name] += value
+    return totals
+
+
+def print_report(ledgerfiles, metrics, output=sys.stdout):
+    """
+    One table per metric: a row per step and command, a column per run,
+    and the change between the first and the last run
+    """
+    runs = []
+    for ledgerfile in ledgerfiles:
+        records = read_ledger(ledgerfile)
+        if records:
+            label = f"{records[-1]['release']} ({records[0]['run']})"
+            runs.append((label, run_totals(records)))
+    if not runs:
+        print("No command recorded", file=output)
+        return
+
+    rows = []
+    for _, totals in runs:
+        rows.extend(key for key in totals if key not in rows)
+    width = max(len(f"{step} {command}") for step, command in rows)
+    column = max(len(label) for label, _ in runs)
+    for metric in metrics:
+        print(f"\n{METRICS[metric]}", file=output)
+        header = [f"{'step':<{width}}"] + [f"{label:>{column}}" for label, _ in runs]
+        if len(runs) > 1:
+            header.append(f"{'change':>8}")
+        print("  ".join(header), file=output)
+        for step, command in rows:
+            values = [totals.get((step, command), {}).get(metric) for _, totals in runs]
+            line = [f"{f'{step} {command}':<{width}}"]
+            line += [f"{'-' if v is None else f'{v:.2f}':>{column}}" for v in values]
+            if len(runs) > 1:
+                first, last = values[0], values[-1]
+                if first and last is not None:
+                    line.append(f"{(last - first) / first:>+8.0%}")
+                else:
+                    line.append(f"{'-':>8}")
+            print("  ".join(line), file=output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ledger_file", help="ledgers of the runs to compare", nargs="+")
+    parser.add_argument(
+        "-m", "--metrics", help="metrics reported (default: all)", nargs="+", choices=METRICS
+    )
+    args = parser.parse_args()
+
+    missing = [f for f in args.ledger_file if not os.path.isfile(f)]
+    if missing:
+        print(f"Ledger files not found: {' '.join(missing)}")
+        sys.exit(1)
+
+    print_report(args.ledger_file, args.metrics or list(METRICS))
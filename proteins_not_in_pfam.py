@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Fetch the list of UniProt proteins not matching Pfam
+        The accession space is split into ranges queried concurrently over a small pool of sessions,
+        the rows are streamed to the accessions file and its index (see accession_index.py)
+        The database can be InterPro (Oracle) or a SQLite stand-in for tests and benchmarks,
+        with the tables PROTEIN(PROTEIN_AC), MATCH(PROTEIN_AC, DBCODE) and DB_VERSION(DBCODE, VERSION)
+
+        The list is cached with the UniProt and Pfam versions it was generated from,
+        and the count and checksum of the accessions of each bucket (<proteinfile>.json),
+        buckets being the accessions sharing their 3 first characters (6 for A0A TrEMBL accessions)
+        When only one of the versions changed since the last cached list, only the buckets whose
+        checksum changed are fetched again, the other accessions are copied from the previous list
+        (the accessions added and removed are found by cluster_state.py from the two indexes)
+
+@arguments [-o proteinfile]: file to write the accessions to
+            [-u username]: username for database connection
+            [-p password]: password for database connection
+            [-s schema]: schema for database connection (VIPREAD)
+            [-l sqlitefile]: SQLite database to use instead of Oracle
+            [-j threads]: number of ranges fetched concurrently (default=4)
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import sqlite3
+import sys
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from accession_index import (
+    ACCESSION_CHARS,
+    accession_index,
+    accession_index_writer,
+    decode_accession,
+    get_index_file,
+)
+
+
+def accession_ranges():
+    """
+    Split the accession space into [lo, hi) ranges
+    One range per first letter, TrEMBL accessions starting with A0A are split on their 4th character
+    """
+    bounds = ["0", "A"]
+    bounds += [f"A0A{c}" for c in ACCESSION_CHARS]
+    bounds += ["A0B"]
+    bounds += [c for c in ACCESSION_CHARS[11:]]  # B to Z
+    bounds += ["~"]
+    return list(zip(bounds, bounds[1:]))
+
+
+# checksums are computed by bucket, a few thousand accessions each
+BUCKET = (
+    "CASE WHEN PROTEIN_AC LIKE 'A0A%' THEN SUBSTR(PROTEIN_AC, 1, 6) ELSE SUBSTR(PROTEIN_AC, 1, 3) END"
+)
+# number of consecutive changed buckets fetched with one query
+BUCKETS_PER_QUERY = 64
+
+
+def accession_bucket(acc):
+    """
+    Bucket of an accession (see BUCKET)
+    """
+    return acc[:6] if acc.startswith("A0A") else acc[:3]
+
+
+def bucket_ranges(buckets, changed, size=BUCKETS_PER_QUERY):
+    """
+    Merge the runs of consecutive changed buckets into [lo, hi) ranges of at most size buckets
+    buckets: all the buckets of the previous and current lists, changed: set of changed buckets
+    """
+    ranges = []
+    run = []
+    for bucket in sorted(buckets):
+        if bucket in changed and len(run) < size:
+            run.append(bucket)
+            continue
+        if run:
+            ranges.append((run[0], f"{run[-1]}~"))
+        run = [bucket] if bucket in changed else []
+    if run:
+        ranges.append((run[0], f"{run[-1]}~"))
+    return ranges
+
+
+class oracle_database:
+    query = """SELECT PROTEIN_AC FROM INTERPRO.PROTEIN
+                WHERE PROTEIN_AC >= :lo AND PROTEIN_AC < :hi
+            MINUS
+            SELECT PROTEIN_AC FROM INTERPRO.MATCH PARTITION (MATCH_DBCODE_H)
+                WHERE PROTEIN_AC >= :lo AND PROTEIN_AC < :hi
+        """
+    checksum_query = (
+        f"SELECT {BUCKET}, COUNT(*), SUM(ORA_HASH(PROTEIN_AC)) FROM ({query}) GROUP BY {BUCKET}"
+    )
+    versions_query = "SELECT DBCODE, VERSION FROM INTERPRO.DB_VERSION WHERE DBCODE IN ('u', 'H')"
+
+    def __init__(self, user, password, schema, sessions=4):
+        import cx_Oracle
+
+        try:
+            self.pool = cx_Oracle.SessionPool(
+                user=user,
+                password=password,
+                dsn=schema,
+                min=1,
+                max=sessions,
+                increment=1,
+                threaded=True,
+                getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+            )
+        except cx_Oracle.DatabaseError:
+            print(traceback.format_exc())
+            print(f"Could not connect to {schema} as user {user}")
+            sys.exit(1)
+
+    def acquire(self):
+        return self.pool.acquire()
+
+    def release(self, connection):
+        self.pool.release(connection)
+
+    def prepare(self, cursor, arraysize):
+        cursor.arraysize = arraysize
+        cursor.prefetchrows = arraysize + 1
+
+    def close(self):
+        self.pool.close()
+
+
+class sqlite_database:
+    query = """SELECT PROTEIN_AC FROM PROTEIN
+                WHERE PROTEIN_AC >= :lo AND PROTEIN_AC < :hi
+            EXCEPT
+            SELECT PROTEIN_AC FROM MATCH
+                WHERE DBCODE = 'H' AND PROTEIN_AC >= :lo AND PROTEIN_AC < :hi
+        """
+    checksum_query = (
+        f"SELECT {BUCKET}, COUNT(*), SUM(ACC_HASH(PROTEIN_AC)) FROM ({query}) GROUP BY {BUCKET}"
+    )
+    versions_query = "SELECT DBCODE, VERSION FROM DB_VERSION WHERE DBCODE IN ('u', 'H')"
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+
+    def acquire(self):
+        connection = sqlite3.connect(self.dbfile, check_same_thread=False)
+        connection.create_function("ACC_HASH", 1, lambda acc: zlib.crc32(acc.encode()))
+        return connection
+
+    def release(self, connection):
+        connection.close()
+
+    def prepare(self, cursor, arraysize):
+        cursor.arraysize = arraysize
+
+    def close(self):
+        pass
+
+
+def create_sqlite_database(dbfile, proteins, matches, versions):
+    """
+    Create a SQLite stand-in database
+    proteins: iterable of accessions, matches: iterable of (accession, dbcode),
+    versions: dictionary {"uniprot": version, "pfam": version}
+    """
+    with sqlite3.connect(dbfile) as connection:
+        connection.execute("CREATE TABLE PROTEIN (PROTEIN_AC TEXT PRIMARY KEY)")
+        connection.execute("CREATE TABLE MATCH (PROTEIN_AC TEXT, DBCODE TEXT)")
+        connection.execute("CREATE INDEX MATCH_AC ON MATCH (PROTEIN_AC)")
+        connection.execute("CREATE TABLE DB_VERSION (DBCODE TEXT, VERSION TEXT)")
+        connection.executemany("INSERT INTO PROTEIN VALUES (?)", ((acc,) for acc in proteins))
+        connection.executemany("INSERT INTO MATCH VALUES (?, ?)", matches)
+        connection.executemany(
+            "INSERT INTO DB_VERSION VALUES (?, ?)",
+            [("u", versions["uniprot"]), ("H", versions["pfam"])],
+        )
+    connection.close()
+
+
+def get_versions(database):
+    """
+    UniProt and Pfam versions of the data in the database
+    """
+    connection = database.acquire()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(database.versions_query)
+        dbcodes = {"u": "uniprot", "H": "pfam"}
+        versions = {dbcodes[dbcode]: str(version) for dbcode, version in cursor}
+        cursor.close()
+    finally:
+        database.release(connection)
+    return versions
+
+
+def fetch_range(database, lo, hi, rows, arraysize):
+    """
+    Put the accessions of the range in the rows queue by batches of arraysize (run by the threads)
+    None is put in the queue once the range is done
+    """
+    count = 0
+    try:
+        connection = database.acquire()
+        try:
+            cursor = connection.cursor()
+            database.prepare(cursor, arraysize)
+            cursor.execute(database.query, {"lo": lo, "hi": hi})
+            while True:
+                batch = cursor.fetchmany(arraysize)
+                if not batch:
+                    break
+                rows.put([str(row[0]) for row in batch])
+                count += len(batch)
+            cursor.close()
+        finally:
+            database.release(connection)
+    finally:
+        rows.put(None)
+    return count
+
+
+def fetch_ranges(database, ranges, threads=4, arraysize=50000):
+    """
+    Yield the accessions of the given ranges by batches, in no particular order
+    At most 2 batches per thread are kept in memory
+    """
+    rows = queue.Queue(maxsize=2 * threads)
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [
+            executor.submit(fetch_range, database, lo, hi, rows, arraysize) for lo, hi in ranges
+        ]
+        done = 0
+        try:
+            while done < len(ranges):
+                batch = rows.get()
+                if batch is None:
+                    done += 1
+                else:
+                    yield batch
+        finally:
+            # if stopped early, empty the queue so the running threads can finish
+            done += sum(future.cancel() for future in futures)
+            while done < len(ranges):
+                if rows.get() is None:
+                    done += 1
+
+        for future in futures:
+            future.result()
+
+
+def fetch_range_checksums(database, lo, hi):
+    connection = database.acquire()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(database.checksum_query, {"lo": lo, "hi": hi})
+        checksums = {str(bucket): [int(count), int(checksum)] for bucket, count, checksum in cursor}
+        cursor.close()
+    finally:
+        database.release(connection)
+    return checksums
+
+
+def fetch_checksums(database, ranges, threads=4):
+    """
+    Number of accessions and checksum computed by the database for each bucket of the ranges
+    {bucket: [count, checksum]}
+    """
+    checksums = {}
+    with ThreadPoolExecutor(threads) as executor:
+        for result in executor.map(lambda r: fetch_range_checksums(database, *r), ranges):
+            checksums.update(result)
+    return checksums
+
+
+def fetch_proteins_not_in_pfam(database, proteinfile, threads=4, arraysize=50000):
+    """
+    Write the accessions not found in Pfam to proteinfile and its index,
+    return the number of accessions
+    """
+    tmpfile = f"{proteinfile}.tmp"
+    count = 0
+
+    start_time = time.time()
+    with accession_index_writer(get_index_file(proteinfile)) as writer:
+        with open(tmpfile, "w") as f, closing(
+            fetch_ranges(database, accession_ranges(), threads, arraysize)
+        ) as batches:
+            for batch in batches:
+                for protein in batch:
+                    f.write(f"{protein}\n")
+                    writer.add(protein)
+                count += len(batch)
+
+    os.replace(tmpfile, proteinfile)
+    print(
+        f"{count} proteins not in Pfam fetched"
+        + " --- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60)
+    )
+    return count
+
+
+def get_metadata_file(proteinfile):
+    return f"{proteinfile}.json"
+
+
+def load_metadata(proteinfile):
+    """
+    Metadata of a cached list, None if the list or its index is missing
+    """
+    metadata_file = get_metadata_file(proteinfile)
+    if not all(
+        os.path.isfile(f) for f in [proteinfile, get_index_file(proteinfile), metadata_file]
+    ):
+        return None
+    with open(metadata_file, "r") as f:
+        return json.load(f)
+
+
+class protein_cache:
+    """
+    Cache of the lists of proteins not in Pfam, one per UniProt release, all in the same directory
+    """
+
+    def __init__(self, database, proteinfile, threads=4):
+        self.database = database
+        self.proteinfile = proteinfile
+        self.threads = threads
+
+    def find_previous(self):
+        """
+        Metadata of the most recent cached list in the directory, None if not found
+        """
+        previous = None
+        for metadata_file in glob.glob(os.path.join(os.path.dirname(self.proteinfile), "*.json")):
+            try:
+                metadata = load_metadata(metadata_file[: -len(".json")])
+            except ValueError:
+                continue
+            if metadata and "buckets" in metadata and "versions" in metadata:
+                if previous is None or metadata["updated"] > previous["updated"]:
+                    previous = metadata
+        return previous
+
+    def save_metadata(self, versions, checksums, count):
+        metadata = {
+            "proteinfile": os.path.abspath(self.proteinfile),
+            "versions": versions,
+            "count": count,
+            "buckets": checksums,
+            "updated": time.time(),
+        }
+        tmpfile = f"{get_metadata_file(self.proteinfile)}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(metadata, f, indent=1)
+        os.replace(tmpfile, get_metadata_file(self.proteinfile))
+
+    def update(self):
+        """
+        Check the cached list against the database versions and refresh it if needed
+        Return True if the list was fetched or updated
+        """
+        versions = get_versions(self.database)
+        current = load_metadata(self.proteinfile)
+        if current and current["versions"] == versions:
+            print(f"{self.proteinfile} up to date ({versions})")
+            return False
+        if current is None and os.path.isfile(self.proteinfile):
+            if os.path.getsize(self.proteinfile) != 0:
+                print(f"No versions recorded for {self.proteinfile}, not checking for updates")
+                return False
+
+        previous = current or self.find_previous()
+        changed = []
+        if previous:
+            changed = [k for k in versions if previous["versions"].get(k) != versions[k]]
+            # the delta can only be applied if the list was cached with the checksums of its buckets
+            if "buckets" not in previous:
+                changed = []
+
+        if len(changed) == 1:
+            print(f"{changed[0]} changed since {previous['proteinfile']}, fetching the differences")
+            self.update_delta(previous, versions)
+        else:
+            print("Fetching all the proteins not matching Pfam")
+            checksums = fetch_checksums(self.database, accession_ranges(), self.threads)
+            count = fetch_proteins_not_in_pfam(self.database, self.proteinfile, self.threads)
+            self.save_metadata(versions, checksums, count)
+        return True
+
+    def update_delta(self, previous, versions):
+        """
+        Fetch again the buckets whose checksum changed, keep the other buckets from the previous list
+        The new accessions are streamed to the list, so only the changed buckets are read
+        """
+        start_time = time.time()
+        checksums = fetch_checksums(self.database, accession_ranges(), self.threads)
+        buckets = set(previous["buckets"]) | set(checksums)
+        changed = {b for b in buckets if previous["buckets"].get(b) != checksums.get(b)}
+        ranges = bucket_ranges(buckets, changed)
+
+        tmpfile = f"{self.proteinfile}.tmp"
+        kept = fetched = 0
+        old_index = accession_index(get_index_file(previous["proteinfile"]))
+        with accession_index_writer(get_index_file(self.proteinfile)) as writer:
+            with open(tmpfile, "w") as f:
+                for value in old_index:
+                    protein = decode_accession(value)
+                    if accession_bucket(protein) in changed:
+                        continue
+                    f.write(f"{protein}\n")
+                    writer.add(protein)
+                    kept += 1
+                with closing(fetch_ranges(self.database, ranges, self.threads)) as batches:
+                    for batch in batches:
+                        for protein in batch:
+                            f.write(f"{protein}\n")
+                            writer.add(protein)
+                        fetched += len(batch)
+        old_index.close()
+        os.replace(tmpfile, self.proteinfile)
+
+        self.save_metadata(versions, checksums, kept + fetched)
+        print(
+            f"{len(changed)} of {len(buckets)} buckets updated ({len(ranges)} queries), "
+            + f"{kept} proteins kept, {fetched} fetched"
+            + " --- Completed in %.2f minutes ---" % ((time.time() - start_time) / 60)
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o", "--proteinfile", help="file to write the accessions to", required=True
+    )
+    parser.add_argument("-u", "--user", help="username for database connection")
+    parser.add_argument("-p", "--password", help="password for database connection")
+    parser.add_argument("-s", "--schema", help="database schema to connect to")
+    parser.add_argument("-l", "--sqlitefile", help="SQLite database to use instead of Oracle")
+    parser.add_argument(
+        "-j", "--threads", help="number of ranges fetched concurrently", type=int, default=4
+    )
+    args = parser.parse_args()
+
+    if args.sqlitefile:
+        database = sqlite_database(args.sqlitefile)
+    elif args.user and args.password and args.schema:
+        database = oracle_database(args.user, args.password, args.schema, args.threads)
+    else:
+        parser.error("database credentials (-u, -p, -s) or SQLite file (-l) required")
+
+    protein_cache(database, args.proteinfile, args.threads).update()
+    database.close()
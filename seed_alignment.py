@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief SEED alignment of a family prepared in memory, replacing the belvu and trim_alignment.pl runs
+        The alignment (aligned fasta, mul or Stockholm) is read into a matrix of characters (one row per sequence)
+        - redundancy filter: the sequences are taken from the longest, a sequence more than IDENTITY % identical
+          to a sequence kept is removed (identity over the columns where both sequences have a residue, as belvu -n)
+        - N and C terminal columns with more than MAX_GAP of gaps are trimmed, the sequence coordinates are updated
+        - partial sequences (gap in the first or last column) are removed (as belvu -P)
+        The alignment is written in mul format (name/start-end sequence, '.' for gaps)
+
+@arguments -i INPUT: alignment to read (e.g. SEED4)
+           -o OUTPUT: alignment written in mul format (e.g. SEED)
+           [-c]: only convert the alignment to mul format
+           [-n IDENTITY]: maximum identity between the sequences kept, in % (default=80)
+           [-g MAX_GAP]: maximum fraction of gaps in the terminal columns kept (default=0.5)
+
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import numpy as np
+
+IDENTITY = 80
+MAX_GAP = 0.5
+GAP = ord(".")
+NAME_COORDINATES = re.compile(r"^(.+)/(\d+)-(\d+)$")
+
+
+class seed_alignment:
+    def __init__(self, names, starts, ends, matrix):
+        """
+        names: sequence names without coordinates, starts and ends: coordinates of the first and last residues,
+        matrix: characters of the alignment (uint8, one row per sequence)
+        """
+        self.names = names
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.matrix = matrix
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def residues(self):
+        # letters (upper case: match states, lower case: insertions)
+        upper = self.matrix & 0xDF
+        return (upper >= ord("A")) & (upper <= ord("Z"))
+
+    def select(self, rows):
+        """
+        Keep the sequences of rows (indices or boolean mask), and the columns with a residue left
+        """
+        rows = np.asarray(rows)
+        if rows.dtype != bool:
+            rows = np.sort(rows)
+        names = [self.names[i] for i in np.arange(len(self))[rows]]
+        matrix = self.matrix[rows]
+        self.names, self.starts, self.ends = names, self.starts[rows], self.ends[rows]
+        self.matrix = matrix
+        if len(self):
+            self.matrix = matrix[:, self.residues.any(axis=0)]
+        return self
+
+    def non_redundant(self, identity=IDENTITY):
+        """
+        Remove the sequences more than identity % identical to a longer sequence
+        """
+        if len(self) < 2:
+            return self
+        residues = self.residues
+        # upper case, so insertions compare with match states
+        upper = np.where(residues, self.matrix & 0xDF, 0).astype(np.uint8)
+        lengths = residues.sum(axis=1)
+        # residue masks as floats, the aligned columns are counted by a matrix product
+        weights = residues.astype(np.float32)
+        kept_rows = np.empty_like(upper)
+        kept_weights = np.empty_like(weights)
+        kept = []
+        for i in np.argsort(-lengths, kind="stable"):
+            k = len(kept)
+            if k:
+                # compared with all the sequences kept at once
+                aligned = kept_weights[:k] @ weights[i]
+                # gaps are 0 in kept_rows, equal characters on the residues of i are identical residues
+                same = np.count_nonzero((kept_rows[:k] == upper[i]) & residues[i], axis=1)
+                if np.any(same * 100 > identity * np.maximum(aligned, 1)):
+                    continue
+            kept_rows[k] = upper[i]
+            kept_weights[k] = weights[i]
+            kept.append(i)
+        return self.select(kept)
+
+    def trim_gappy_ends(self, max_gap=MAX_GAP):
+        """
+        Remove the N and C terminal columns with more than max_gap of gaps, and the sequences left empty
+        """
+        if len(self) == 0:
+            return self
+        residues = self.residues
+        kept = np.flatnonzero(1 - residues.mean(axis=0) <= max_gap)
+        if len(kept) == 0:
+            return self.select(np.zeros(len(self), dtype=bool))
+        first, last = kept[0], kept[-1] + 1
+        # residues trimmed from the start and the end of the sequences
+        self.starts = self.starts + residues[:, :first].sum(axis=1)
+        self.ends = self.ends - residues[:, last:].sum(axis=1)
+        self.matrix = self.matrix[:, first:last]
+        return self.select(self.residues.any(axis=1))
+
+    def remove_partial(self):
+        """
+        Remove the sequences with a gap in the first or last column
+        """
+        if len(self) == 0:
+            return self
+        residues = self.residues
+        return self.select(residues[:, 0] & residues[:, -1])
+
+    def lines(self):
+        """
+        Yield the lines of the alignment in mul format
+        """
+        labels = [f"{name}/{start}-{end}" for name, start, end in zip(self.names, self.starts, self.ends)]
+        width = max((len(label) for label in labels), default=0)
+        sequences = np.where(self.residues, self.matrix, GAP).astype(np.uint8)
+        for label, row in zip(labels, sequences):
+            yield f"{label:<{width}} {row.tobytes().decode('ascii')}\n"
+
+    def write_mul(self, filename):
+        """
+        Write the alignment in mul format, written to a temporary file then renamed
+        """
+        with open(f"{filename}.tmp", "w") as f:
+            f.writelines(self.lines())
+        os.replace(f"{filename}.tmp", filename)
+
+    def write_stockholm(self, f, name):
+        """
+        Write the alignment to the open file f as a Stockholm alignment named name (#=GF ID)
+        """
+        f.write(f"# STOCKHOLM 1.0\n#=GF ID {name}\n")
+        f.writelines(self.lines())
+        f.write("//\n")
+
+
+def read_alignment(filename):
+    """
+    Read an aligned fasta, mul or Stockholm file, raise ValueError if the sequences aren't aligned
+    """
+    names, sequences = [], {}
+    with open(filename, "r") as f:
+        name = None
+        fasta = None
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith(("#", "//")):
+                continue
+            if fasta is None:
+                fasta = line.startswith(">")
+            if fasta:
+                if line.startswith(">"):
+                    name = line[1:].split()[0] if line[1:].strip() else ""
+                    names.append(name)
+                    sequences[name] = []
+                else:
+                    sequences[name].append(line.strip())
+            else:
+                fields = line.split()
+                if len(fields) != 2:
+                    raise ValueError(f"Invalid line in {filename}: {line}")
+                # interleaved Stockholm blocks: the rows of a sequence are joined
+                if fields[0] not in sequences:
+                    names.append(fields[0])
+                    sequences[fields[0]] = []
+                sequences[fields[0]].append(fields[1])
+
+    rows = ["".join(sequences[name]).encode("ascii") for name in names]
+    if len(set(len(row) for row in rows)) > 1:
+        raise ValueError(f"Sequences of different lengths in {filename}")
+    if rows:
+        matrix = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), -1).copy()
+    else:
+        matrix = np.zeros((0, 0), dtype=np.uint8)
+    alignment = seed_alignment([], [], [], matrix)
+    lengths = alignment.residues.sum(axis=1)
+    starts, ends = [], []
+    for name, length in zip(names, lengths):
+        match = NAME_COORDINATES.match(name)
+        if match:
+            alignment.names.append(match.group(1))
+            starts.append(int(match.group(2)))
+            ends.append(int(match.group(3)))
+        else:
+            alignment.names.append(name)
+            starts.append(1)
+            ends.append(int(length))
+    alignment.starts = np.array(starts, dtype=np.int64)
+    alignment.ends = np.array(ends, dtype=np.int64)
+    return alignment
+
+
+def convert_to_mul(inputfile, outputfile):
+    """
+    Write an alignment in mul format (as belvu -o mul), return the number of sequences
+    """
+    alignment = read_alignment(inputfile)
+    alignment.write_mul(outputfile)
+    return len(alignment)
+
+
+def prepare_seed(inputfile, outputfile, identity=IDENTITY, max_gap=MAX_GAP):
+    """
+    Write the SEED alignment from the liftover alignment: non redundant, gappy terminal columns trimmed,
+    without partial sequences; return the number of sequences
+    """
+    alignment = read_alignment(inputfile)
+    alignment.non_redundant(identity).trim_gappy_ends(max_gap).remove_partial()
+    alignment.write_mul(outputfile)
+    return len(alignment)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="alignment to read", required=True)
+    parser.add_argument("-o", "--output", help="alignment written in mul format", required=True)
+    parser.add_argument("-c", "--convert", help="only convert the alignment", action="store_true")
+    parser.add_argument(
+        "-n",
+        "--identity",
+        help=f"maximum identity between the sequences kept, in %% (default={IDENTITY})",
+        type=float,
+        default=IDENTITY,
+    )
+    parser.add_argument(
+        "-g",
+        "--max_gap",
+        help=f"maximum fraction of gaps in the terminal columns kept (default={MAX_GAP})",
+        type=float,
+        default=MAX_GAP,
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.input):
+        print(f"File not found: {args.input}")
+        sys.exit(1)
+    try:
+        if args.convert:
+            count = convert_to_mul(args.input, args.output)
+        else:
+            count = prepare_seed(args.input, args.output, args.identity, args.max_gap)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print(f"{count} sequences written to {args.output}")
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""
+@author T. Paysan-Lafosse
+
+@brief Block-compressed fasta files with an accession index, replacing the uncompressed UniProtKB and MGnify files
+        <store>: BGZF file (gzip members of at most 64 KB, readable by zcat), fasta records as in the input files
+        <store>.npy: accession key (see dedup_sequences.encode_member), virtual offset (offset of the block
+        in the file << 16 | offset in the block) and length of each record, sorted by key
+        The input files (gzipped or not) are cut into chunks of records (CHUNK_SIZE), compressed by a pool of
+        processes into their own BGZF blocks (blocks are independent), the chunks are then written in order
+        The records of a batch of accessions are read in file order, each block is decompressed once
+
+@arguments [-f INPUT_FILE [INPUT_FILE ...]]: fasta files to store (e.g. uniprot_sprot.fasta.gz uniprot_trembl.fasta.gz)
+           [-o STORE]: store written from the input files
+           [-w WORKERS]: number of processes compressing the chunks (default=1)
+           [-m]: remove the truncated MGnify sequences (see filter_partial.py)
+           [-s STORE -a ACCESSION [ACCESSION ...]]: fasta records of the accessions (written to stdout)
+
+"""
+
+import argparse
+import io
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+
+from dedup_sequences import encode_member, header_accession, iter_fasta, iter_fasta_file
+from filter_partial import BLOCK_SIZE, KEEP_FLAGS, open_fasta
+
+INDEX_TYPE = np.dtype([("key", "u8"), ("voffset", "u8"), ("length", "u4")])
+# uncompressed data of a block, as written by bgzip
+BGZF_BLOCK_SIZE = 0xFF00
+# gzip header with the BC extra field giving the size of the block
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_HEADER_START = b"\x1f\x8b\x08\x04"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# uncompressed records compressed by a process at once
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_store_index(storefile):
+    return f"{storefile}.npy"
+
+
+def is_store(filename):
+    """
+    Whether filename is a BGZF file with an index
+    """
+    if not os.path.isfile(get_store_index(filename)):
+        return False
+    with open(filename, "rb") as f:
+        return f.read(4) == BGZF_HEADER_START
+
+
+def compress_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(
+        0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, BGZF_HEADER.size + len(deflated) + 7
+    )
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class bgzf_writer:
+    """
+    Write data in BGZF blocks, tell() gives the virtual offset of the next byte written
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.buffer = bytearray()
+
+    def tell(self):
+        return (self.output.tell() << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.output.write(compress_block(bytes(self.buffer[:BGZF_BLOCK_SIZE])))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def flush(self):
+        if self.buffer:
+            self.output.write(compress_block(bytes(self.buffer)))
+            self.buffer.clear()
+
+
+def iter_chunks(inputfile, filter_partial=False, chunk_size=CHUNK_SIZE):
+    """
+    Yield (data, keep) for the chunks of complete records of inputfile
+    keep: whether the records of the chunk before its first MGnify record are kept (see store_chunk)
+    """
+    # as filter_partial.py, records are kept with the previous MGnify sequence
+    keep = not filter_partial
+    remainder = b""
+    with open_fasta(inputfile) as input:
+        while True:
+            block = input.read(chunk_size)
+            data = remainder + block
+            if block:
+                cut = data.rfind(b"\n>") + 1
+                data, remainder = data[:cut], data[cut:]
+            if data:
+                yield data, keep
+                # state left by the last MGnify record of the chunk
+                pos = data.rfind(b"\n>MGY") + 1
+                if filter_partial and (pos or data.startswith(b">MGY")):
+                    eol = data.find(b"\n", pos)
+                    header = data[pos:] if eol == -1 else data[pos:eol]
+                    keep = any(flag in header for flag in KEEP_FLAGS)
+            if not block:
+                break
+
+
+def store_chunk(job):
+    """
+    Compress the records of a chunk into BGZF blocks (run by the workers)
+    Return (compressed data, index of the records with virtual offsets from the start of the chunk,
+    number of records, number of records stored)
+    """
+    data, keep, filter_partial = job
+    keys, voffsets, lengths = array("Q"), array("Q"), array("I")
+    total = stored = 0
+    output = io.BytesIO()
+    writer = bgzf_writer(output)
+    for header, sequence in iter_fasta(data):
+        total += 1
+        if filter_partial and header.startswith(b">MGY"):
+            keep = any(flag in header for flag in KEEP_FLAGS)
+        if not keep:
+            continue
+        if not header.endswith(b"\n"):
+            header += b"\n"
+        elif sequence and not sequence.endswith(b"\n"):
+            # last record of a file without end of line
+            sequence += b"\n"
+        stored += 1
+        try:
+            key = encode_member(header_accession(header))
+        except ValueError:
+            # stored, but not found by accession
+            key = None
+        if key is not None:
+            keys.append(key)
+            voffsets.append(writer.tell())
+            lengths.append(len(header) + len(sequence))
+        writer.write(header)
+        writer.write(sequence)
+    writer.flush()
+
+    index = np.empty(len(keys), dtype=INDEX_TYPE)
+    index["key"] = np.frombuffer(keys, dtype="u8")
+    index["voffset"] = np.frombuffer(voffsets, dtype="u8")
+    index["length"] = np.frombuffer(lengths, dtype="u4")
+    return output.getvalue(), index, total, stored
+
+
+def build_store(inputfiles, storefile, workers=1, filter_partial=False, chunk_size=CHUNK_SIZE):
+    """
+    Write the records of the input files to storefile and its index (written to temporary files
+    then renamed), return (number of records, number of records stored)
+    The chunks are sent to the pool with at most 2 chunks per worker waiting
+    """
+    jobs = (
+        (data, keep, filter_partial)
+        for inputfile in inputfiles
+        for data, keep in iter_chunks(inputfile, filter_partial, chunk_size)
+    )
+    tmpfile = f"{storefile}.tmp"
+    total = stored = 0
+    indexes = []
+    with open(tmpfile, "wb") as output, Pool(max(1, workers)) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * max(1, workers):
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending.append(pool.apply_async(store_chunk, (job,)))
+            if not pending:
+                break
+            compressed, index, chunk_total, chunk_stored = pending.popleft().get()
+            # the virtual offsets of the chunk start at the current end of the store
+            index["voffset"] += np.uint64(output.tell() << 16)
+            indexes.append(index)
+            output.write(compressed)
+            total += chunk_total
+            stored += chunk_stored
+        output.write(BGZF_EOF)
+
+    index = np.concatenate(indexes) if indexes else np.zeros(0, dtype=INDEX_TYPE)
+    # the first record of an accession is found first
+    index.sort(order="key", kind="stable")
+    np.save(get_store_index(tmpfile), index)
+    os.replace(get_store_index(tmpfile), get_store_index(storefile))
+    os.replace(tmpfile, storefile)
+    return total, stored
+
+
+class sequence_store:
+    """
+    Random access to the records of a store, by accession
+    """
+
+    def __init__(self, storefile):
+        self.storefile = storefile
+        # name used in the messages, as mmseqs_db
+        self.database = storefile
+        self.open()
+
+    def open(self):
+        self.file = open(self.storefile, "rb")
+        self.index = np.load(get_store_index(self.storefile), mmap_mode="r")
+        if len(self.index) == 0:
+            self.index = np.zeros(0, dtype=INDEX_TYPE)
+        # last block read: (offset, data, offset of the next block)
+        self.block = (None, b"", None)
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_block(self, offset):
+        """
+        Return (uncompressed data, offset of the next block) of the block at offset
+        """
+        if self.block[0] != offset:
+            header = os.pread(self.file.fileno(), BGZF_HEADER.size, offset)
+            if len(header) < BGZF_HEADER.size or not header.startswith(BGZF_HEADER_START):
+                raise ValueError(f"Invalid BGZF block at offset {offset} in {self.storefile}")
+            size = BGZF_HEADER.unpack(header)[-1] + 1
+            block = os.pread(self.file.fileno(), size, offset)
+            data = zlib.decompress(block[BGZF_HEADER.size : -8], -15)
+            self.block = (offset, data, offset + size)
+        return self.block[1:]
+
+    def read(self, voffset, length):
+        offset, start = voffset >> 16, voffset & 0xFFFF
+        chunks = []
+        while length > 0:
+            data, offset = self.read_block(offset)
+            chunk = data[start : start + length]
+            if not chunk:
+                raise ValueError(f"Truncated record in {self.storefile}")
+            chunks.append(chunk)
+            length -= len(chunk)
+            start = 0
+        return b"".join(chunks)
+
+    def locate(self, acc):
+        """
+        (virtual offset, length) of the record of acc (bytes), None if not found
+        """
+        try:
+            key = encode_member(acc)
+        except ValueError:
+            return None
+        i = np.searchsorted(self.index["key"], key)
+        if i < len(self.index) and self.index["key"][i] == key:
+            return int(self.index["voffset"][i]), int(self.index["length"][i])
+        return None
+
+    def get(self, acc):
+        """
+        Fasta record of acc (bytes), None if not found
+        """
+        location = self.locate(acc)
+        return self.read(*location) if location else None
+
+    def fetch(self, identifiers):
+        """
+        Return {identifier: (header, sequence)} for the requested accessions (bytes),
+        the header without '>', both ending with an end of line, as mmseqs_db.fetch
+        Missing accessions are left out
+        """
+        locations = {}
+        for identifier in identifiers:
+            location = self.locate(identifier)
+            if location:
+                locations[identifier] = location
+        entries = {}
+        # reading in file order
+        for identifier, location in sorted(locations.items(), key=lambda item: item[1]):
+            header, sequence = self.read(*location).split(b"\n", 1)
+            entries[identifier] = (header[1:] + b"\n", sequence)
+        return entries
+
+    def iter_blocks(self):
+        """
+        Yield the uncompressed data of each block, in file order
+        """
+        offset = 0
+        size = os.fstat(self.file.fileno()).st_size
+        while offset < size:
+            data, offset = self.read_block(offset)
+            yield data
+
+    def iter_records(self):
+        """
+        Yield (header line, sequence lines) for each record of the store, in file order
+        """
+        remainder = b""
+        chunks = []
+        length = 0
+        for data in self.iter_blocks():
+            chunks.append(data)
+            length += len(data)
+            if length >= BLOCK_SIZE:
+                # only complete records are parsed, the last one is kept for the next blocks
+                data = remainder + b"".join(chunks)
+                cut = data.rfind(b"\n>") + 1
+                data, remainder = data[:cut], data[cut:]
+                chunks, length = [], 0
+                yield from iter_fasta(data)
+        yield from iter_fasta(remainder + b"".join(chunks))
+
+    # only the file name is sent to other processes, the files are opened again on their side
+    def __getstate__(self):
+        return {"storefile": self.storefile}
+
+    def __setstate__(self, state):
+        self.storefile = state["storefile"]
+        self.database = self.storefile
+        self.open()
+
+
+class store_group:
+    """
+    Sequences read from several stores (e.g. UniProtKB and MGnify), in the order of the stores
+    """
+
+    def __init__(self, storefiles):
+        self.stores = [sequence_store(storefile) for storefile in storefiles]
+        self.database = " ".join(storefiles)
+
+    def fetch(self, identifiers):
+        identifiers = list(identifiers)
+        entries = {}
+        for store in self.stores:
+            entries.update(store.fetch(i for i in identifiers if i not in entries))
+        return entries
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--input_file", help="fasta files to store", nargs="+")
+    parser.add_argument("-o", "--output_file", help="store written from the input files")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes compressing the chunks (default=1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-m", "--filter_partial", help="remove the truncated MGnify sequences", action="store_true"
+    )
+    parser.add_argument("-s", "--store", help="store to read the sequences from")
+    parser.add_argument(
+        "-a", "--accessions", help="accessions of the sequences to extract", nargs="+"
+    )
+    args = parser.parse_args()
+
+    if args.input_file and args.output_file:
+        missing = [f for f in args.input_file if not os.path.isfile(f)]
+        if missing:
+            print(f"Input files not found: {' '.join(missing)}")
+            sys.exit(1)
+        total, stored = build_store(
+            args.input_file, args.output_file, args.workers, args.filter_partial
+        )
+        print(f"{stored} sequences stored out of {total} in {args.output_file}")
+    elif args.store and args.accessions:
+        if not is_store(args.store):
+            print(f"{args.store} is not an indexed BGZF file")
+            sys.exit(1)
+        store = sequence_store(args.store)
+        for acc in args.accessions:
+            record = store.get(acc.encode("utf-8"))
+            if record is None:
+                print(f"{acc} not found in {args.store}", file=sys.stderr)
+                continue
+            sys.stdout.buffer.write(record)
+    else:
+        parser.error("Expected -f and -o to build a store, or -s and -a to read sequences")
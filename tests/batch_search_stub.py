@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for "hmmbuild {input}.hmm {input} && hmmsearch -A {output} {input}.hmm pfamseq" used by the tests:
+one query per alignment of the Stockholm input (named by its #=GF ID), one alignment of hits per query written to
+the output, named by the query, the rows wrapped in blocks as hmmsearch does
+The queries named in $DROP have no hits, the search fails if $FAIL is set
+"""
+
+import os
+import sys
+
+WRAP = 5
+
+
+def read_queries(queryfile):
+    queries, name, rows = [], None, []
+    with open(queryfile) as f:
+        for line in f:
+            if line.startswith("# STOCKHOLM"):
+                name, rows = None, []
+            elif line.startswith("#=GF ID"):
+                name = line.split()[2]
+            elif line.startswith("//"):
+                if name is None:
+                    sys.exit("query without name")
+                if len({len(seq) for _, seq in rows}) != 1:
+                    sys.exit(f"rows of different widths in the query {name}")
+                queries.append((name, rows))
+            elif line.strip():
+                rows.append(line.split())
+    return queries
+
+
+if __name__ == "__main__":
+    queryfile, outputfile = sys.argv[1:3]
+    if os.environ.get("FAIL"):
+        sys.exit(1)
+    drop = os.environ.get("DROP", "").split()
+    with open(outputfile, "w") as out:
+        for name, rows in read_queries(queryfile):
+            if name in drop:
+                continue
+            out.write(f"# STOCKHOLM 1.0\n#=GF ID {name}\n#=GF AC PF_{name}\n\n")
+            hits = [(f"UPI{i}_{label}", seq.replace(".", "-")) for i, (label, seq) in enumerate(rows)]
+            for label, _ in hits:
+                out.write(f"#=GS {label} DE hit\n")
+            width = len(hits[0][1])
+            for start in range(0, width, WRAP):
+                out.write("\n")
+                for label, seq in hits:
+                    out.write(f"{label} {seq[start:start + WRAP]}\n")
+                out.write(f"#=GC RF {'x' * len(hits[0][1][start:start + WRAP])}\n")
+            out.write("//\n")
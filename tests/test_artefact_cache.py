@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from artefact_cache import artefact_cache, pfam_config_value, pfamseq_version
+
+
+def write_config(tmp_path, location):
+    config = tmp_path / "pfam.conf"
+    config.write_text(
+        "<database>\n  location /nfs/db\n</database>\n"
+        f"<pfamseq>\n  # pfamseq and its indexes\n  location = {location}\n  dbsize 12345\n</pfamseq>\n"
+    )
+    return str(config)
+
+
+def test_pfamseq_version(tmp_path, monkeypatch):
+    pfamseqdir = tmp_path / "pfamseq"
+    pfamseqdir.mkdir()
+    (pfamseqdir / "pfamseq").write_text(">P12345\nACDE\n")
+    config = write_config(tmp_path, pfamseqdir)
+    assert pfam_config_value(config, "pfamseq", "location") == str(pfamseqdir)
+    assert pfam_config_value(config, "pfamseq", "dbsize") == "12345"
+    assert pfam_config_value(config, "database", "dbsize") is None
+
+    monkeypatch.setenv("PFAM_CONFIG", config)
+    version = pfamseq_version()
+    assert version.startswith(f"{pfamseqdir / 'pfamseq'}:13:")
+    # new release
+    (pfamseqdir / "pfamseq").write_text(">P12345\nACDEF\n")
+    assert pfamseq_version() != version
+
+    monkeypatch.delenv("PFAM_CONFIG")
+    assert pfamseq_version() is None
+    assert pfamseq_version(write_config(tmp_path, tmp_path / "missing")) is None
+
+
+def test_stage_keys(tmp_path):
+    seed = tmp_path / "SEED"
+    seed.write_text("P12345/1-4 ACDE\n")
+    tool = tmp_path / "liftover_alignment.pl"
+    tool.write_text("print 1;\n")
+
+    cache = artefact_cache(str(tmp_path / "cache"), 1 << 30, "pfamseq:1:1")
+    alignment = cache.stage_key(str(seed), ("create_alignment.pl",), "-m")
+    liftover = cache.stage_key(str(seed), (str(tool),), pfamseq=True)
+
+    # only the keys of the stages searching pfamseq depend on its version
+    other = artefact_cache(str(tmp_path / "cache"), 1 << 30, "pfamseq:2:2")
+    assert other.stage_key(str(seed), ("create_alignment.pl",), "-m") == alignment
+    assert other.stage_key(str(seed), (str(tool),), pfamseq=True) != liftover
+
+    with pytest.raises(ValueError):
+        artefact_cache(str(tmp_path / "cache"), 1 << 30).stage_key(str(seed), (), pfamseq=True)
+
+
+def test_restore(tmp_path):
+    cache = artefact_cache(str(tmp_path / "cache"), 1 << 30, "pfamseq:1:1")
+    first, second = tmp_path / "PF1", tmp_path / "PF2"
+    first.mkdir()
+    second.mkdir()
+    (first / "PF1_SEED.phmmer").write_text("lifted\n")
+    key = cache.stage_key(str(first / "PF1_SEED.phmmer"), (), pfamseq=True)
+    cache.store(key, "liftover", str(first), "PF1", ("{family}_SEED.phmmer",))
+    assert not cache.restore(key, "pfbuild", str(second), "PF2")
+    assert cache.restore(key, "liftover", str(second), "PF2")
+    assert os.path.isfile(second / "PF2_SEED.phmmer")
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+
+from batch_liftover import combine_seeds, read_alignments, run_batch, split_output
+from seed_alignment import read_alignment
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_search_stub.py")
+SEARCH = f"{sys.executable} {STUB} {{input}} {{output}}"
+
+# SEED alignments of different widths
+SEEDS = {
+    "Pfam-M_000001": ["MGYP000000000001/1-6 ACDEFG", "P12345/3-7       AC.EFG"],
+    "Pfam-M_000002": ["MGYP000000000002/1-9 MKLVACDEF", "Q12345/1-8       MKL.ACDEF", "A0A023/2-5       ..LVAC..."],
+    "Pfam-M_000003": ["MGYP000000000003/1-3 WWW", "P99999/1-3       WYW"],
+}
+
+
+def make_families(tmp_path):
+    familydirs = []
+    for family, rows in SEEDS.items():
+        familydir = tmp_path / family
+        familydir.mkdir()
+        (familydir / f"{family}_SEED").write_text("".join(f"{row}\n" for row in rows))
+        familydirs.append(str(familydir))
+    return familydirs
+
+
+def test_combine_seeds(tmp_path):
+    familydirs = make_families(tmp_path)
+    queryfile = str(tmp_path / "batch.seed")
+    assert combine_seeds(familydirs + [str(tmp_path / "Pfam-M_000004")], queryfile) == list(SEEDS)
+    # one named alignment per family
+    queries = list(read_alignments(queryfile))
+    assert [name for name, _ in queries] == list(SEEDS)
+    for (family, lines), rows in zip(queries, SEEDS.values()):
+        assert [line.split() for line in lines] == [row.split() for row in rows]
+
+
+def test_run_batch(tmp_path):
+    familydirs = make_families(tmp_path)
+    assert run_batch(SEARCH, str(tmp_path / "batch_1"), familydirs) == len(SEEDS)
+    for family, rows in SEEDS.items():
+        hits = read_alignment(str(tmp_path / family / f"{family}_SEED.phmmer"))
+        assert hits.names == [f"UPI{i}_{row.split('/')[0]}" for i, row in enumerate(rows)]
+        assert hits.matrix.shape == (len(rows), len(rows[0].split()[1]))
+        assert not os.path.exists(tmp_path / family / f"{family}_SEED.phmmer.sto")
+
+
+def test_split_output_missing_family(tmp_path):
+    familydirs = make_families(tmp_path)
+    queryfile, outputfile = str(tmp_path / "batch.seed"), str(tmp_path / "batch.phmmer")
+    combine_seeds(familydirs, queryfile)
+    env = dict(os.environ, DROP="Pfam-M_000002")
+    subprocess.run([sys.executable, STUB, queryfile, outputfile], env=env, check=True)
+    assert split_output(outputfile, familydirs) == ["Pfam-M_000001", "Pfam-M_000003"]
+    assert not os.path.exists(tmp_path / "Pfam-M_000002" / "Pfam-M_000002_SEED.phmmer")
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from cluster_archive import cluster_archive, cluster_archive_writer
+
+CLUSTERS = {"MGYP000000000001": b">MGYP000000000001\nMKLV\n", "P12345": b">P12345\nACDE\n>Q12345\nACDF\n"}
+
+
+def write_archive(archive, clusters):
+    with cluster_archive_writer(archive) as writer:
+        for rep, content in clusters.items():
+            writer.add(rep, content)
+
+
+def test_archive_written_again(tmp_path):
+    archive = str(tmp_path / "clusters")
+    write_archive(archive, CLUSTERS)
+    # archive step run again: the archive is replaced, not appended to
+    write_archive(archive, CLUSTERS)
+    with open(f"{archive}.index") as f:
+        assert len(f.readlines()) == len(CLUSTERS)
+    assert os.path.getsize(f"{archive}.dat") == sum(len(c) for c in CLUSTERS.values())
+    with cluster_archive(archive) as reader:
+        assert {rep: reader.get(rep) for rep in reader} == CLUSTERS
+        assert reader.get("MGYP000000000002") is None
+
+
+def test_archive_kept_on_error(tmp_path):
+    archive = str(tmp_path / "clusters")
+    write_archive(archive, CLUSTERS)
+    with pytest.raises(RuntimeError):
+        with cluster_archive_writer(archive) as writer:
+            writer.add("MGYP000000000002", b">MGYP000000000002\nWW\n")
+            raise RuntimeError("interrupted")
+    with cluster_archive(archive) as reader:
+        assert set(reader) == set(CLUSTERS)
+    assert sorted(os.listdir(tmp_path)) == ["clusters.dat", "clusters.index"]
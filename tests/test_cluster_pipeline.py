@@ -0,0 +1,31 @@
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_dry_run_fresh_tree(tmp_path):
+    # copy of the scripts without data directory (UniProt never fetched)
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    for name in ("cluster_pipeline.py", "pipeline_ledger.py"):
+        shutil.copy(os.path.join(ROOT, name), tree)
+    (tmp_path / "mgnify" / "2019_05").mkdir(parents=True)
+    config = tmp_path / "clustering.cfg"
+    config.write_text(
+        f'MGNIFY_VERSION="2019_05"\nMGNIFYDIR="{tmp_path / "mgnify"}"\n'
+        f'PFAM_DIR="{tmp_path / "pfam"}"\nUPDATE_UNIPROT="yes"\n'
+    )
+    result = subprocess.run(
+        [sys.executable, str(tree / "cluster_pipeline.py"), str(config), "-n"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Step dedup: running" in result.stdout
+    assert "Step select: running" in result.stdout
+    assert "Step table: running" in result.stdout
+    # nothing written in the clustering directory
+    assert not (tmp_path / "pfam").exists()
@@ -0,0 +1,106 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import cluster_state
+from cluster_state import get_state_file, membership_digest
+from dedup_sequences import encode_member
+from test_mmseqs_db import write_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# clusters of the synthetic releases (representative first)
+CLUSTERS = [
+    [b"MGYP000000000001", b"MGYP000000000002", b"P11111"],
+    [b"MGYP000000000003", b"Q22222"],
+    [b"MGYP000000000004", b"MGYP000000000005"],
+]
+
+
+def write_release(releasedir, clusters):
+    """
+    Cluster table and sequence database of a release, as created by mmseqs createtsv and createdb
+    """
+    releasedir.mkdir()
+    with open(releasedir / "mgy_seqs.cluster.tsv", "wb") as f:
+        for members in clusters:
+            for member in members:
+                f.write(members[0] + b"\t" + member + b"\n")
+    records = [
+        (member, member + b"\n", b"MKLV" * (i + 1) + b"\n")
+        for i, member in enumerate(m for members in clusters for m in members)
+    ]
+    write_database(str(releasedir / "mgy_seqs.mmseqs"), records)
+
+
+def write_list(listfile, accessions):
+    with open(listfile, "w") as f:
+        f.write("".join(f"{acc}\n" for acc in accessions))
+    # newer than the index of the previous content
+    mtime = os.path.getmtime(listfile) + 10
+    os.utime(listfile, (mtime, mtime))
+
+
+def get_stats(releasedir, listdir, previous=None):
+    command = [
+        sys.executable,
+        os.path.join(ROOT, "get_stats.py"),
+        "-i", str(releasedir / "mgy_seqs.cluster.tsv"),
+        "-x", str(releasedir / "mgy_seqs.mmseqs"),
+        "-f", str(listdir / "proteins_not_in_pfam.txt"),
+        "-y", str(listdir / "swissprot.txt"),
+        "-t", "-a", "-k", "10",
+        "-u", "user", "-p", "password", "-s", "schema",
+    ]
+    if previous:
+        command += ["-v", str(previous / "mgy_seqs.cluster.tsv_summary")]
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    with open(releasedir / "mgy_seqs.cluster.tsv_summary") as f:
+        return result.stdout, f.read()
+
+
+def test_release_with_list_rewritten_in_place(tmp_path):
+    listdir = tmp_path / "lists"
+    listdir.mkdir()
+    write_list(listdir / "proteins_not_in_pfam.txt", ["P11111", "Q22222"])
+    write_list(listdir / "swissprot.txt", ["P11111"])
+
+    write_release(tmp_path / "r1", CLUSTERS)
+    get_stats(tmp_path / "r1", listdir)
+    assert os.path.isfile(get_state_file(str(tmp_path / "r1" / "mgy_seqs.cluster.tsv_summary")))
+
+    # next release: same clusters, same lists
+    write_release(tmp_path / "r2", CLUSTERS)
+    output, summary = get_stats(tmp_path / "r2", listdir, tmp_path / "r1")
+    assert "3 clusters unchanged since the previous release, 0 computed" in output
+
+    # next release: Q22222 now in Pfam, the list being rewritten with the same name
+    write_list(listdir / "proteins_not_in_pfam.txt", ["P11111"])
+    write_release(tmp_path / "r3", CLUSTERS)
+    output, summary = get_stats(tmp_path / "r3", listdir, tmp_path / "r2")
+    assert "2 clusters unchanged since the previous release, 1 computed" in output
+
+    # same statistics as without the previous release
+    write_release(tmp_path / "r4", CLUSTERS)
+    _, expected = get_stats(tmp_path / "r4", listdir)
+    assert summary == expected
+    assert summary.splitlines()[1].split("\t")[-1] == "1"
+
+
+def test_is_changed(tmp_path, monkeypatch):
+    changedfile = str(tmp_path / "changed.npy")
+    np.save(changedfile, np.array(sorted(encode_member(acc) for acc in [b"Q22222", b"MGYP000000000004"]), dtype="u8"))
+    statefile = str(tmp_path / "summary.state.npy")
+    np.save(statefile, np.zeros(0, dtype=cluster_state.STATE_TYPE))
+    state = cluster_state.cluster_state(statefile, changedfile)
+    for size in (cluster_state.CHANGED_SET_SIZE, 0):
+        # changed accessions in a set, or keys searched in the sorted array
+        monkeypatch.setattr(cluster_state, "CHANGED_SET_SIZE", size)
+        state.changed_accessions = None
+        assert state.is_changed(CLUSTERS[1])
+        assert state.is_changed(CLUSTERS[2])
+        assert not state.is_changed(CLUSTERS[0])
+    assert membership_digest(CLUSTERS[0]) != membership_digest(CLUSTERS[1])
@@ -0,0 +1,44 @@
+import random
+from collections import namedtuple
+
+import numpy as np
+
+from cluster_table import cluster_table, cluster_table_writer, round_percent
+from get_stats import summary_statistics
+
+summary = namedtuple("summary", "rep members mgnify swissprot inpfam")
+
+
+def make_row(rep, start, members, mgnify, swissprot=0, inpfam=0):
+    trembl = members - mgnify - swissprot
+    return (rep, start, start + 10, members, mgnify, swissprot, trembl, inpfam, 100, 90, 110, 100.0, 1)
+
+
+def test_round_percent_as_round():
+    random.seed(1)
+    totals = [20000, 4000, 3, 7, 8] + [random.randint(2, 10 ** 7) for _ in range(2000)]
+    counts = [1, 3999, 1, 3, 1] + [random.randint(0, t) for t in totals[5:]]
+    rounded = round_percent(np.array(counts, dtype="u4"), np.array(totals, dtype="u4"))
+    # np.round gives 0.0 and 99.98
+    assert rounded[0] == 0.01 and rounded[1] == 99.97
+    assert list(rounded) == [round(c * 100 / t, 2) for c, t in zip(counts, totals)]
+
+
+def test_qualifying_as_get_stats(tmp_path):
+    rows = [
+        make_row(b"MGYP1", 0, 20000, 1),
+        make_row(b"MGYP2", 10, 200000, 199999),
+        make_row(b"MGYP3", 20, 5, 0),
+        make_row(b"MGYP4", 30, 1, 0),
+        make_row(b"MGYP5", 40, 4, 2, inpfam=1),
+        make_row(b"MGYP6", 50, 40, 20, 10),
+    ]
+    tabledir = str(tmp_path / "table")
+    with cluster_table_writer(tabledir) as writer:
+        writer.append(rows)
+    table = cluster_table(tabledir)
+    expected = [
+        summary_statistics(summary(row[0], row[3], row[4], row[5], row[7])) is not None for row in rows
+    ]
+    assert list(table.qualifying()) == expected == [True, False, False, False, False, True]
+    assert list(table.top(10)) == [0, 5]
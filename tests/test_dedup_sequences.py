@@ -0,0 +1,90 @@
+import numpy as np
+
+from dedup_sequences import (
+    NO_KEY,
+    decode_member,
+    dedup_files,
+    duplicate_index,
+    duplicate_index_writer,
+    encode_member,
+    iter_unique,
+    record_key,
+)
+
+
+def write_fasta(filename, records):
+    with open(filename, "w") as f:
+        for header, sequence in records:
+            f.write(f">{header}\n{sequence}\n")
+
+
+def read_headers(filename):
+    with open(filename) as f:
+        return [line[1:].strip() for line in f if line.startswith(">")]
+
+
+def test_member_keys():
+    for acc in (b"MGYP000000000123", b"P12345", b"A0A023GPI8"):
+        assert decode_member(encode_member(acc)) == acc
+    assert record_key(b">sp|P12345|NAME desc\n") == encode_member(b"P12345")
+    # not written back identically
+    assert record_key(b">MGYP12\n") == NO_KEY
+    assert record_key(b">weird_id\n") == NO_KEY
+
+
+def test_dedup(tmp_path):
+    uniprot = str(tmp_path / "uniprot.fa")
+    mgnify = str(tmp_path / "mgnify.fa")
+    write_fasta(
+        uniprot,
+        [
+            ("sp|P12345|NAME", "MKV"),
+            ("weird_id", "WWW"),
+            ("tr|A0A023GPI8|X", "mk v"),
+            ("P99999", "AAA"),
+        ],
+    )
+    write_fasta(
+        mgnify,
+        [
+            ("MGYP000000000001 PL=00", "MKV"),
+            ("MGYP000000000002 PL=00", "WWW"),
+            ("MGYP000000000003 PL=00", "CCC"),
+            ("MGYP000000000004 PL=00", "AAA"),
+            ("MGYP000000000005 PL=00", "CCC"),
+        ],
+    )
+    outputs = [str(tmp_path / "uniprot_unique.fa"), str(tmp_path / "mgnify_unique.fa")]
+    dupsfile = str(tmp_path / "unique.dups")
+    # several buckets and ranges of records
+    total, duplicates = dedup_files([uniprot, mgnify], outputs, dupsfile, buckets=3, range_size=2)
+    assert (total, duplicates) == (9, 4)
+    assert read_headers(outputs[0]) == ["sp|P12345|NAME", "weird_id", "P99999"]
+    # the duplicates of a sequence first found with an unknown identifier are kept
+    assert read_headers(outputs[1]) == ["MGYP000000000002 PL=00", "MGYP000000000003 PL=00"]
+
+    index = duplicate_index(dupsfile)
+    assert len(index) == 4
+    assert index.get(b"P12345") == [b"tr|A0A023GPI8|X\n", b"MGYP000000000001 PL=00\n"]
+    assert index.get(b"P99999") == [b"MGYP000000000004 PL=00\n"]
+    assert index.get(b"MGYP000000000003") == [b"MGYP000000000005 PL=00\n"]
+    assert index.get(b"weird_id") == []
+    index.close()
+
+    # without output files, the unique sequences are read again from the input files
+    dupsfile = str(tmp_path / "mgy_seqs.dups")
+    assert dedup_files([uniprot, mgnify], None, dupsfile, buckets=3, range_size=2) == (9, 4)
+    unique = [header[1:].strip().decode() for header, _ in iter_unique([uniprot, mgnify], dupsfile)]
+    assert unique == read_headers(outputs[0]) + read_headers(outputs[1])
+    assert duplicate_index(dupsfile).get(b"P12345") == [b"tr|A0A023GPI8|X\n", b"MGYP000000000001 PL=00\n"]
+
+
+def test_index_writer_merges_runs(tmp_path):
+    indexfile = str(tmp_path / "dups.npy")
+    writer = duplicate_index_writer(indexfile, str(tmp_path), chunk_size=3)
+    entries = [(5, 0), (2, 10), (5, 20), (1, 30), (2, 40), (9, 50), (1, 60)]
+    for key, offset in entries:
+        writer.add(key, offset)
+    writer.close()
+    index = np.load(indexfile)
+    assert [tuple(map(int, entry)) for entry in index] == sorted(entries)
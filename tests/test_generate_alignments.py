@@ -0,0 +1,132 @@
+import os
+import stat
+
+from batch_liftover import liftover_batch
+from family_state import ALIGNING, LIFTOVER, PFBUILD, family_db
+from generate_alignments import alignments
+from job_executor import fake_executor, local_executor
+
+
+def make_alignments(tmp_path, executor):
+    al = alignments()
+    al.aligned_dir = str(tmp_path)
+    al.db = family_db(str(tmp_path / "families.db"))
+    al.set_executor(executor)
+    return al
+
+
+def add_family(al, family, state, job=None, files=()):
+    os.makedirs(os.path.join(al.aligned_dir, family), exist_ok=True)
+    for name in files:
+        with open(os.path.join(al.aligned_dir, family, name), "w") as f:
+            f.write("output\n")
+    al.db.add([(family, f"MGYP00000000000{family[-1]}")])
+    if state != ALIGNING:
+        al.db.transition(family, ALIGNING, LIFTOVER, job)
+    if state == PFBUILD:
+        al.db.transition(family, LIFTOVER, PFBUILD, job)
+
+
+def test_resume_dead_jobs(tmp_path):
+    executor = fake_executor(auto=False, running={"1234"})
+    al = make_alignments(tmp_path, executor)
+    add_family(al, "PF1", LIFTOVER, "999")  # job ended without output
+    add_family(al, "PF2", LIFTOVER, "1234")  # job still running
+    add_family(al, "PF3", LIFTOVER, "999", ["PF3_SEED.phmmer"])  # output written
+    add_family(al, "PF4", LIFTOVER)  # job queued when the previous run stopped
+    add_family(al, "PF5", PFBUILD, "999")
+
+    submitted = []
+    for family in al.db.families(LIFTOVER, PFBUILD):
+        stage = "liftover" if family["state"] == LIFTOVER else "pfbuild"
+        resubmitted = al.resume_family(
+            stage,
+            family,
+            ("{family}_SEED.phmmer",),
+            lambda name, familydir: executor.submit(stage, name, "true", familydir),
+        )
+        if resubmitted:
+            submitted.append(family["family"])
+
+    assert submitted == ["PF1", "PF4", "PF5"]
+    # the new jobs are saved, the states are unchanged
+    assert al.db.get("PF1")["job"] == al.job_handle("liftover", "PF1") == "fake_0"
+    assert al.db.get("PF1")["state"] == LIFTOVER and al.db.get("PF1")["attempts"] == 1
+    assert al.db.get("PF2")["job"] == "1234"
+    assert al.db.get("PF5")["job"] == "fake_2"
+    # families submitted by this run aren't checked again
+    assert not al.resume_family("liftover", al.db.get("PF1"), (), None)
+
+
+def test_record_jobs(tmp_path):
+    executor = fake_executor({"liftover": 1}, auto=False)
+    al = make_alignments(tmp_path, executor)
+    add_family(al, "PF1", LIFTOVER)
+    add_family(al, "PF2", LIFTOVER)
+    first = executor.submit("liftover", "PF1", "true")
+    executor.submit("liftover", "PF2", "true")
+    recorded = {}
+    al.record_jobs("liftover", LIFTOVER, ["PF1", "PF2"], recorded)
+    # PF2 queued, saved once started
+    assert recorded == {"PF1": "fake_0"}
+    assert al.db.get("PF2")["job"] is None
+    executor.complete(first)
+    al.record_jobs("liftover", LIFTOVER, ["PF1", "PF2"], recorded)
+    assert al.db.get("PF2")["job"] == "fake_1"
+
+
+def test_batch_submitted(tmp_path):
+    executor = fake_executor(auto=False)
+    al = make_alignments(tmp_path, executor)
+    al.batch = liftover_batch(
+        executor, "search {input} {output}", 2, str(tmp_path / "batches"), al.batch_submitted
+    )
+    for family in ("PF1", "PF2", "PF3"):
+        add_family(al, family, ALIGNING)
+        al.batch.add(family, os.path.join(al.aligned_dir, family))
+    # PF3 waits for its batch, it stays in the alignment stage
+    assert [f["family"] for f in al.db.families(LIFTOVER)] == ["PF1", "PF2"]
+    assert al.db.get("PF1")["job"] == al.db.get("PF2")["job"] == "fake_0"
+    assert al.db.get("PF3")["state"] == ALIGNING
+    assert "PF3" in al.batch and al.batch.job("PF3") is None
+    al.batch.flush()
+    assert al.db.get("PF3")["state"] == LIFTOVER
+    assert al.job_handle("liftover", "PF3") == "fake_1"
+
+
+def test_resume_detached_job(tmp_path, monkeypatch):
+    # bjobs reporting the jobs listed in running as running
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    running = tmp_path / "running"
+    running.write_text("4242\n")
+    bjobs = bindir / "bjobs"
+    bjobs.write_text(f'#!/bin/bash\nif grep -qx "${{@: -1}}" {running}; then echo RUN; else echo DONE; fi\n')
+    bjobs.chmod(bjobs.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bindir}:{os.environ['PATH']}")
+
+    aligned_dir = tmp_path / "families"
+    aligned_dir.mkdir()
+    executor = local_executor()
+    al = make_alignments(aligned_dir, executor)
+    add_family(al, "PF1", LIFTOVER)
+    # the command submits the farm job and returns, the output isn't written yet
+    job = executor.submit(
+        "liftover", "PF1", "echo 'Job <4242> is submitted to queue <normal>.'", str(aligned_dir), detached=True
+    )
+    assert executor.wait([job], timeout=10)
+    recorded = {}
+    al.record_jobs("liftover", LIFTOVER, ["PF1"], recorded)
+    assert al.db.get("PF1")["job"] == "lsf:4242"
+
+    # next run, the submitter exited but the farm job is still running
+    submitted = []
+    later = make_alignments(aligned_dir, local_executor())
+    resume = lambda: later.resume_family(
+        "liftover", later.db.get("PF1"), ("{family}_SEED.phmmer",), lambda name, familydir: submitted.append(name)
+    )
+    assert not resume()
+    # the farm job ended without output
+    running.write_text("")
+    assert resume()
+    assert submitted == ["PF1"]
@@ -0,0 +1,68 @@
+import pytest
+
+from cluster_table import cluster_table
+from cluster_tsv import tsv_reader
+from get_stats import process_cluster, select_top, write_table
+from mmseqs_db import mmseqs_db
+from test_mmseqs_db import RECORDS, write_database
+
+
+def candidates():
+    # (rep, count_total, percentmgy, percentswiss), start, end
+    rows = [
+        (("MGYP1", 10, 50.0, 0.0), 0, 10),
+        (("MGYP2", 30, 100.0, 0.0), 10, 20),
+        (("MGYP3", 20, 90.0, 5.0), 20, 30),
+        (("MGYP4", 30, 80.0, 0.0), 30, 40),
+    ]
+    return iter(rows)
+
+
+def test_select_top_by_size():
+    selected = select_top(candidates(), 3)
+    # ties in file order
+    assert [stats[0] for stats, _, _ in selected] == ["MGYP2", "MGYP4", "MGYP3"]
+
+
+def test_select_top_by_score():
+    selected = select_top(candidates(), 2, "swissprot")
+    assert [stats[0] for stats, _, _ in selected] == ["MGYP3", "MGYP2"]
+
+
+def test_select_top_none():
+    assert select_top(candidates(), 0) == []
+    assert select_top(candidates(), -1) == []
+    assert select_top(iter([]), 5) == []
+
+
+def test_table_from_cluster_tsv(tmp_path):
+    database = str(tmp_path / "mgy_seqs.mmseqs")
+    write_database(database, RECORDS)
+    tsvfile = tmp_path / "mgy_seqs.cluster.tsv"
+    tsvfile.write_bytes(
+        b"MGYP000000000003\tMGYP000000000003\nMGYP000000000003\tP12345\n"
+        b"MGYP000000000003\tMGYP000000000001\nA0A023GPI8\tA0A023GPI8\n"
+    )
+    pc = process_cluster(str(tmp_path))
+    pc.protein_dict = {b"P12345", b"A0A023GPI8"}
+    pc.swissprot = {b"P12345"}
+    pc.sequence_db = mmseqs_db(database)
+    tabledir = str(tmp_path / "table")
+    # the sequences are read by the workers
+    with tsv_reader(str(tsvfile)) as reader:
+        write_table(pc, reader, tabledir, 2)
+    table = cluster_table(tabledir)
+    rows = [table.row(i) for i in range(len(table))]
+    assert [row["rep"] for row in rows] == [b"MGYP000000000003", b"A0A023GPI8"]
+    values = lambda row, *names: [int(row[name]) for name in names]
+    assert values(rows[0], "members", "mgnify", "swissprot", "trembl", "inpfam") == [3, 2, 1, 0, 0]
+    # lengths of MKLV, ACDEFGH, MKK, partial classes 00 and 10
+    assert values(rows[0], "rep_length", "min_length", "max_length", "partial_classes") == [4, 3, 7, 2]
+    assert rows[0]["median_length"] == 4.0
+    assert values(rows[1], "members", "trembl", "rep_length", "partial_classes") == [1, 1, 3, 0]
+
+    # member missing from the database
+    with open(tsvfile, "ab") as f:
+        f.write(b"MGYP000000000002\tMGYP000000000002\n")
+    with tsv_reader(str(tsvfile)) as reader, pytest.raises(KeyError):
+        write_table(pc, reader, tabledir, 1)
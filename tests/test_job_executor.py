@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+
+import pytest
+
+import complete_desc_file
+from complete_desc_file import DESC_STEPS, DESC_WRITERS, complete_desc, desc_order
+from job_executor import (
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    executor,
+    fake_executor,
+    farm_job,
+    local_executor,
+    parse_limits,
+    process_start,
+)
+
+
+def states(executor, stage):
+    return executor.summary()[stage]
+
+
+def test_parse_limits():
+    assert parse_limits(["liftover=2", "desc=8"]) == {"liftover": 2, "desc": 8}
+    assert parse_limits(None) == {}
+    for value in ("liftover", "liftover=0", "=2", "liftover=x"):
+        with pytest.raises(ValueError):
+            parse_limits([value])
+
+
+def test_backend_required():
+    # launch and alive are implemented by the backends
+    with pytest.raises(TypeError):
+        executor()
+
+
+def test_stage_limits():
+    executor = fake_executor({"liftover": 2}, auto=False)
+    jobs = [executor.submit("liftover", f"PF{i}", "true") for i in range(5)]
+    pfbuild = [executor.submit("pfbuild", f"PF{i}", "true") for i in range(3)]
+    # stages without limit start all their jobs
+    assert [j.state for j in jobs] == [RUNNING] * 2 + [PENDING] * 3
+    assert all(j.state == RUNNING for j in pfbuild)
+    assert states(executor, "liftover") == {PENDING: 3, RUNNING: 2, DONE: 0, FAILED: 0}
+
+    # a job ending starts the next job of its stage, in submission order
+    executor.complete(jobs[1])
+    assert jobs[1].state == DONE
+    assert [j.state for j in jobs[2:]] == [RUNNING, PENDING, PENDING]
+    executor.complete(jobs[0], 1)
+    assert jobs[0].state == FAILED and jobs[0].returncode == 1
+    assert states(executor, "liftover") == {PENDING: 1, RUNNING: 2, DONE: 1, FAILED: 1}
+    assert [j.name for j in executor.launched if j.stage == "liftover"] == ["PF0", "PF1", "PF2", "PF3"]
+
+
+def test_detached_jobs_keep_their_slot():
+    executor = fake_executor({"pfbuild": 1}, auto=False)
+    first = executor.submit("pfbuild", "PF1", "pfbuild", detached=True)
+    second = executor.submit("pfbuild", "PF2", "pfbuild", detached=True)
+    # the command returned, the farm job it submitted is still running
+    executor.complete(first)
+    assert executor.wait([first], timeout=0)
+    assert first.state == RUNNING and second.state == PENDING
+    executor.finish("pfbuild", "PF1")
+    assert first.state == DONE and second.state == RUNNING
+    executor.complete(second)
+    executor.finish("pfbuild", "PF2", success=False)
+    assert states(executor, "pfbuild") == {PENDING: 0, RUNNING: 0, DONE: 1, FAILED: 1}
+
+
+def test_job_handles():
+    assert farm_job("Job <12> is submitted to queue <normal>.\nJob <34> is submitted to queue <long>.\n") == "34"
+    assert farm_job("Successfully completed.\n") is None
+    executor = fake_executor(auto=False)
+    j = executor.submit("pfbuild", "PF1", "pfbuild", detached=True)
+    assert j.handle == "fake_0"
+    # the farm job submitted by the command is checked once it returned
+    executor.complete(j, output="Job <12> is submitted to queue <normal>.\n")
+    assert j.handle == "lsf:12"
+    assert executor.alive("lsf:12") and not executor.alive("fake_0")
+
+    # a process reusing the PID of the job isn't taken for it
+    local = local_executor()
+    start = process_start(os.getpid())
+    assert local.alive(f"{os.getpid()}@{start}")
+    assert not local.alive(f"{os.getpid()}@{int(start) + 1}")
+
+
+def test_resubmitted_job_replaces_previous():
+    executor = fake_executor({"liftover": 1}, auto=False)
+    first = executor.submit("liftover", "PF1", "true")
+    second = executor.submit("liftover", "PF1", "true")
+    assert first.state == FAILED
+    assert second.state == RUNNING
+    assert executor.get("liftover", "PF1") is second
+    # the command of the replaced job returning doesn't change its state
+    executor.complete(first, 0)
+    assert first.state == FAILED
+    assert states(executor, "liftover") == {PENDING: 0, RUNNING: 1, DONE: 0, FAILED: 0}
+
+
+def test_complete_desc(tmp_path):
+    familydir = tmp_path / "PF1"
+    familydir.mkdir()
+    executor = fake_executor({"desc": 1}, results={("desc", "PF1:duffem"): 2})
+    steps = complete_desc(str(familydir), executor)
+
+    assert steps["duffem"]["status"] == 2
+    # steps requiring a failed step are skipped, the others run
+    assert steps["nextDUF"]["status"] is None
+    assert steps["pqc-overlap-rdb"]["status"] is None
+    assert steps["add_pdb_ref"]["status"] == 0
+    assert states(executor, "desc")[FAILED] == 1
+    assert states(executor, "desc")[DONE] == len(DESC_STEPS) - 3
+
+    # each step launched after the steps it requires
+    launched = [j.name.split(":")[1] for j in executor.launched]
+    for step in launched:
+        for required in DESC_STEPS[step][2]:
+            assert launched.index(required) < launched.index(step)
+    with open(familydir / "complete_desc.json") as f:
+        assert json.load(f)["steps"] == steps
+
+
+def test_desc_writers_one_at_a_time(tmp_path):
+    familydir = tmp_path / "PF1"
+    familydir.mkdir()
+    executor = fake_executor(auto=False)
+    # set when jobs start or end
+    started = threading.Event()
+    executor.add_listener(started.set)
+    thread = threading.Thread(target=complete_desc, args=(str(familydir), executor))
+    thread.start()
+    completed = []
+    while len(completed) < len(DESC_STEPS):
+        assert started.wait(5)
+        started.clear()
+        with executor.condition:
+            running = [j for j in executor.jobs.values() if j.state == RUNNING]
+        steps = [j.name.split(":")[1] for j in running]
+        # the lookups reading the family files run with the steps writing the DESC file
+        assert sum(step in DESC_WRITERS for step in steps) <= 1
+        for j in running:
+            executor.complete(j)
+            completed.append(j.name)
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_desc_order_writers(monkeypatch):
+    order = desc_order()
+    writers = [step for step in order if step in DESC_WRITERS]
+    assert writers == list(DESC_WRITERS)
+    steps = dict(DESC_STEPS)
+    steps["duffem"] = steps["duffem"][:2] + ((),)
+    monkeypatch.setattr(complete_desc_file, "DESC_STEPS", steps)
+    with pytest.raises(ValueError):
+        desc_order()
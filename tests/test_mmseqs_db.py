@@ -0,0 +1,69 @@
+import os
+import pickle
+import time
+
+from mmseqs_db import get_key_index, mmseqs_db
+
+RECORDS = [
+    (b"MGYP000000000003", b"MGYP000000000003 PL=00\n", b"MKLV\n"),
+    (b"P12345", b"sp|P12345|NAME_HUMAN\n", b"ACDEFGH\n"),
+    (b"MGYP000000000001", b"MGYP000000000001 PL=10\n", b"MKK\n"),
+    (b"A0A023GPI8", b"tr|A0A023GPI8|X\n", b"WWW\n"),
+    (b"not_an_accession", b"not_an_accession\n", b"AAA\n"),
+]
+
+
+def write_database(database, records, order=None):
+    """
+    MMseqs2 sequence database as written by mmseqs createdb, with the index entries in the given order
+    """
+    order = order or range(len(records))
+    for suffix, part in (("", 2), ("_h", 1)):
+        offsets = {}
+        with open(f"{database}{suffix}", "wb") as f:
+            for key, record in enumerate(records):
+                offsets[key] = (f.tell(), len(record[part]) + 1)
+                f.write(record[part] + b"\0")
+        with open(f"{database}{suffix}.index", "w") as f:
+            for key in order:
+                f.write(f"{key}\t{offsets[key][0]}\t{offsets[key][1]}\n")
+    with open(f"{database}.lookup", "wb") as f:
+        for key, (identifier, _, _) in enumerate(records):
+            f.write(b"%d\t%s\t0\n" % (key, identifier))
+
+
+def test_fetch(tmp_path):
+    database = str(tmp_path / "mgy_seqs.mmseqs")
+    write_database(database, RECORDS, order=[3, 0, 4, 1, 2])
+    db = mmseqs_db(database)
+    assert os.path.isfile(get_key_index(database))
+    # the identifiers which aren't accessions aren't indexed
+    assert len(db) == 4
+    wanted = [b"P12345", b"MGYP000000000001", b"MGYP000000000002", b"A0A023GPI8", b"MGYP000000000003"]
+    entries = db.fetch(wanted)
+    assert set(entries) == {b"P12345", b"MGYP000000000001", b"A0A023GPI8", b"MGYP000000000003"}
+    for identifier, header, sequence in RECORDS[:4]:
+        assert entries[identifier] == (header, sequence)
+    # the index is opened again by the other processes
+    copy = pickle.loads(pickle.dumps(db))
+    assert copy.fetch([b"P12345"]) == {b"P12345": RECORDS[1][1:]}
+
+
+def test_index_rebuilt(tmp_path):
+    database = str(tmp_path / "mgy_seqs.mmseqs")
+    write_database(database, RECORDS[:2])
+    assert len(mmseqs_db(database)) == 2
+    assert len(mmseqs_db(database)) == 2
+    # database created again
+    old = time.time() - 60
+    os.utime(get_key_index(database), (old, old))
+    write_database(database, RECORDS[:4])
+    assert len(mmseqs_db(database)) == 4
+
+
+def test_empty(tmp_path):
+    database = str(tmp_path / "empty.mmseqs")
+    write_database(database, [])
+    db = mmseqs_db(database)
+    assert len(db) == 0
+    assert db.fetch([b"P12345"]) == {}
@@ -0,0 +1,137 @@
+import json
+import os
+import queue
+import zlib
+from contextlib import closing
+
+import pytest
+
+from accession_index import accession_index, decode_accession, get_index_file
+from proteins_not_in_pfam import (
+    accession_bucket,
+    accession_ranges,
+    bucket_ranges,
+    create_sqlite_database,
+    fetch_range,
+    fetch_ranges,
+    protein_cache,
+    sqlite_database,
+)
+
+PROTEINS = [
+    "A0A000A001",
+    "A0A0B2C3D4",
+    "A0AZZZZZZ9",
+    "A0B123",
+    "B2RXH2",
+    "P12345",
+    "Q9Y6K9",
+    "Z9Z9Z9",
+    "A12345",
+]
+MATCHES = [("P12345", "H"), ("B2RXH2", "H"), ("Q9Y6K9", "J")]
+NOT_IN_PFAM = sorted(set(PROTEINS) - {"P12345", "B2RXH2"})
+
+
+@pytest.fixture
+def database(tmp_path):
+    dbfile = str(tmp_path / "interpro.sqlite")
+    create_sqlite_database(dbfile, PROTEINS, MATCHES, {"uniprot": "2024_01", "pfam": "36.0"})
+    return sqlite_database(dbfile)
+
+
+def read_list(proteinfile):
+    with open(proteinfile) as f:
+        return sorted(line.strip() for line in f)
+
+
+def test_ranges_cover_accession_space():
+    ranges = accession_ranges()
+    # contiguous, sorted ranges
+    assert all(hi == lo for (_, hi), (lo, _) in zip(ranges, ranges[1:]))
+    assert all(lo < hi for lo, hi in ranges)
+    for protein in PROTEINS:
+        assert sum(lo <= protein < hi for lo, hi in ranges) == 1
+    # TrEMBL A0A accessions are split on their 4th character
+    assert ("A0AZ", "A0B") in ranges
+
+
+def test_bucket_ranges():
+    assert [accession_bucket(acc) for acc in PROTEINS[:5]] == ["A0A000", "A0A0B2", "A0AZZZ", "A0B", "B2R"]
+    buckets = ["A0A000", "A0A0B2", "A0AZZZ", "A0B", "B2R", "P12", "Q9Y"]
+    # consecutive changed buckets merged, at most size buckets per range
+    assert bucket_ranges(buckets, {"A0A0B2", "A0AZZZ", "A0B", "Q9Y"}, size=2) == [
+        ("A0A0B2", "A0AZZZ~"),
+        ("A0B", "A0B~"),
+        ("Q9Y", "Q9Y~"),
+    ]
+    assert bucket_ranges(buckets, set()) == []
+    # the accessions of a bucket are in its range, the accessions of the other buckets aren't
+    for protein in PROTEINS:
+        for bucket in buckets:
+            lo, hi = bucket_ranges(buckets, {bucket})[0]
+            assert (lo <= protein < hi) == (accession_bucket(protein) == bucket)
+
+
+def test_fetch_range_ends_with_none(database):
+    rows = queue.Queue()
+    count = fetch_range(database, "A0A", "A0B", rows, arraysize=2)
+    batches = []
+    while True:
+        batch = rows.get_nowait()
+        if batch is None:
+            break
+        batches.append(batch)
+    assert rows.empty()
+    assert count == 3
+    # by batches of arraysize
+    assert [len(b) for b in batches] == [2, 1]
+    assert sorted(sum(batches, [])) == ["A0A000A001", "A0A0B2C3D4", "A0AZZZZZZ9"]
+
+
+def test_fetch_ranges(database):
+    batches = list(fetch_ranges(database, accession_ranges(), threads=3, arraysize=1))
+    assert sorted(sum(batches, [])) == NOT_IN_PFAM
+
+
+def test_fetch_ranges_stopped_early(database):
+    # the queue is emptied so the threads can end
+    with closing(fetch_ranges(database, accession_ranges(), threads=2, arraysize=1)) as batches:
+        first = next(batches)
+    assert len(first) == 1
+
+
+def test_cache_full_then_delta(tmp_path, database, capsys):
+    proteinfile = str(tmp_path / "proteins_not_in_pfam_2024_01.txt")
+    cache = protein_cache(database, proteinfile, threads=2)
+    assert cache.update()
+    assert read_list(proteinfile) == NOT_IN_PFAM
+    index = accession_index(get_index_file(proteinfile))
+    assert sorted(decode_accession(v) for v in index) == NOT_IN_PFAM
+    assert "P12345" not in index and "Q9Y6K9" in index
+    index.close()
+    # same versions: nothing fetched
+    assert not cache.update()
+
+    # new UniProt release: a protein added, a protein now matching Pfam
+    connection = database.acquire()
+    with connection:
+        connection.execute("INSERT INTO PROTEIN VALUES ('Q00001')")
+        connection.execute("INSERT INTO MATCH VALUES ('Z9Z9Z9', 'H')")
+        connection.execute("UPDATE DB_VERSION SET VERSION = '2024_02' WHERE DBCODE = 'u'")
+    database.release(connection)
+
+    newfile = str(tmp_path / "proteins_not_in_pfam_2024_02.txt")
+    assert protein_cache(database, newfile, threads=2).update()
+    expected = sorted((set(NOT_IN_PFAM) | {"Q00001"}) - {"Z9Z9Z9"})
+    assert read_list(newfile) == expected
+    # only the buckets of the two proteins fetched again
+    assert "2 of 8 buckets updated" in capsys.readouterr().out
+    with open(f"{newfile}.json") as f:
+        metadata = json.load(f)
+    assert metadata["count"] == len(expected)
+    assert metadata["buckets"]["Q00"] == [1, zlib.crc32(b"Q00001")]
+    assert "Z9Z" not in metadata["buckets"]
+    # the previous list is unchanged
+    assert read_list(proteinfile) == NOT_IN_PFAM
+    assert os.path.isfile(f"{newfile}.json")
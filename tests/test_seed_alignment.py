@@ -0,0 +1,104 @@
+import pytest
+
+from seed_alignment import convert_to_mul, prepare_seed, read_alignment
+
+
+def write(path, rows):
+    path.write_text("".join(f"{row}\n" for row in rows))
+    return str(path)
+
+
+def rows_of(alignment):
+    sequences = [row.tobytes().decode("ascii") for row in alignment.matrix]
+    return [
+        (name, int(start), int(end), sequence)
+        for name, start, end, sequence in zip(alignment.names, alignment.starts, alignment.ends, sequences)
+    ]
+
+
+def test_identity_threshold(tmp_path):
+    alignment = read_alignment(
+        write(
+            tmp_path / "SEED4",
+            [
+                "A/1-10 ACDEFGHIKL",
+                # same residues as insertions (lower case): identical to A
+                "B/1-10 acdefghiKL",
+                # 9 identical residues out of 10: 90 %
+                "C/1-10 ACDEFGHIKW",
+                # 8 identical residues out of 10: 80 %, not above the threshold
+                "D/1-10 ACDEFGHIWW",
+                # shorter, identical to A where both have a residue
+                "E/3-7  ..DEFGH...",
+            ],
+        )
+    )
+    alignment.non_redundant(80)
+    assert alignment.names == ["A", "D"]
+    assert read_alignment(str(tmp_path / "SEED4")).non_redundant(95).names == ["A", "C", "D"]
+
+
+def test_trim_gappy_ends(tmp_path):
+    alignment = read_alignment(
+        write(
+            tmp_path / "SEED4",
+            [
+                "A/11-18 MKACDEFG..",
+                "B/1-6   ..ACDEFG..",
+                "C/5-12  ..ACDEFGHI",
+            ],
+        )
+    )
+    alignment.trim_gappy_ends(0.5)
+    # columns with 2 gaps out of 3 trimmed, the residues trimmed are removed from the coordinates
+    assert rows_of(alignment) == [
+        ("A", 13, 18, "ACDEFG"),
+        ("B", 1, 6, "ACDEFG"),
+        ("C", 5, 10, "ACDEFG"),
+    ]
+
+
+def test_remove_partial(tmp_path):
+    alignment = read_alignment(
+        write(tmp_path / "SEED4", ["A/1-5 ACDEF", "B/1-4 .CDEF", "C/2-5 ACDE.", "D/1-5 AC.EF"])
+    )
+    alignment.remove_partial()
+    assert alignment.names == ["A", "D"]
+
+
+def test_prepare_seed(tmp_path):
+    seed = str(tmp_path / "SEED")
+    count = prepare_seed(
+        write(
+            tmp_path / "SEED4",
+            [
+                "A/1-8  ..ACDEFGHI",
+                "B/1-8  ..ACDEFGHI",
+                "C/1-10 MKACDWWWHI",
+                "D/1-4  ..ACDE....",
+                "E/1-8  ..ACDYYYHI",
+            ],
+        ),
+        seed,
+    )
+    # B and D redundant with A, the two first columns trimmed then
+    assert count == 3
+    assert [line.split() for line in open(seed)] == [["A/1-8", "ACDEFGHI"], ["C/3-10", "ACDWWWHI"], ["E/1-8", "ACDYYYHI"]]
+
+
+def test_empty_and_single_row(tmp_path):
+    empty = read_alignment(write(tmp_path / "empty", []))
+    assert len(empty.non_redundant().trim_gappy_ends().remove_partial()) == 0
+    assert prepare_seed(str(tmp_path / "empty"), str(tmp_path / "SEED")) == 0
+    assert (tmp_path / "SEED").read_text() == ""
+
+    single = read_alignment(write(tmp_path / "single", [">A", "..ACDE.."]))
+    single.non_redundant().trim_gappy_ends().remove_partial()
+    assert rows_of(single) == [("A", 1, 4, "ACDE")]
+
+
+def test_ragged_alignment(tmp_path):
+    with pytest.raises(ValueError):
+        read_alignment(write(tmp_path / "SEED4", ["A/1-5 ACDEF", "B/1-4 ACDE"]))
+    with pytest.raises(ValueError):
+        convert_to_mul(write(tmp_path / "aln", [">A", "ACDEF", ">B", "ACD"]), str(tmp_path / "mul"))
@@ -0,0 +1,48 @@
+import gzip
+
+from sequence_store import build_store, sequence_store
+
+
+def write_fasta(filename, records):
+    with open(filename, "w") as f:
+        for header, sequence in records:
+            f.write(f">{header}\n{sequence}\n")
+
+
+def test_build_store_by_chunks(tmp_path):
+    uniprot = [(f"sp|P{i:05d}|NAME_{i}", "ACDEFGHIKL" * (i % 7 + 1)) for i in range(300)]
+    mgnify = [
+        (f"MGYP{i:012d} PL={'11' if i % 3 == 0 else '00'}", "MKLV" * (i % 5 + 1)) for i in range(300)
+    ]
+    inputs = [str(tmp_path / "uniprot.fa"), str(tmp_path / "mgnify.fa")]
+    write_fasta(inputs[0], uniprot)
+    write_fasta(inputs[1], mgnify)
+    storefile = str(tmp_path / "store.bgz")
+    # chunks of a few records compressed by several processes
+    assert build_store(inputs, storefile, workers=3, chunk_size=512) == (600, 600)
+
+    expected = "".join(f">{h}\n{s}\n" for h, s in uniprot + mgnify).encode()
+    with gzip.open(storefile, "rb") as f:
+        assert f.read() == expected
+    store = sequence_store(storefile)
+    assert len(store) == 600
+    assert store.get(b"P00299") == f">{uniprot[299][0]}\n{uniprot[299][1]}\n".encode()
+    entries = store.fetch([b"MGYP000000000151", b"P00000"])
+    header, sequence = mgnify[151]
+    assert entries[b"MGYP000000000151"] == (f"{header}\n".encode(), f"{sequence}\n".encode())
+    assert entries[b"P00000"][1] == f"{uniprot[0][1]}\n".encode()
+
+
+def test_filter_partial_across_chunks(tmp_path):
+    inputfile = str(tmp_path / "mgnify.fa")
+    # sequences without MGnify header kept with the previous MGnify sequence, in the next chunks
+    write_fasta(
+        inputfile,
+        [("MGYP000000000001 PL=11", "MK" * 200), ("other_1", "WW"), ("other_2", "WW")]
+        + [("MGYP000000000002 PL=00", "MK" * 200), ("other_3", "CC")],
+    )
+    storefile = str(tmp_path / "store.bgz")
+    assert build_store([inputfile], storefile, workers=2, filter_partial=True, chunk_size=64) == (5, 2)
+    with gzip.open(storefile, "rb") as f:
+        headers = [line for line in f.read().split(b"\n") if line.startswith(b">")]
+    assert headers == [b">MGYP000000000002 PL=00", b">other_3"]
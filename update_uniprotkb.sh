@@ -1,9 +1,12 @@
 #!/bin/bash
 
+set -e
+
 if [ $# -le 0 ]
         then echo "Path not given for references"
 else
     FOLDERDB=$1
+    SCRIPTDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
     mkdir -p $FOLDERDB
     cd $FOLDERDB
     
@@ -16,11 +19,18 @@ else
     fi
 
     echo "Updating Uniprotkb"
-    #put together the content of the SwissProt and TrEMBL files to obtain uniprotkb
+    #put together the content of the SwissProt and TrEMBL files to obtain uniprotkb, block-compressed and indexed by accession (see sequence_store.py)
     UNIPROT_VERSION=`cut -d ' ' -f3 <(head -1 /ebi/ftp/pub/databases/uniprot/relnotes.txt)`
 
-    zcat /ebi/ftp/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_sprot.fasta.gz /ebi/ftp/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_trembl.fasta.gz > "uniprotkb_${UNIPROT_VERSION}.fasta" 
-    cp /ebi/ftp/pub/databases/uniprot/relnotes.txt .
+    #files are written under a temporary name and renamed when complete, relnotes.txt is copied last
+    python3 "${SCRIPTDIR}/sequence_store.py" -f /ebi/ftp/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_sprot.fasta.gz /ebi/ftp/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_trembl.fasta.gz -o "uniprotkb_${UNIPROT_VERSION}.bgz" -w 16
+
+    #save SwissProt accessions in separate file (used by get_stats.py to count the SwissProt sequences of the clusters)
+    cut -d'|' -f2 <(zgrep '>' /ebi/ftp/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_sprot.fasta.gz) > "swissprot_acc_${UNIPROT_VERSION}.txt.tmp"
+    mv "swissprot_acc_${UNIPROT_VERSION}.txt.tmp" "swissprot_acc_${UNIPROT_VERSION}.txt"
+
+    cp /ebi/ftp/pub/databases/uniprot/relnotes.txt relnotes.txt.tmp
+    mv relnotes.txt.tmp relnotes.txt
 
     #save uniprot accessions in separate file
     #cut -d'|' -f2 <(grep '>' "uniprotkb_${UNIPROT_VERSION}.fasta") > "uniprot_acc_${UNIPROT_VERSION}.txt"